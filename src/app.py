@@ -7,8 +7,8 @@ from flask_jwt_extended import JWTManager
 from config import Config
 from context import init_db_session, teardown_db_session
 from error import (
-    NotFoundError, BadRequestError, UnauthorizedError, handle_not_found, handle_bad_request,
-    handle_unauthorized, handle_invalid_route, handle_internal_exception
+    NotFoundError, BadRequestError, UnauthorizedError, NotAcceptableError, handle_not_found, handle_bad_request,
+    handle_unauthorized, handle_not_acceptable, handle_invalid_route, handle_internal_exception
 )
 from routes import files, cache, views, lookups, transactions, users, permissions
 
@@ -24,6 +24,7 @@ app.register_blueprint(permissions)
 app.register_error_handler(NotFoundError, handle_not_found)
 app.register_error_handler(BadRequestError, handle_bad_request)
 app.register_error_handler(UnauthorizedError, handle_unauthorized)
+app.register_error_handler(NotAcceptableError, handle_not_acceptable)
 app.register_error_handler(404, handle_invalid_route)
 app.register_error_handler(500, handle_internal_exception)
 
@@ -0,0 +1,69 @@
+"""
+Compare the time to apply a transaction to a workbook by loading and saving it with openpyxl vs patching only the
+sheet xml, as the file grows.
+Run from the src dir: python -m benchmarks.apply_changes --rows 10000 50000 200000
+"""
+import argparse
+import io
+from itertools import islice
+
+from openpyxl import load_workbook
+
+from benchmarks.util import DATA_TYPES, synthetic_workbook, timed
+from constants import DATE_FORMAT
+from database.models import Change
+from enums import ChangeType
+from services.file_data import FileDataService
+from util.xlsx_patch import SheetPatch
+from util.xlsx_reader import XlsxReader
+
+NEW_ROW = {
+    'First Name': 'Steve', 'Last Name': 'Rogers', 'Age': '40', 'Score': '90.5', 'Notes': 'Added by the benchmark',
+    'Date Entered': '14/04/2023'
+}
+
+
+def row_dict(file_bytes: bytes, row_number: int) -> dict:
+    reader = XlsxReader(file_bytes)
+    header, row = next(reader.iter_rows()), next(islice(reader.iter_rows(), row_number, None))
+    row = dict(zip(header, row))
+    row['Date Entered'] = row['Date Entered'].strftime(DATE_FORMAT)
+    return {key: str(value) for key, value in row.items()}
+
+
+def rewrite(file_bytes: bytes, change_sets: list) -> bytes:
+    wb = load_workbook(io.BytesIO(file_bytes))
+    FileDataService._apply_to_sheet(wb.active, DATA_TYPES, change_sets)
+    return FileDataService._convert_to_bytes(wb, 'benchmark.xlsx')
+
+
+def patch(file_bytes: bytes, change_sets: list) -> bytes:
+    ws = SheetPatch(file_bytes)
+    FileDataService._apply_to_sheet(ws, DATA_TYPES, change_sets)
+    return ws.save()
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 50_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    for rows in args.rows:
+        # the workbook is saved by openpyxl once, as it would be after its first transaction
+        file_bytes = rewrite(synthetic_workbook(rows), [])
+        before = row_dict(file_bytes, rows // 2)
+        change_sets = [[
+            Change(change_type=ChangeType.UPDATE, row_number=rows // 2, before=before, after={**before, 'Age': '41'}),
+            Change(change_type=ChangeType.CREATE, row_number=rows + 1, after=NEW_ROW)
+        ]]
+        rewrite_seconds, _ = timed(rewrite, file_bytes, change_sets, repeat=args.repeat)
+        patch_seconds, _ = timed(patch, file_bytes, change_sets, repeat=args.repeat)
+        print(
+            f'{rows:>8} rows: {len(file_bytes) / 1e6:5.1f} MB, openpyxl {rewrite_seconds:6.2f}s, '
+            f'patch {patch_seconds:6.2f}s ({rewrite_seconds / patch_seconds:4.1f}x)'
+        )
+
+
+if __name__ == '__main__':
+    main()
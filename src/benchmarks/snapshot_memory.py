@@ -0,0 +1,70 @@
+"""
+Compare the memory held by one file cache entry, for the previous response dict vs the columnar snapshot.
+Run from the src dir: python -m benchmarks.snapshot_memory --rows 200000
+"""
+import argparse
+import gc
+import io
+import tracemalloc
+
+from openpyxl import load_workbook
+
+from benchmarks.util import synthetic_workbook, DATA_TYPES
+from constants import DATE_FORMAT
+from util.snapshot import SnapshotBuilder
+
+
+def legacy_row_data(file_bytes: bytes, data_types: dict) -> list:
+    """The row dicts that were previously held in the file cache"""
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    cells = list(wb.active.rows)[:]
+    row_data = []
+    for row_number, row_cells in enumerate(cells[1:]):
+        row = {'_rowNumber': row_number + 1}
+        for i, hc in enumerate(cells[0]):
+            cell_value = row_cells[i].value
+            if data_types[hc.value] == 'd':
+                try:
+                    cell_value = cell_value.strftime(DATE_FORMAT)
+                except AttributeError:
+                    pass
+            row[hc.value] = cell_value if cell_value is not None else ''
+        row_data.append(row)
+    return row_data
+
+
+def snapshot(file_bytes: bytes, data_types: dict):
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    rows = wb.active.rows
+    header_cells = next(rows)
+    builder = SnapshotBuilder([hc.value for hc in header_cells], [hc.column_letter for hc in header_cells])
+    for row_cells in rows:
+        builder.append([cell.value for cell in row_cells])
+    return builder.build(data_types)
+
+
+def retained_bytes(func, *args) -> int:
+    """Bytes still allocated once func has returned, i.e. what a cache entry would hold on to"""
+    gc.collect()
+    tracemalloc.start()
+    result = func(*args)
+    gc.collect()
+    current, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del result
+    return current
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50_000)
+    args = parser.parse_args()
+
+    file_bytes = synthetic_workbook(args.rows)
+    print(f'rows: {args.rows}, xlsx size: {len(file_bytes) / 1e6:.1f} MB')
+    for name, func in [('response dict', legacy_row_data), ('columnar snapshot', snapshot)]:
+        print(f'{name:>20}: {retained_bytes(func, file_bytes, DATA_TYPES) / 1e6:8.1f} MB per cache entry')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,49 @@
+import io
+import random
+import time
+from datetime import datetime, timedelta
+
+from openpyxl import Workbook
+from openpyxl.cell import WriteOnlyCell
+
+from constants import DATE_STYLE
+
+HEADERS = ['First Name', 'Last Name', 'Age', 'Score', 'Notes', 'Date Entered']
+DATA_TYPES = {'First Name': 's', 'Last Name': 's', 'Age': 'n', 'Score': 'n', 'Notes': 's', 'Date Entered': 'd'}
+FIRST_NAMES = ['Bruce', 'Peter', 'Tony', 'Natasha', 'Steve', 'Wanda', 'Carol', 'Thor', 'Clint', 'Sam']
+LAST_NAMES = ['Banner', 'Parker', 'Stark', 'Romanov', 'Rogers', 'Maximoff', 'Danvers', 'Odinson', 'Barton', 'Wilson']
+
+
+def synthetic_workbook(rows: int, seed: int = 0) -> bytes:
+    """Generate an xlsx with a mix of repetitive strings, numbers, free text and dates"""
+    rand = random.Random(seed)
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet()
+    ws.append(HEADERS)
+    start_date = datetime(2023, 1, 1)
+    for i in range(rows):
+        date_cell = WriteOnlyCell(ws, value=start_date + timedelta(days=rand.randint(0, 365)))
+        date_cell.number_format = DATE_STYLE
+        ws.append([
+            rand.choice(FIRST_NAMES),
+            rand.choice(LAST_NAMES),
+            rand.randint(18, 80),
+            round(rand.random() * 100, 2),
+            f'Note {i} about row {rand.randint(0, 10_000)}',
+            date_cell
+        ])
+
+    virtual_file = io.BytesIO()
+    wb.save(virtual_file)
+    return virtual_file.getvalue()
+
+
+def timed(func, *args, repeat: int = 1, **kwargs) -> (float, object):
+    """Return the best wall time in seconds over a number of runs, along with the last result"""
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
@@ -0,0 +1,43 @@
+"""
+Compare the /files/data payload size and encode time of the row dicts vs the compact array-of-arrays format,
+and the arrow stream if pyarrow is installed.
+Run from the src dir: python -m benchmarks.wire_format --rows 200000
+"""
+import argparse
+import json
+
+from benchmarks.util import synthetic_workbook, timed
+from services.file_data import FileDataService
+from util.arrow import pyarrow, to_arrow_stream
+from util.compression import compress
+
+
+def encode(snapshot, compact: bool) -> bytes:
+    data = FileDataService._get_data(snapshot, 'benchmark', compact=compact)
+    return json.dumps(data, separators=(',', ':')).encode('utf-8')
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, default=50_000)
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    file_bytes = synthetic_workbook(args.rows)
+    _, snapshot = FileDataService.ingest(file_bytes)
+    print(f'rows: {args.rows}')
+    for name, compact in [('objects', False), ('compact', True)]:
+        seconds, body = timed(encode, snapshot, compact, repeat=args.repeat)
+        gzipped = compress(body, 'gzip')
+        print(
+            f'{name:>8}: {len(body) / 1e6:6.1f} MB json, {len(gzipped) / 1e6:5.1f} MB gzip, '
+            f'{seconds:5.2f}s render + encode'
+        )
+    if pyarrow:
+        seconds, body = timed(to_arrow_stream, snapshot, repeat=args.repeat)
+        print(f'{"arrow":>8}: {len(body) / 1e6:6.1f} MB ipc,  {len(compress(body, "gzip")) / 1e6:5.1f} MB gzip, '
+              f'{seconds:5.2f}s encode')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,43 @@
+"""
+Compare cold reads of the active sheet with openpyxl read-only mode vs the streaming xlsx reader.
+Run from the src dir: python -m benchmarks.xlsx_reader --rows 10000 50000 200000
+"""
+import argparse
+import io
+
+from openpyxl import load_workbook
+
+from benchmarks.util import synthetic_workbook, timed
+from util.xlsx_reader import XlsxReader
+
+
+def read_openpyxl(file_bytes: bytes) -> list:
+    """The previous read path of the file data, before the xlsx reader"""
+    wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+    return [[cell.value for cell in row] for row in list(wb.active.rows)[:]]
+
+
+def read_xlsx_reader(file_bytes: bytes) -> list:
+    return list(XlsxReader(file_bytes).iter_rows())
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--rows', type=int, nargs='+', default=[10_000, 50_000])
+    parser.add_argument('--repeat', type=int, default=3)
+    args = parser.parse_args()
+
+    print(f'{"rows":>8} {"xlsx MB":>8} {"openpyxl s":>11} {"reader s":>9} {"speedup":>8}')
+    for rows in args.rows:
+        file_bytes = synthetic_workbook(rows)
+        openpyxl_time, expected = timed(read_openpyxl, file_bytes, repeat=args.repeat)
+        reader_time, actual = timed(read_xlsx_reader, file_bytes, repeat=args.repeat)
+        assert actual == expected, 'readers returned different values'
+        print(
+            f'{rows:>8} {len(file_bytes) / 1e6:>8.1f} {openpyxl_time:>11.2f} {reader_time:>9.2f} '
+            f'{openpyxl_time / reader_time:>7.1f}x'
+        )
+
+
+if __name__ == '__main__':
+    main()
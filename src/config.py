@@ -23,16 +23,41 @@ class Config:
     SERVER_HOST = os.getenv('SERVER_HOST', '0.0.0.0')
     SERVER_PORT = os.getenv('SERVER_PORT', 5000)
     CORS_ALLOW_ORIGINS = os.getenv('CORS_ALLOW_ORIGINS', '*')
-    GUNICORN_WORKER_COUNT = 1  # hard-code for now due to caching issues across worker processes
+    GUNICORN_WORKER_COUNT = int(os.getenv('GUNICORN_WORKER_COUNT', 1))
     GUNICORN_WORKER_THREADS = os.getenv('GUNICORN_WORKER_THREADS', 5)
     GUNICORN_TIMEOUT = os.getenv('GUNICORN_TIMEOUT', 30)
     GUNICORN_RELOAD = os.getenv('GUNICORN_RELOAD', '0').lower() in ['1', 'true']
 
     LO_AVAILABLE = os.getenv('LO_AVAILABLE') in ['1', 'true']
+    # formulas are recalculated by a pool of long lived LibreOffice instances per worker, or a fresh one if 0
+    LO_POOL_SIZE = int(os.getenv('LO_POOL_SIZE', 1))
+    LO_WORKER_PYTHON = os.getenv('LO_WORKER_PYTHON', '/usr/bin/python3')  # a python with the LibreOffice uno module
+    LO_JOB_TIMEOUT = float(os.getenv('LO_JOB_TIMEOUT', 20))  # seconds, kept under the gunicorn timeout
+    LO_STARTUP_TIMEOUT = float(os.getenv('LO_STARTUP_TIMEOUT', 60))
+    LO_HEALTH_CHECK_INTERVAL = float(os.getenv('LO_HEALTH_CHECK_INTERVAL', 30))
     EXCEL_AVAILABLE = os.getenv('EXCEL_AVAILABLE') in ['1', 'true']
 
     MAX_FILE_SIZE_MB = int(os.getenv('MAX_FILE_SIZE_MB', 15))
+    BLOB_STORE = os.getenv('BLOB_STORE', 'database')  # 'database' or 'local', for a content addressed directory
+    # the store holds the only copy of each workbook, so must be at a persistent path rather than e.g. in /tmp
+    BLOB_STORE_PATH = os.environ['BLOB_STORE_PATH'] if BLOB_STORE == 'local' else os.getenv('BLOB_STORE_PATH')
     FILE_CACHE_SIZE = int(os.getenv('CACHE_SIZE', 50))
+    FILE_CACHE_MAX_MB = int(os.getenv('CACHE_MAX_MB', 512))  # memory budget across all cached files
+    # workers share cached file data through a local sqlite store, which is needed with more than one worker.
+    # It holds pickled data, so must be at a path only the app's user can write to, rather than e.g. in /tmp
+    SHARED_CACHE_PATH = (
+        os.environ['SHARED_CACHE_PATH'] if GUNICORN_WORKER_COUNT > 1 else os.getenv('SHARED_CACHE_PATH')
+    )
+    SHARED_CACHE_MAX_MB = int(os.getenv('SHARED_CACHE_MAX_MB', 2048))  # values the shared store holds at most
+    CACHE_REBUILD_ASYNC = os.getenv('CACHE_REBUILD_ASYNC', '1').lower() in ['1', 'true']
+    FILE_BLOCK_CACHE_SIZE = int(os.getenv('BLOCK_CACHE_SIZE', 32))  # rendered row blocks cached per file
+    STREAM_CHUNK_ROWS = int(os.getenv('STREAM_CHUNK_ROWS', 5000))  # rows rendered at a time for streamed data
+    VERSION_CHECKPOINT_INTERVAL = int(os.getenv('VERSION_CHECKPOINT_INTERVAL', 20))  # versions between full copies
+    VERSION_CACHE_SIZE = int(os.getenv('VERSION_CACHE_SIZE', 10))  # past versions of files rebuilt from the log
+    # approved changes are applied by background threads, one job at a time per file, so requests don't wait
+    APPLY_ASYNC = os.getenv('APPLY_ASYNC', '1').lower() in ['1', 'true']
+    APPLY_WORKERS = int(os.getenv('APPLY_WORKERS', 2))  # files which have changes applied at once, per worker
+    DOWNLOAD_CHUNK_KB = int(os.getenv('DOWNLOAD_CHUNK_KB', 1024))  # blob bytes read from the database at a time
 
     JWT_SECRET_KEY = os.getenv('JWT_SECRET_KEY')
     JWT_ACCESS_TOKEN_EXPIRES = float(os.getenv('JWT_ACCESS_TOKEN_EXPIRES', 1))  # hours
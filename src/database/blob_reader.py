@@ -0,0 +1,64 @@
+import io
+
+from sqlalchemy import func
+
+from database import db
+from database.models import File
+
+
+class DatabaseBlobReader(io.RawIOBase):
+    """
+    Seekable reader of a blob held in the database, which selects only the bytes read, so a download or range of
+    one is sent without loading the whole blob. It has its own session, as it's read after the request has ended.
+    Each read is of the version of the file it was opened for, so if the file changes while it's read, the read
+    fails rather than mixing bytes of two versions under the one ETag.
+    """
+
+    def __init__(self, file_id: str, size: int, version: int):
+        super().__init__()
+        self.file_id = file_id
+        self.size = size
+        self.version = version
+        self.position = 0
+        self._session = None
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def tell(self) -> int:
+        return self.position
+
+    def seek(self, offset: int, whence: int = io.SEEK_SET) -> int:
+        if whence == io.SEEK_CUR:
+            offset += self.position
+        elif whence == io.SEEK_END:
+            offset += self.size
+        if offset < 0:
+            raise ValueError(f'negative seek position {offset}')
+        self.position = offset
+        return self.position
+
+    def readinto(self, buffer) -> int:
+        length = min(len(buffer), self.size - self.position)
+        if length <= 0:
+            return 0
+        if self._session is None:
+            self._session = db.get_session()
+        # substr is 1-indexed, and works on blobs in sqlite and bytea in postgresql
+        data = self._session.query(
+            func.substr(File._blob, self.position + 1, length)
+        ).filter(File.id == self.file_id, File.version == self.version).scalar()
+        if not data:
+            raise IOError(f'Version {self.version} of file {self.file_id!r} changed or deleted while being read')
+        buffer[:len(data)] = data
+        self.position += len(data)
+        return len(data)
+
+    def close(self):
+        if self._session is not None:
+            self._session.close()
+            self._session = None
+        super().close()
@@ -0,0 +1,68 @@
+import hashlib
+import mmap
+import os
+import tempfile
+from typing import Iterator, Optional
+
+from config import Config
+
+
+class LocalBlobStore:
+    """
+    Content addressed store of file blobs in a local directory, keyed by the sha256 of their contents, so an
+    unchanged workbook is only stored once. Blobs are read by memory mapping rather than copying them into memory.
+    """
+
+    def __init__(self, root: str):
+        self.root = root
+        os.makedirs(root, exist_ok=True)
+
+    def put(self, data: bytes) -> str:
+        key = hashlib.sha256(data).hexdigest()
+        path = self.path(key)
+        try:
+            # so a blob stored again isn't collected as garbage before the file referencing it is committed
+            os.utime(path)
+            return key
+        except FileNotFoundError:
+            pass
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        # write to a temp file then rename, so a blob is never seen partially written
+        fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path))
+        with os.fdopen(fd, 'wb') as temp_file:
+            temp_file.write(data)
+        os.replace(temp_path, path)
+        return key
+
+    def get(self, key: str) -> mmap.mmap or bytes:
+        with open(self.path(key), 'rb') as blob_file:
+            if os.fstat(blob_file.fileno()).st_size == 0:
+                return b''  # empty files can't be memory mapped
+            return mmap.mmap(blob_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def path(self, key: str) -> str:
+        return os.path.join(self.root, key[:2], key[2:4], key)
+
+    def delete(self, key: str):
+        try:
+            os.remove(self.path(key))
+        except FileNotFoundError:
+            pass
+
+    def keys(self) -> Iterator[str]:
+        for dir_path, _, filenames in os.walk(self.root):
+            for filename in filenames:
+                if len(filename) == 64 and not filename.startswith('tmp'):
+                    yield filename
+
+
+def _create_blob_store() -> Optional[LocalBlobStore]:
+    if Config.BLOB_STORE == 'local':
+        return LocalBlobStore(Config.BLOB_STORE_PATH)
+    if Config.BLOB_STORE != 'database':
+        raise ValueError(f'Unknown blob store provided: {Config.BLOB_STORE}')
+    return None
+
+
+# None when blobs are kept in the database
+blob_store = _create_blob_store()
@@ -1,6 +1,8 @@
 from sqlalchemy import Enum, String
 
-from enums import ChangeType, FilterType, ConditionOperator, LookupOperator, FilterOperator, ApprovalStatus, Role
+from enums import (
+    ChangeType, FilterType, ConditionOperator, LookupOperator, FilterOperator, ApprovalStatus, Role, JobStatus
+)
 
 UUID_STRING = String(length=22)
 
@@ -11,4 +13,5 @@ ENUM_CONDITION_OPERATOR = Enum(ConditionOperator, name='condition_operator')
 ENUM_LOOKUP_OPERATOR = Enum(LookupOperator, name='lookup_operator')
 ENUM_APPROVAL_STATUS = Enum(ApprovalStatus, name='approval_status')
 ENUM_ROLE = Enum(Role, name='role')
+ENUM_JOB_STATUS = Enum(JobStatus, name='job_status')
 
@@ -1,7 +1,8 @@
 from abc import ABC
 
-from sqlalchemy import create_engine
-from sqlalchemy.engine import Engine
+from sqlalchemy import MetaData, Table, create_engine, inspect
+from sqlalchemy.engine import Connection, Engine
+from sqlalchemy.schema import CreateColumn
 from sqlalchemy.orm import sessionmaker
 from sqlalchemy_utils import database_exists, create_database
 
@@ -19,6 +20,7 @@ class Database(ABC):
             self.create_schema()
         else:
             self.engine = create_engine(url, **kwargs)
+            self.upgrade_schema()
         self.SessionMaker = sessionmaker(self.engine)
 
     def get_session(self):
@@ -29,3 +31,47 @@ class Database(ABC):
 
     def drop_schema(self):
         DeclarativeBase.metadata.drop_all(self.engine)
+
+    def upgrade_schema(self):
+        """
+        Bring a database created by an earlier version of the app up to the models, by creating the tables and
+        adding the columns added since, and dropping NOT NULL from columns which have become nullable. Only what
+        differs is changed, so it is run on every start.
+        """
+        DeclarativeBase.metadata.create_all(self.engine)  # only the missing tables
+        inspector = inspect(self.engine)
+        preparer = self.engine.dialect.identifier_preparer
+        with self.engine.begin() as connection:
+            for table in DeclarativeBase.metadata.sorted_tables:
+                existing = {column['name']: column for column in inspector.get_columns(table.name)}
+                for column in table.columns:
+                    if column.name not in existing:
+                        # added columns which are NOT NULL all have a server default, for the existing rows
+                        ddl = CreateColumn(column).compile(dialect=self.engine.dialect)
+                        connection.exec_driver_sql(f'ALTER TABLE {preparer.format_table(table)} ADD COLUMN {ddl}')
+                    elif column.nullable and not existing[column.name]['nullable']:
+                        if self.engine.dialect.name == 'sqlite':
+                            self._rebuild_table(connection, table, list(existing))
+                            break
+                        connection.exec_driver_sql(
+                            f'ALTER TABLE {preparer.format_table(table)} '
+                            f'ALTER COLUMN {preparer.format_column(column)} DROP NOT NULL'
+                        )
+
+    def _rebuild_table(self, connection: Connection, table: Table, columns: list):
+        """
+        Recreate a table as the model defines it and copy its rows over, as sqlite can't alter columns. The new
+        table is renamed to the old name once that is dropped, so references to it from other tables still hold.
+        """
+        preparer = self.engine.dialect.identifier_preparer
+        new_table = table.to_metadata(MetaData(), name=f'{table.name}__upgrade')
+        new_table.create(connection)
+        names = ', '.join(preparer.quote(name) for name in columns)
+        connection.exec_driver_sql(
+            f'INSERT INTO {preparer.format_table(new_table)} ({names}) '
+            f'SELECT {names} FROM {preparer.format_table(table)}'
+        )
+        connection.exec_driver_sql(f'DROP TABLE {preparer.format_table(table)}')
+        connection.exec_driver_sql(
+            f'ALTER TABLE {preparer.format_table(new_table)} RENAME TO {preparer.format_table(table)}'
+        )
@@ -0,0 +1,126 @@
+"""
+Move file blobs between the database and the local blob store, and remove blobs no longer referenced by a file.
+The schema of an existing database is upgraded first, as when the app starts. Run from the src dir with the
+BLOB_STORE env vars of the app:
+    python -m database.migrate_blobs --to local
+    python -m database.migrate_blobs --to database
+    python -m database.migrate_blobs --gc
+    python -m database.migrate_blobs --sizes
+"""
+import argparse
+import logging
+import os
+import time
+
+from sqlalchemy import func
+
+from database import db
+from database.blob_store import blob_store, LocalBlobStore
+from database.models import File
+
+logger = logging.getLogger(__name__)
+
+GC_GRACE_MINUTES = 60
+
+
+def migrate_to_store(store: LocalBlobStore) -> int:
+    """Move blobs held in the database into the store, one file at a time so only one blob is in memory"""
+    session = db.get_session()
+    moved = 0
+    try:
+        for (file_id,) in session.query(File.id).filter(File.blob_key.is_(None)).all():
+            file = session.query(File).filter_by(id=file_id).one()
+            file.blob_key = store.put(file._blob)
+            file.size_bytes = len(file._blob)
+            file._blob = None
+            session.commit()
+            session.expunge(file)
+            moved += 1
+    finally:
+        session.close()
+    return moved
+
+
+def migrate_to_database(store: LocalBlobStore) -> int:
+    session = db.get_session()
+    moved = 0
+    try:
+        for (file_id,) in session.query(File.id).filter(File.blob_key.isnot(None)).all():
+            file = session.query(File).filter_by(id=file_id).one()
+            file._blob = bytes(store.get(file.blob_key))
+            file.size_bytes = len(file._blob)
+            file.blob_key = None
+            session.commit()
+            session.expunge(file)
+            moved += 1
+    finally:
+        session.close()
+    return moved
+
+
+def backfill_sizes() -> int:
+    """Set the size of files saved before their sizes were stored, which are 0"""
+    session = db.get_session()
+    try:
+        updated = session.query(File).filter(File.size_bytes == 0, File.blob_key.is_(None)).update(
+            {File.size_bytes: func.coalesce(func.length(File._blob), 0)}, synchronize_session=False
+        )
+        for file in session.query(File).filter(File.size_bytes == 0, File.blob_key.isnot(None)).all():
+            file.size_bytes = os.path.getsize(file.blob_path)
+            updated += 1
+        session.commit()
+    finally:
+        session.close()
+    return updated
+
+
+def collect_garbage(store: LocalBlobStore, grace_minutes: float = GC_GRACE_MINUTES) -> int:
+    """
+    Delete blobs not referenced by any file, e.g. previous versions of files which have changed. Blobs stored in
+    the last grace_minutes are kept, as the app may be running and not have committed the files referencing them.
+    """
+    stored_before = time.time() - grace_minutes * 60
+    session = db.get_session()
+    try:
+        referenced = {key for (key,) in session.query(File.blob_key).filter(File.blob_key.isnot(None))}
+    finally:
+        session.close()
+    removed = 0
+    for key in list(store.keys()):
+        if key not in referenced and _stored_at(store, key) < stored_before:
+            store.delete(key)
+            removed += 1
+    return removed
+
+
+def _stored_at(store: LocalBlobStore, key: str) -> float:
+    try:
+        return os.path.getmtime(store.path(key))
+    except FileNotFoundError:
+        return time.time()  # deleted since listed
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--to', choices=['local', 'database'])
+    parser.add_argument('--gc', action='store_true', help='remove unreferenced blobs from the store')
+    parser.add_argument(
+        '--gc-grace', type=float, default=GC_GRACE_MINUTES, help='minutes to keep newly stored blobs for'
+    )
+    parser.add_argument('--sizes', action='store_true', help='set the size of files saved before sizes were')
+    args = parser.parse_args()
+
+    if args.sizes:
+        print(f'Set the size of {backfill_sizes()} files')
+    if blob_store is None and (args.to or args.gc):
+        parser.error('BLOB_STORE=local and BLOB_STORE_PATH must be set to the blob store to migrate to/from')
+    if args.to == 'local':
+        print(f'Moved {migrate_to_store(blob_store)} blobs to {blob_store.root}')
+    elif args.to == 'database':
+        print(f'Moved {migrate_to_database(blob_store)} blobs to the database')
+    if args.gc:
+        print(f'Removed {collect_garbage(blob_store, args.gc_grace)} unreferenced blobs')
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,17 @@
 import json
+from mmap import mmap
 from typing import List
 
-from sqlalchemy import Integer, Column, String, LargeBinary, ForeignKey, DateTime, func, Boolean, ForeignKeyConstraint
-from sqlalchemy.orm import declarative_base, relationship
+from sqlalchemy import (
+    Integer, Column, String, LargeBinary, ForeignKey, DateTime, func, Boolean, ForeignKeyConstraint, UniqueConstraint,
+    false
+)
+from sqlalchemy.orm import declarative_base, relationship, deferred
 
+from database.blob_store import blob_store
 from database.column_types import (
-    ENUM_FILTER_TYPE, ENUM_CHANGE_TYPE, ENUM_LOOKUP_OPERATOR,
-    ENUM_CONDITION_OPERATOR, ENUM_FILTER_OPERATOR, ENUM_APPROVAL_STATUS, ENUM_ROLE, UUID_STRING
+    ENUM_FILTER_TYPE, ENUM_CHANGE_TYPE, ENUM_LOOKUP_OPERATOR, ENUM_CONDITION_OPERATOR,
+    ENUM_FILTER_OPERATOR, ENUM_APPROVAL_STATUS, ENUM_ROLE, ENUM_JOB_STATUS, UUID_STRING
 )
 from database.util import generate_uuid
 
@@ -24,8 +29,11 @@ class File(Base):
 
     name = Column(String, nullable=False)
     content_type = Column(String, nullable=False)
-    blob = Column(LargeBinary, nullable=False)
+    _blob = deferred(Column('blob', LargeBinary, nullable=True))  # only loaded when accessed, as can be large
+    blob_key = Column(String, nullable=True)  # key of the blob in the blob store, if not held in the database
+    size_bytes = Column(Integer, nullable=False, default=0, server_default='0')
     _data_types = Column(String, nullable=False)
+    version = Column(Integer, nullable=False, default=1, server_default='1')  # bumped whenever the blob changes
 
     views = relationship("View", back_populates="file", cascade='all, delete')
     lookups = relationship(
@@ -33,6 +41,32 @@ class File(Base):
     )
     transactions = relationship("Transaction", back_populates="file", cascade='all, delete')
     permissions = relationship("Permission", back_populates="file", cascade='all, delete')
+    snapshot = relationship("Snapshot", back_populates="file", uselist=False, cascade='all, delete')
+    versions = relationship("FileVersion", back_populates="file", cascade='all, delete')
+
+    # updates only match the version the row was loaded at, so a file changed by another worker since raises a
+    # StaleDataError rather than being overwritten. The version is bumped by the app, only when the blob changes.
+    __mapper_args__ = {'version_id_col': version, 'version_id_generator': False}
+
+    @property
+    def blob(self) -> bytes or mmap:
+        """The workbook bytes, which are memory mapped if held in the blob store"""
+        return blob_store.get(self.blob_key) if self.blob_key else self._blob
+
+    @blob.setter
+    def blob(self, blob: bytes):
+        if blob_store:
+            self.blob_key = blob_store.put(blob)
+            self._blob = None
+        else:
+            self._blob = blob
+            self.blob_key = None
+        self.size_bytes = len(blob)
+
+    @property
+    def blob_path(self) -> str or None:
+        """Path of the blob on local disk, if held in the blob store"""
+        return blob_store.path(self.blob_key) if self.blob_key else None
 
     @property
     def data_types(self) -> dict:
@@ -43,6 +77,39 @@ class File(Base):
         self._data_types = json.dumps(data_types)
 
 
+class Snapshot(Base):
+    """Parsed row data of a file, so it can be loaded without reparsing the workbook"""
+    __tablename__ = "snapshot"
+
+    file_id = Column(UUID_STRING, ForeignKey('file.id'), nullable=False, unique=True)
+    version = Column(Integer, nullable=False)  # version of the file it was parsed from
+    data = Column(LargeBinary, nullable=False)
+
+    file = relationship("File", back_populates="snapshot")
+
+
+class FileVersion(Base):
+    """
+    Entry in the version log of a file. A checkpoint holds the row data of the version as a serialized snapshot,
+    otherwise it holds the row changes from the previous version, so past versions don't each need a full copy.
+    """
+    __tablename__ = "file_version"
+
+    file_id = Column(UUID_STRING, ForeignKey('file.id'), nullable=False)
+    version = Column(Integer, nullable=False)
+    checkpoint = Column(Boolean, nullable=False)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    data = deferred(Column(LargeBinary, nullable=False))
+    # a delta whose formula result updates are yet to be added, once the version has been parsed
+    pending = Column(Boolean, nullable=False, default=False, server_default=false())
+
+    file = relationship("File", back_populates="versions")
+
+    __table_args__ = (
+        UniqueConstraint(file_id, version, checkpoint),
+    )
+
+
 class View(Base):
     __tablename__ = "view"
 
@@ -115,6 +182,7 @@ class Transaction(Base):
     approver_id = Column(UUID_STRING, ForeignKey('user.id'))
 
     changes = relationship('Change', back_populates="transaction", cascade='all, delete')
+    jobs = relationship('ApplyJob', back_populates="transaction", cascade='all, delete')
     file = relationship('File', back_populates="transactions")
     user = relationship('User', foreign_keys=[user_id])
     approver = relationship('User', foreign_keys=[approver_id])
@@ -125,6 +193,22 @@ class Transaction(Base):
     )
 
 
+class ApplyJob(Base):
+    """Applying the changes of an approved transaction to its file, which is done in the background"""
+    __tablename__ = "apply_job"
+
+    file_id = Column(UUID_STRING, ForeignKey('file.id'), nullable=False)
+    transaction_id = Column(UUID_STRING, ForeignKey('transaction.id'), nullable=False)
+    status = Column(ENUM_JOB_STATUS, nullable=False)
+    error = Column(String)
+    created_at = Column(DateTime(timezone=True), server_default=func.now(), nullable=False)
+    started_at = Column(DateTime(timezone=True))
+    finished_at = Column(DateTime(timezone=True))
+    worker = Column(String)  # host:pid of the worker process it's queued in, so it can be queued again if that exits
+
+    transaction = relationship('Transaction', back_populates="jobs")
+
+
 class Change(Base):
     __tablename__ = "change"
 
@@ -48,6 +48,13 @@ class ApprovalStatus(enum.Enum):
     REJECTED = enum.auto()
 
 
+class JobStatus(enum.Enum):
+    QUEUED = enum.auto()
+    RUNNING = enum.auto()
+    DONE = enum.auto()
+    FAILED = enum.auto()
+
+
 class Role(enum.Enum):
     OWNER = enum.auto()
     CONTRIBUTOR = enum.auto()
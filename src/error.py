@@ -19,6 +19,10 @@ class UnauthorizedError(APIError):
     pass
 
 
+class NotAcceptableError(APIError):
+    pass
+
+
 def handle_not_found(e):
     return e.as_dict(), 404
 
@@ -31,6 +35,10 @@ def handle_unauthorized(e):
     return e.as_dict(), 401
 
 
+def handle_not_acceptable(e):
+    return e.as_dict(), 406
+
+
 def handle_invalid_route(e):
     return {'message': 'Requested route does not exist'}, 404
 
@@ -1,11 +1,19 @@
-from flask import Blueprint, request, jsonify, send_file
+import json
+from typing import List
+
+from flask import Blueprint, Response, request, jsonify, send_file
+from werkzeug.exceptions import RequestedRangeNotSatisfiable
 
 from context import current_user_id
 from decorators import jwt_user_required
 from error import BadRequestError
-from services import FileDataService, FileService, PermissionService
+from services import FileDataService, FileService, PermissionService, VersionService
+from util.arrow import ARROW_STREAM_MIMETYPE
+from util.compression import ENCODINGS
 
 files = Blueprint('files', __name__, url_prefix='/files')
+# file data is negotiated on its format and encoding
+DATA_VARY = ['Accept', 'Accept-Encoding']
 
 
 @files.post("")
@@ -19,8 +27,8 @@ def add_file():
     content_type = file.content_type
     FileService.validate_content_type(content_type)
     file_bytes = file.read()
-    data_types = FileDataService.get_data_types(file_bytes)
-    file_ = FileService.create(file_bytes, filename, content_type, data_types)
+    data_types, snapshot = FileDataService.ingest(file_bytes)
+    file_ = FileService.create(file_bytes, filename, content_type, data_types, snapshot=snapshot)
     user_id = current_user_id.get()
     PermissionService.create(file_id=file_['id'], user_id=user_id, role='OWNER')
     return file_
@@ -41,13 +49,14 @@ def update_file():
     content_type = file.content_type
     FileService.validate_content_type(content_type)
     file_bytes = file.read()
-    data_types = FileDataService.get_data_types(file_bytes)
+    data_types, snapshot = FileDataService.ingest(file_bytes)
     return FileService.update(
         id_=file_id,
         file_bytes=file_bytes,
         filename=filename,
         content_type=content_type,
-        data_types=data_types
+        data_types=data_types,
+        snapshot=snapshot
     )
 
 
@@ -80,8 +89,22 @@ def download_file():
     if not file_id:
         raise BadRequestError(message='id not found in request')
 
-    blob, filename, content_type = FileService.download(id_=file_id)
-    return send_file(blob, mimetype=content_type, as_attachment=True, download_name=filename)
+    etag = _get_etag(file_id, FileService.get_version(id_=file_id))
+    if etag in request.if_none_match:
+        return _not_modified(etag)
+
+    blob, size, filename, content_type, version = FileService.download(id_=file_id)
+    etag = _get_etag(file_id, version)  # of the version the blob is read from, in case it changed since the check
+    response = send_file(
+        blob, mimetype=content_type, as_attachment=True, download_name=filename, etag=etag, conditional=False
+    )
+    # send_file only knows the size of paths, so ranges and If-Range are handled here with the stored size
+    response.content_length = size
+    try:
+        return response.make_conditional(request, accept_ranges=True, complete_length=size)
+    except RequestedRangeNotSatisfiable:
+        response.close()
+        raise
 
 
 @files.get("/data")
@@ -91,4 +114,92 @@ def get_file_data():
     if not file_id:
         raise BadRequestError(message='id not found in request')
 
-    return FileDataService.get_data(id_=file_id)
+    start_row = _get_row_arg('startRow')
+    end_row = _get_row_arg('endRow')
+    view_id = request.args.get('viewId')
+    sort_model = _get_sort_model()
+    compact = _is_compact_format()
+    version = _get_row_arg('version')  # a past version of the file, otherwise the current one
+    # analytics clients can ask for the arrow format, which is binary so isn't compressed further
+    arrow = request.accept_mimetypes.best_match(['application/json', ARROW_STREAM_MIMETYPE]) == ARROW_STREAM_MIMETYPE
+    # streamed JSON is rendered and sent in chunks for very large sheets, and can only be gzipped on the fly
+    stream = not arrow and request.args.get('stream', '').lower() in ['1', 'true']
+    encoding = None if arrow else request.accept_encodings.best_match(['gzip'] if stream else ENCODINGS)
+    # the version is read first, so the body is never older than the ETag it is sent with
+    if version is None:
+        version = FileDataService.get_version(id_=file_id)
+    etag = _get_etag(file_id, version, 'arrow' if arrow else 'stream' if stream else None, encoding)
+    if etag in request.if_none_match:
+        return _not_modified(etag, DATA_VARY)
+
+    params = dict(start_row=start_row, end_row=end_row, view_id=view_id, sort_model=sort_model, version=version)
+    if arrow:
+        response = Response(FileDataService.get_arrow_data(id_=file_id, **params), mimetype=ARROW_STREAM_MIMETYPE)
+    elif stream:
+        chunks = FileDataService.stream_data(id_=file_id, gzip=encoding == 'gzip', compact=compact, **params)
+        response = Response(chunks, mimetype='application/json')
+    else:
+        body = FileDataService.get_encoded_data(id_=file_id, encoding=encoding, compact=compact, **params)
+        response = Response(body, mimetype='application/json')
+    if encoding:
+        response.content_encoding = encoding
+    response.vary.update(DATA_VARY)
+    response.set_etag(etag)
+    return response
+
+
+@files.get("/versions")
+@jwt_user_required()
+def get_file_versions():
+    file_id = request.args.get('id')
+    if not file_id:
+        raise BadRequestError(message='id not found in request')
+    return jsonify(VersionService.list(file_id=file_id))
+
+
+def _get_etag(file_id: str, version: int, *representation: str) -> str:
+    """
+    Views are immutable and the request args are part of the URL, so the file version identifies a response.
+    Each format and content encoding of it is a different representation, so gets its own ETag.
+    """
+    return '-'.join([file_id, str(version), *(part for part in representation if part)])
+
+
+def _not_modified(etag: str, vary: List[str] = None) -> Response:
+    """A 304 has the Vary of the response it stands for, so caches keep the variants of a resource apart"""
+    response = Response(status=304)
+    response.set_etag(etag)
+    if vary:
+        response.vary.update(vary)
+    return response
+
+
+def _get_row_arg(name: str) -> int or None:
+    value = request.args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise BadRequestError(message=f'{name} must be a non-negative integer')
+    return int(value)
+
+
+def _get_sort_model() -> list or None:
+    """The ag-grid sort model as JSON, e.g. [{"colId": "C", "sort": "desc"}]"""
+    value = request.args.get('sortModel')
+    if not value:
+        return None
+    try:
+        sort_model = json.loads(value)
+    except ValueError:
+        raise BadRequestError(message='sortModel must be valid JSON')
+    if not isinstance(sort_model, list) or not all(isinstance(sort, dict) for sort in sort_model):
+        raise BadRequestError(message='sortModel must be a list of {colId, sort} objects')
+    return sort_model
+
+
+def _is_compact_format() -> bool:
+    """Rows are sent as lists of values in the order of 'fields' if format=compact, otherwise as dicts"""
+    row_format = request.args.get('format', 'objects')
+    if row_format not in ['objects', 'compact']:
+        raise BadRequestError(message=f'format must be objects or compact but got {row_format!r}')
+    return row_format == 'compact'
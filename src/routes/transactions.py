@@ -4,7 +4,7 @@ from flask_jwt_extended import jwt_required
 from context import current_user_id
 from decorators import jwt_user_required
 from error import BadRequestError
-from services import TransactionService
+from services import TransactionService, ApplyJobService
 
 transactions = Blueprint('transactions', __name__, url_prefix='/transactions')
 
@@ -22,7 +22,8 @@ def add_transaction():
     if not changes_data:
         raise BadRequestError(message='changes not found in request')
 
-    return TransactionService.create(file_id=file_id, user_id=user_id, changes_data=changes_data)
+    transaction = TransactionService.create(file_id=file_id, user_id=user_id, changes_data=changes_data)
+    return _accepted_if_queued(transaction)
 
 
 @transactions.get("")
@@ -58,7 +59,25 @@ def update_transaction():
     if not status:
         raise BadRequestError(message='status not found in request')
 
-    return TransactionService.update(transaction_id, user_id, status, file_id=file_id, notes=notes)
+    transaction = TransactionService.update(transaction_id, user_id, status, file_id=file_id, notes=notes)
+    return _accepted_if_queued(transaction)
+
+
+@transactions.put("/approve")
+@jwt_user_required()
+def approve_transactions():
+    file_id = request.json.get('fileId')
+    if not file_id:
+        raise BadRequestError(message='file id not found in request')
+
+    transaction_ids = request.json.get('ids')
+    if not transaction_ids or not isinstance(transaction_ids, list):
+        raise BadRequestError(message='ids not found in request')
+
+    notes = request.json.get('notes')
+    user_id = current_user_id.get()
+    transactions_ = TransactionService.approve(transaction_ids, user_id, file_id=file_id, notes=notes)
+    return jsonify(transactions_), 202
 
 
 @transactions.delete("")
@@ -70,3 +89,23 @@ def delete_transaction():
 
     success = TransactionService.delete(id_=transaction_id)
     return {'success': success}
+
+
+@transactions.get("/jobs")
+@jwt_user_required()
+def get_jobs():
+    file_id = request.args.get('fileId')
+    if not file_id:
+        raise BadRequestError(message='file id not found in request')
+
+    job_id = request.args.get('id')
+    if job_id:
+        return ApplyJobService.get(id_=job_id, file_id=file_id)
+    else:
+        jobs = ApplyJobService.list(file_id=file_id)
+        return jsonify(jobs)
+
+
+def _accepted_if_queued(transaction: dict):
+    """Approved changes are applied by a job, which the client can poll at /transactions/jobs"""
+    return (transaction, 202) if 'job' in transaction else transaction
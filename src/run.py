@@ -1,12 +1,42 @@
+import threading
+
 from app import app
 from config import Config
 from logger import init_root_logger
 from server import ExcelApplication, CustomGunicornLogger, ACCESS_FORMAT, GUNICORN_LEVEL
+from services.apply_jobs import ApplyJobService
+from services.file_data import file_cache
+from util.lo_pool import get_recalc_pool
+from util.shared_cache import SharedLRUCache
 
 init_root_logger()
 
 
+def post_fork(server, worker):
+    """
+    Start the LibreOffice instances of each worker as it's forked, rather than on its first apply, and pick up the
+    apply jobs left by workers which exited
+    """
+    if Config.LO_AVAILABLE and Config.LO_POOL_SIZE:
+        threading.Thread(target=get_recalc_pool().start, daemon=True).start()
+    ApplyJobService.resume()
+
+
+def worker_exit(server, worker):
+    """Stop the LibreOffice instances of a worker as it exits, whether it's stopped, recycled or timed out"""
+    if Config.LO_AVAILABLE and Config.LO_POOL_SIZE:
+        get_recalc_pool().close()
+
+
+def child_exit(server, worker):
+    ApplyJobService.release(worker.pid)
+
+
 def run_app():
+    if isinstance(file_cache, SharedLRUCache):
+        file_cache.store.clear()  # entries left by a previous run may be for old versions of files
+    ApplyJobService.release()  # jobs which were queued or running when the server stopped
+
     options = {
         'bind': f'{Config.SERVER_HOST}:{Config.SERVER_PORT}',
         'workers': Config.GUNICORN_WORKER_COUNT,
@@ -18,7 +48,10 @@ def run_app():
         'access_log_format': ACCESS_FORMAT,
         'loglevel': GUNICORN_LEVEL,
         'accesslog': '-',
-        'errorlog': '-'
+        'errorlog': '-',
+        'post_fork': post_fork,
+        'worker_exit': worker_exit,
+        'child_exit': child_exit
     }
     ExcelApplication(app, options=options).run()
 
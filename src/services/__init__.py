@@ -1,7 +1,9 @@
 from .files import FileService
 from .file_data import FileDataService
+from .versions import VersionService
 from .lookups import LookupService
 from .views import ViewService
 from .users import UserService
+from .apply_jobs import ApplyJobService
 from .transactions import TransactionService
 from .permissions import PermissionService
@@ -0,0 +1,207 @@
+import logging
+import os
+import socket
+from datetime import datetime
+from typing import List
+
+from sqlalchemy.orm import Session
+from sqlalchemy.orm.exc import StaleDataError
+
+from config import Config
+from context import db_session
+from database import db
+from database.models import ApplyJob, File, Transaction
+from decorators import enforce_permission
+from enums import JobStatus
+from error import NotFoundError
+from services.file_data import FileDataService
+from util.keyed_queue import KeyedQueue
+
+logger = logging.getLogger(__name__)
+
+APPLY_ATTEMPTS = 3  # times changes are applied to the latest version of a file, if another worker changed it first
+
+
+class ApplyJobService:
+    @classmethod
+    @enforce_permission(file_id_key='file_id', required_roles=['*'])
+    def get(cls, id_: str, file_id: str) -> dict:
+        session = db_session.get()
+        job = session.query(ApplyJob).filter_by(id=id_, file_id=file_id).one_or_none()
+        if not job:
+            raise NotFoundError(message=f'Job {id_} not found')
+        return cls._job_to_dict(job)
+
+    @classmethod
+    @enforce_permission(file_id_key='file_id', required_roles=['*'])
+    def list(cls, file_id: str) -> List[dict]:
+        session = db_session.get()
+        jobs = session.query(ApplyJob).filter_by(file_id=file_id).order_by(ApplyJob.created_at).all()
+        return [cls._job_to_dict(job) for job in jobs]
+
+    @classmethod
+    def enqueue(cls, session: Session, transaction: Transaction) -> dict:
+        return cls.enqueue_all(session, [transaction])[0]
+
+    @classmethod
+    def enqueue_all(cls, session: Session, transactions: List[Transaction]) -> List[dict]:
+        """
+        Queue applying the changes of approved transactions of a file, in the order given. The jobs are committed
+        before they're queued, so their status can be polled from any worker, and they're run by this worker once
+        the file's earlier jobs are. Jobs of a file which are queued by the time it's free are applied together.
+        """
+        worker = cls._worker()
+        jobs = [
+            ApplyJob(file_id=t.file_id, transaction_id=t.id, status=JobStatus.QUEUED, worker=worker)
+            for t in transactions
+        ]
+        session.add_all(jobs)
+        session.commit()
+        cls._queue([(job.file_id, job.id) for job in jobs])
+        if not Config.APPLY_ASYNC:
+            for job in jobs:
+                session.refresh(job)
+        return [cls._job_to_dict(job) for job in jobs]
+
+    @classmethod
+    def release(cls, pid: int = None) -> int:
+        """
+        Put back the jobs left queued or running by a worker process of this host which exited, or by any of them
+        when the server starts, so the next worker to start picks them up. The changes of a job are committed with
+        its status, so a job left running never applied them. Run by the gunicorn master.
+        """
+        host = socket.gethostname()
+        session = db.get_session()
+        try:
+            query = session.query(ApplyJob).filter(ApplyJob.status.in_([JobStatus.QUEUED, JobStatus.RUNNING]))
+            if pid is None:
+                query = query.filter(ApplyJob.worker.like(f'{host}:%'))
+            else:
+                query = query.filter(ApplyJob.worker == f'{host}:{pid}')
+            released = query.update(
+                {ApplyJob.status: JobStatus.QUEUED, ApplyJob.worker: None, ApplyJob.started_at: None},
+                synchronize_session=False
+            )
+            session.commit()
+        finally:
+            session.close()
+            db.engine.dispose()  # so forked workers don't share the master's connections
+        if released:
+            logger.warning(f'Released {released} apply job(s) of exited worker(s) to be queued again')
+        return released
+
+    @classmethod
+    def resume(cls) -> int:
+        """Claim the released jobs and queue them in this worker, in the order they were created"""
+        worker = cls._worker()
+        session = db.get_session()
+        try:
+            session.query(ApplyJob).filter(ApplyJob.status == JobStatus.QUEUED, ApplyJob.worker.is_(None)).update(
+                {ApplyJob.worker: worker}, synchronize_session=False
+            )
+            session.commit()
+            jobs = (
+                session.query(ApplyJob.file_id, ApplyJob.id)
+                .filter_by(status=JobStatus.QUEUED, worker=worker)
+                .order_by(ApplyJob.created_at)
+                .all()
+            )
+        finally:
+            session.close()
+        cls._queue(jobs)
+        return len(jobs)
+
+    @staticmethod
+    def _worker() -> str:
+        return f'{socket.gethostname()}:{os.getpid()}'
+
+    @classmethod
+    def _queue(cls, jobs: List[tuple]):
+        """Queue (file id, job id) pairs, or run them straight away if not applying in the background"""
+        for file_id in dict.fromkeys(file_id for file_id, _ in jobs):
+            job_ids = [job_id for job_file_id, job_id in jobs if job_file_id == file_id]
+            if Config.APPLY_ASYNC:
+                apply_queue.put_all(file_id, job_ids)
+            else:
+                cls._run(file_id, job_ids)
+
+    @classmethod
+    def _run(cls, file_id: str, job_ids: List[str]):
+        """
+        Apply the changes of queued jobs of a file in a single rewrite of it, on a session of their own as outside
+        of the request. If that fails they're applied one at a time, so only the jobs which can't be applied fail.
+        """
+        session = db.get_session()
+        token = db_session.set(session)
+        try:
+            jobs = [job for job in (session.get(ApplyJob, job_id) for job_id in job_ids) if job]
+            if not jobs:
+                return  # the transactions or file were deleted while queued
+            for job in jobs:
+                job.status = JobStatus.RUNNING
+                job.started_at = datetime.now()
+            session.commit()
+            if not cls._apply(session, jobs):
+                for job in jobs:
+                    cls._apply(session, [job])
+        finally:
+            db_session.reset(token)
+            session.close()
+
+    @classmethod
+    def _apply(cls, session: Session, jobs: List[ApplyJob]) -> bool:
+        """Apply jobs together, returning False if more than one failed together, otherwise they're finished"""
+        try:
+            cls._apply_changes(session, jobs)
+            return True
+        except Exception as e:
+            session.rollback()
+            if len(jobs) > 1:
+                logger.warning(f'Unable to apply {len(jobs)} transactions together, applying each', exc_info=True)
+                return False
+            job = jobs[0]
+            logger.exception(f'Unable to apply changes in transaction {job.transaction_id}')
+            job.status = JobStatus.FAILED
+            job.error = f'unable to apply changes in transaction {job.transaction_id}: {e}'
+            job.finished_at = datetime.now()
+            session.commit()
+            return True
+
+    @classmethod
+    def _apply_changes(cls, session: Session, jobs: List[ApplyJob]):
+        """
+        Apply the changes of jobs to the latest version of their file, and commit the jobs as done with it.
+        The file row is locked first, so workers apply changes to a file one at a time, and the update of it
+        only matches the version loaded, so if another worker changed it first, e.g. with sqlite which has no row
+        locks, the changes are applied again to the version it saved.
+        """
+        for attempt in range(1, APPLY_ATTEMPTS + 1):
+            file = session.query(File).filter_by(id=jobs[0].file_id).with_for_update().populate_existing().one()
+            change_sets = [job.transaction.changes for job in jobs]
+            for job in jobs:
+                job.status = JobStatus.DONE
+                job.finished_at = datetime.now()
+            try:
+                FileDataService.apply_changes(file, *change_sets)
+                return
+            except StaleDataError:
+                session.rollback()
+                if attempt == APPLY_ATTEMPTS:
+                    raise
+                logger.info(f'File {file.id!r} changed while applying changes, applying them to the new version')
+
+    @classmethod
+    def _job_to_dict(cls, job: ApplyJob) -> dict:
+        return {
+            'id': job.id,
+            'fileId': job.file_id,
+            'transactionId': job.transaction_id,
+            'status': job.status.name,
+            'error': job.error,
+            'createdAt': job.created_at,
+            'startedAt': job.started_at,
+            'finishedAt': job.finished_at
+        }
+
+
+apply_queue = KeyedQueue(ApplyJobService._run, max_workers=Config.APPLY_WORKERS, name='apply-changes')
@@ -1,79 +1,408 @@
-import io
+import json
 import logging
 import os
 import tempfile
-from copy import copy
+from array import array
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from typing import List
+from typing import List, Iterator, Sequence
 
 from openpyxl import load_workbook, Workbook
-from openpyxl.cell import ReadOnlyCell
 from openpyxl.formula.translate import Translator
+from openpyxl.utils import get_column_letter
 from openpyxl.worksheet.worksheet import Worksheet
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
 
 from config import Config
 from constants import DATE_FORMAT, DATE_STYLE
 from context import db_session
-from database.models import File, Change
+from database import db
+from database.models import File, Change, Snapshot
 from decorators import enforce_permission
 from enums import ChangeType
+from error import BadRequestError, NotAcceptableError
+from services.versions import VersionService
 from util.LRU import LRUCache
+from util.shared_cache import SharedLRUCache, SharedStore
+from util.arrow import pyarrow, to_arrow_stream
+from util.buffers import as_file
+from util.compression import compress, gzip_stream
+from util.formulas import evaluate_formulas, write_cached_values, FormulaError
+from util.filters import filter_rows, filter_key, FilterError
+from util.sorting import column_ranks, sort_rows
+from util.snapshot import FileSnapshot, SnapshotBuilder, SnapshotError, dump_snapshot, load_snapshot
 from util.subprocess import open_close_excel
+from util.xlsx_patch import SheetPatch, XlsxPatchError
+from util.xlsx_reader import XlsxReader, XlsxReaderError
 
 logger = logging.getLogger(__name__)
-file_cache = LRUCache(maxsize=Config.FILE_CACHE_SIZE)
+file_cache_options = dict(
+    maxsize=Config.FILE_CACHE_SIZE,
+    maxbytes=Config.FILE_CACHE_MAX_MB * 1024 * 1024,
+    sizeof=lambda snapshot: snapshot.nbytes
+)
+if Config.SHARED_CACHE_PATH:
+    file_cache = SharedLRUCache(
+        SharedStore(Config.SHARED_CACHE_PATH, max_bytes=Config.SHARED_CACHE_MAX_MB * 1024 * 1024), **file_cache_options
+    )
+else:
+    file_cache = LRUCache(**file_cache_options)
+cache_rebuilder = ThreadPoolExecutor(max_workers=1, thread_name_prefix='cache-rebuild')
 
 
 class FileDataService:
 
     @classmethod
-    @file_cache
     @enforce_permission(file_id_key='id_', required_roles=['*'])
-    def get_data(cls, id_: str) -> dict:
+    def get_encoded_data(cls, id_: str, encoding: str = None, version: int = None, **kwargs) -> bytes:
+        """
+        Get the column definitions and row data of a file as JSON, compressed with the content encoding if given.
+        The rows are selected by the keyword arguments of _get_data. If a past version is given, its data is rebuilt
+        from the file's version log. The JSON and each compressed variant of it are cached with the snapshot, so a
+        repeat request is a copy.
+        """
+        snapshot = cls._get_snapshot(id_, version)
+        key = json.dumps(kwargs, sort_keys=True)
+        body = snapshot.memoize(
+            'json', key,
+            lambda: json.dumps(cls._get_data(snapshot, id_, **kwargs), separators=(',', ':')).encode('utf-8'),
+            maxsize=Config.FILE_BLOCK_CACHE_SIZE
+        )
+        if encoding:
+            body = snapshot.memoize(
+                f'json-{encoding}', key, lambda: compress(body, encoding), maxsize=Config.FILE_BLOCK_CACHE_SIZE
+            )
+        file_cache.resize(id_=id_)
+        return body
+
+    @classmethod
+    @enforce_permission(file_id_key='id_', required_roles=['*'])
+    def get_arrow_data(cls, id_: str, version: int = None, **kwargs) -> bytes:
+        """
+        Get the rows selected as get_encoded_data does as an Arrow IPC stream, built from the snapshot columns
+        rather than row dicts, and cached with the snapshot. Requires the optional pyarrow package.
+        """
+        if not pyarrow:
+            raise NotAcceptableError('Arrow format is not available, pyarrow is not installed')
+        snapshot = cls._get_snapshot(id_, version)
+
+        def encode():
+            indexes, start_row, end_row, _ = cls._select_rows(snapshot, id_, **kwargs)
+            return to_arrow_stream(snapshot, indexes, start_row, end_row)
+
+        body = snapshot.memoize(
+            'arrow', json.dumps(kwargs, sort_keys=True), encode, maxsize=Config.FILE_BLOCK_CACHE_SIZE
+        )
+        file_cache.resize(id_=id_)
+        return body
+
+    @classmethod
+    @enforce_permission(file_id_key='id_', required_roles=['*'])
+    def stream_data(
+        cls, id_: str, gzip: bool = False, compact: bool = False, version: int = None, **kwargs
+    ) -> Iterator[bytes]:
+        """
+        Get the same JSON as get_encoded_data, but as chunks of encoded rows which are rendered as they are sent,
+        so memory use is bounded by the chunk size and the column definitions go out before any rows are rendered.
+        The rows are selected before streaming begins, so any errors are raised by this rather than mid-response.
+        """
+        snapshot = cls._get_snapshot(id_, version)
+        indexes, start_row, end_row, row_count = cls._select_rows(snapshot, id_, **kwargs)
+        file_cache.resize(id_=id_)  # the sort order may have been memoized
+        end_row = min(end_row, row_count)
+        head = {'columnDefs': cls._get_column_definitions(snapshot)}
+        if compact:
+            head['fields'] = snapshot.fields
+        row_count = row_count if cls._is_paged(**kwargs) else None
+        chunks = cls._stream_json(snapshot, head, indexes, start_row, end_row, row_count, compact)
+        return gzip_stream(chunks) if gzip else chunks
+
+    @classmethod
+    def _stream_json(
+        cls, snapshot: FileSnapshot, head: dict, indexes: array, start_row: int, end_row: int, row_count: int,
+        compact: bool
+    ) -> Iterator[bytes]:
+        encoder = json.JSONEncoder(separators=(',', ':'))
+        yield (encoder.encode(head)[:-1] + ',"rowData":[').encode('utf-8')
+        chunk_size = Config.STREAM_CHUNK_ROWS
+        for chunk_start in range(start_row, end_row, chunk_size):
+            chunk_end = min(chunk_start + chunk_size, end_row)
+            if indexes is None:
+                rows = snapshot.rows(chunk_start, chunk_end, compact=compact)
+            else:
+                rows = snapshot.rows_at(indexes[chunk_start:chunk_end], compact=compact)
+            separator = ',' if chunk_start > start_row else ''
+            yield (separator + encoder.encode(rows)[1:-1]).encode('utf-8')
+        yield (']}' if row_count is None else f'],"rowCount":{row_count}}}').encode('utf-8')
+
+    @classmethod
+    def _get_data(
+        cls, snapshot: FileSnapshot, id_: str, start_row: int = None, end_row: int = None, view_id: str = None,
+        sort_model: List[dict] = None, compact: bool = False
+    ) -> dict:
+        """
+        Get the column definitions and row data of a snapshot. If a view is given, only the rows matching its filters
+        are returned. If an ag-grid sort model is given, rows are returned in that order. If a start or end row is
+        given, only that block of the rows is returned. The total row count is included unless the whole sheet is
+        requested, for the ag-grid infinite/server-side row models.
+        If compact, the fields are listed once and each row is a list of values in that order, rather than a dict
+        repeating the headers.
+        """
+        data = {'columnDefs': cls._get_column_definitions(snapshot)}
+        if compact:
+            data['fields'] = snapshot.fields
+        if not cls._is_paged(start_row, end_row, view_id, sort_model):
+            data['rowData'] = snapshot.rows(compact=compact)
+            return data
+
+        indexes, start_row, end_row, row_count = cls._select_rows(
+            snapshot, id_, start_row, end_row, view_id, sort_model
+        )
+        if indexes is None:
+            data['rowData'] = snapshot.rows(start_row, end_row, compact=compact)
+        else:
+            data['rowData'] = snapshot.rows_at(indexes[start_row:end_row], compact=compact)
+        data['rowCount'] = row_count
+        return data
+
+    @staticmethod
+    def _is_paged(start_row: int = None, end_row: int = None, view_id: str = None, sort_model: List[dict] = None):
+        """Whether rows are requested for the ag-grid infinite/server-side row models, which need the row count"""
+        return not (start_row is None and end_row is None and view_id is None and not sort_model)
+
+    @classmethod
+    def _select_rows(
+        cls, snapshot: FileSnapshot, id_: str, start_row: int = None, end_row: int = None, view_id: str = None,
+        sort_model: List[dict] = None
+    ) -> (array, int, int, int):
+        """
+        Get the indexes of the rows matching the view's filters in sort order, or None for all rows in sheet
+        order, along with the start and end row of the block requested and the number of rows to page through.
+        """
+        filters_key, indexes = cls._filter_rows(snapshot, id_, view_id) if view_id else (None, None)
+        if sort_model:
+            sort_key = cls._get_sort_key(snapshot, sort_model)
+            if indexes is None:
+                indexes = cls._sort_rows(snapshot, sort_key)  # which memoizes the order of all rows itself
+            else:
+                filtered = indexes
+                indexes = snapshot.memoize(
+                    'order', (filters_key, sort_key),
+                    lambda: cls._sort_rows(snapshot, sort_key, filtered),
+                    maxsize=Config.FILE_BLOCK_CACHE_SIZE
+                )
+
+        row_count = snapshot.row_count if indexes is None else len(indexes)
+        start_row = start_row or 0
+        end_row = row_count if end_row is None else end_row
+        if end_row < start_row:
+            raise BadRequestError(f'Invalid row range {start_row!r} to {end_row!r}')
+        return indexes, start_row, end_row, row_count
+
+    @classmethod
+    def _filter_rows(cls, snapshot: FileSnapshot, file_id: str, view_id: str) -> (str, array):
+        """Get the indexes of the rows matching a view's filters, which are cached with the snapshot"""
+        from services import ViewService
+        view = ViewService.get(id_=view_id)
+        if view['fileId'] != file_id:
+            raise BadRequestError(f'View {view_id!r} does not belong to file {file_id!r}')
+
+        key = filter_key(view['filters'])
+        try:
+            indexes = snapshot.memoize(
+                'filter', key, lambda: filter_rows(snapshot, view['filters']), maxsize=Config.FILE_BLOCK_CACHE_SIZE
+            )
+        except FilterError as e:
+            raise BadRequestError(f'Unable to apply filters of view {view_id!r}: {e}')
+        return key, indexes
+
+    @classmethod
+    def _get_sort_key(cls, snapshot: FileSnapshot, sort_model: List[dict]) -> tuple:
+        """Resolve an ag-grid sort model, where colId is the column letter or field, to (column index, descending)"""
+        sort_key = []
+        for sort in sort_model:
+            col_id = sort.get('colId')
+            if col_id in snapshot.column_letters:
+                col_index = snapshot.column_letters.index(col_id)
+            elif col_id in snapshot.headers:
+                col_index = snapshot.headers.index(col_id)
+            else:
+                raise BadRequestError(f'Sort column {col_id!r} not found in file')
+            if sort.get('sort') not in ['asc', 'desc']:
+                raise BadRequestError(f'Sort direction must be asc or desc but got {sort.get("sort")!r}')
+            sort_key.append((col_index, sort['sort'] == 'desc'))
+        return tuple(sort_key)
+
+    @classmethod
+    def _sort_rows(cls, snapshot: FileSnapshot, sort_key: tuple, indexes: array = None) -> array:
+        """
+        Order the rows, or just the given row indexes, by the sort key. The per-column ranks and the permutation of
+        all rows for each sort key are built lazily and cached with the snapshot.
+        """
+        ranks = [
+            (
+                snapshot.memoize(
+                    'ranks', col_index, lambda: column_ranks(snapshot, col_index), maxsize=len(snapshot.columns)
+                ),
+                descending
+            )
+            for col_index, descending in sort_key
+        ]
+        order = snapshot.memoize(
+            'order', (None, sort_key), lambda: sort_rows(ranks, snapshot.row_count),
+            maxsize=Config.FILE_BLOCK_CACHE_SIZE
+        )
+        if indexes is None:
+            return order
+
+        included = bytearray(snapshot.row_count)
+        for i in indexes:
+            included[i] = 1
+        return array('I', [i for i in order if included[i]])
+
+    @classmethod
+    @file_cache
+    def get_snapshot(cls, id_: str) -> FileSnapshot:
+        """
+        Get a columnar snapshot of the file's data rows, which is what the file cache holds. The snapshot persisted
+        for the file's version is loaded if there is one, otherwise the workbook is parsed and the snapshot saved.
+        """
         from services import FileService
         file = FileService.get(id_=id_, internal=True)
+        session = db_session.get()
+        record = session.query(Snapshot).filter_by(file_id=id_, version=file.version).one_or_none()
+        if record:
+            try:
+                snapshot = load_snapshot(record.data)
+                snapshot.version = file.version
+                return snapshot
+            except SnapshotError:
+                logger.warning(f'Unable to load saved snapshot of file {id_!r}, reparsing', exc_info=True)
+
+        snapshot = cls._read_snapshot(id_, file.blob, file.data_types)
+        snapshot.version = file.version
+        cls._persist_snapshot(id_, snapshot)
+        return snapshot
 
-        wb = cls._load_workbook(file.blob, read_only=True, data_only=True)
-        ws = wb.active  # only get single (first) worksheet for now
-        cells: List[List[ReadOnlyCell]] = list(ws.rows)[:]
-        data_types = file.data_types
-
-        row_data = []
-        for row_number, row_cells in enumerate(cells[1:]):
-            row = {'_rowNumber': row_number + 1}
-            for i, hc in enumerate(cells[0]):
-                if data_types[hc.value] == 'd':
-                    try:
-                        cell_value = row_cells[i].value.strftime(DATE_FORMAT)
-                    except AttributeError:
-                        cell_value = row_cells[i].value
-                else:
-                    cell_value = row_cells[i].value
+    @classmethod
+    def _get_snapshot(cls, id_: str, version: int = None) -> FileSnapshot:
+        """The cached snapshot of the file, or of a past version of it"""
+        if version is None or version == cls.get_version(id_=id_):
+            return cls.get_snapshot(id_=id_)
+        return VersionService.get_snapshot(id_=id_, version=version)
+
+    @classmethod
+    def _persist_snapshot(cls, id_: str, snapshot: FileSnapshot, checkpoint: bool = False):
+        """
+        Save a snapshot, and a checkpoint of its version if due, with a session of its own so that reading file data
+        never commits the request's session. A snapshot which isn't saved is only reparsed later, so failures are
+        logged rather than raised, including from the cache rebuild thread where they would otherwise be lost.
+        """
+        session = db.get_session()
+        try:
+            cls.save_snapshot(session, id_, snapshot)
+            if checkpoint:
+                VersionService.add_checkpoint(session, id_, snapshot)
+        except Exception:
+            session.rollback()
+            logger.exception(f'Unable to save snapshot of file {id_!r}')
+        finally:
+            session.close()
 
-                row[hc.value] = cell_value if cell_value is not None else ''
+    @classmethod
+    def _complete_delta(cls, id_: str, previous: FileSnapshot, snapshot: FileSnapshot):
+        """Log the formula results that changed with a session of its own, as _persist_snapshot saves snapshots"""
+        session = db.get_session()
+        try:
+            VersionService.complete_delta(session, id_, previous, snapshot)
+        except Exception:
+            session.rollback()
+            logger.exception(f'Unable to log the formula changes of version {snapshot.version} of file {id_!r}')
+        finally:
+            session.close()
 
-            row_data.append(row)
+    @classmethod
+    def save_snapshot(cls, session: Session, file_id: str, snapshot: FileSnapshot):
+        """Persist the snapshot of a file, unless a snapshot of a later version has already been saved"""
+        data = dump_snapshot(snapshot)
+        try:
+            updated = (
+                session.query(Snapshot)
+                .filter(Snapshot.file_id == file_id, Snapshot.version <= snapshot.version)
+                .update({'version': snapshot.version, 'data': data})
+            )
+            if not updated and not session.query(Snapshot.id).filter_by(file_id=file_id).scalar():
+                session.add(Snapshot(file_id=file_id, version=snapshot.version, data=data))
+            session.commit()
+        except IntegrityError:
+            session.rollback()  # saved concurrently by another worker
 
-        cls._remove_trailing_empty_rows(row_data)
+    @classmethod
+    @enforce_permission(file_id_key='id_', required_roles=['*'])
+    def get_version(cls, id_: str) -> int:
+        """
+        Version of the file data that get_encoded_data would return. While a cached snapshot is being rebuilt after
+        changes, that is the version of the cached snapshot, which can be older than the file's.
+        """
+        from services import FileService
+        snapshot = file_cache.peek(id_=id_)
+        return snapshot.version if snapshot else FileService.get_version(id_=id_)
 
-        return {
-            'columnDefs': cls._get_column_definitions(cells, file.data_types),
-            'rowData': row_data
-        }
+    @classmethod
+    def _read_snapshot(cls, id_: str, file_bytes: bytes, data_types: dict) -> FileSnapshot:
+        try:
+            return cls._build_snapshot(XlsxReader(file_bytes).iter_rows(), data_types)
+        except XlsxReaderError:
+            logger.warning(f'Unable to read file {id_!r} with xlsx reader, falling back to openpyxl', exc_info=True)
+
+        wb = cls._load_workbook(file_bytes, read_only=True, data_only=True)
+        ws = wb.active  # only get single (first) worksheet for now
+        return cls._build_snapshot(ws.values, data_types)
 
     @classmethod
-    def _remove_trailing_empty_rows(cls, row_data: List[dict]):
-        """Trailing empty rows cause problems when the cells have styles so ignore them"""
-        while True:
-            last_row_data = copy(row_data[-1])
-            del last_row_data['_rowNumber']
-            if all(value == '' for value in last_row_data.values()):
-                row_data.pop()
-                continue
-            break
+    def _refresh_cache(
+        cls, id_: str, file_bytes: bytes, data_types: dict, version: int, previous: FileSnapshot = None
+    ):
+        """
+        Rebuild the cached snapshot of a file after its blob has changed. Readers keep getting the old snapshot until
+        the new one replaces it, unless the entry was replaced or removed again in the meantime. If the snapshot of
+        the previous version is given, the version's pending delta is completed from the two.
+        """
+        generation = file_cache.generation(id_=id_)
+
+        def rebuild():
+            try:
+                snapshot = cls._read_snapshot(id_, file_bytes, data_types)
+                snapshot.version = version
+            except Exception:
+                logger.exception(f'Unable to rebuild cached data of file {id_!r}')
+                file_cache.remove(generation=generation, id_=id_)  # unless a newer value has replaced it since
+                return
+            if previous:
+                cls._complete_delta(id_, previous, snapshot)
+            if file_cache.replace(snapshot, generation=generation, id_=id_):
+                logger.info(f'Rebuilt cached data of file {id_!r}')
+            cls._persist_snapshot(id_, snapshot, checkpoint=VersionService.is_checkpoint_due(version))
+
+        if Config.CACHE_REBUILD_ASYNC:
+            cache_rebuilder.submit(rebuild)
+        else:
+            rebuild()
 
     @classmethod
-    def _get_column_definitions(cls, cells, data_types: dict) -> List[dict]:
+    def _build_snapshot(cls, rows: Iterator[Sequence], data_types: dict) -> FileSnapshot:
+        """Build a snapshot from rows of cell values, where the first row is the header row"""
+        rows = iter(rows)
+        headers = next(rows)
+        builder = SnapshotBuilder(headers, [get_column_letter(i + 1) for i in range(len(headers))])
+        for row in rows:
+            builder.append(row)
+
+        return builder.build(data_types)
+
+    @classmethod
+    def _get_column_definitions(cls, snapshot: FileSnapshot) -> List[dict]:
         """Get ag-grid column properties based on openpyxl data_types"""
 
         data_type_props = {
@@ -85,15 +414,54 @@ class FileDataService:
         }
 
         column_definitions = []
-        for hc in cells[0]:
-            data_type = data_types[hc.value]
-            column_def = {'field': hc.value, 'colId': hc.column_letter, **data_type_props[data_type]}
+        for header, column_letter in zip(snapshot.headers, snapshot.column_letters):
+            data_type = snapshot.data_types[header]
+            column_def = {'field': header, 'colId': column_letter, **data_type_props[data_type]}
             if data_type in ['e', 'f']:
                 column_def['headerName'] = column_def['field'] + '*'
             column_definitions.append(column_def)
 
         return column_definitions
 
+    @classmethod
+    def ingest(cls, file_bytes: bytes) -> (dict, FileSnapshot):
+        """
+        Read an uploaded file in a single pass, inferring the column data types while building the snapshot,
+        so the snapshot can be cached straight away. Data types are inferred as in get_data_types.
+        """
+        try:
+            rows = XlsxReader(file_bytes).iter_rows(with_types=True)
+            headers, _ = next(rows)
+            builder = SnapshotBuilder(headers, [get_column_letter(i + 1) for i in range(len(headers))])
+            data_types = [None] * len(headers)
+            first_row = True
+            for values, types in rows:
+                builder.append(values)
+                for col_index, data_type in enumerate(data_types):
+                    if data_type is not None or col_index >= len(values):
+                        continue
+                    # a formula cell has a value when loaded with data_only=False, even if it has no cached value
+                    populated = types[col_index] == 'f' or (
+                        bool(values[col_index]) if first_row else values[col_index] is not None
+                    )
+                    if populated:
+                        data_types[col_index] = types[col_index]
+                first_row = False
+
+            # default to 'n' as openpyxl does, in case entire column is empty
+            data_types = {h: dt or 'n' for h, dt in zip(headers, data_types)}
+            snapshot = builder.build(data_types)
+        except XlsxReaderError:
+            logger.warning('Unable to ingest file with xlsx reader, falling back to openpyxl', exc_info=True)
+            data_types = cls.get_data_types(file_bytes)
+            wb = cls._load_workbook(file_bytes, read_only=True, data_only=True)
+            snapshot = cls._build_snapshot(wb.active.values, data_types)
+
+        logger.info(f'Ingested file with {snapshot.row_count} rows')
+        if logger.isEnabledFor(logging.DEBUG):
+            logger.debug(f'Ingested file column stats: {snapshot.column_stats}')
+        return data_types, snapshot
+
     @classmethod
     def get_data_types(cls, file_bytes: bytes) -> dict:
         """Return dictionary of column header to data type, based on the first populated row for each column."""
@@ -116,53 +484,94 @@ class FileDataService:
         return {hc.value: dt for hc, dt in zip(cells[0], data_types)}
 
     @classmethod
-    def apply_changes(cls, file: File, changes: List[Change]) -> bool:
+    def apply_changes(cls, file: File, *change_sets: List[Change]) -> bool:
         """
-        Apply transaction changes to the actual saved excel file.
-        Changes are applied in reverse row number order, so creates and deletes don't affect subsequent changes.
-        TODO - Other pending transactions will still be affected and need a solution.
+        Apply the changes of one or more transactions to the actual saved excel file, in a single rewrite of it.
+        The sheet xml is patched where possible, otherwise the whole workbook is loaded and saved by openpyxl.
         """
         logger.info('Apply changes to workbook - begin')
-        wb = cls._load_workbook(file.blob, read_only=False, data_only=False)
-        ws = wb.active  # only get single (first) worksheet for now
-
-        # take a snapshot of row2 values for use in formula translation
-        value_lookup = {cell.coordinate: cell.value for cell in list(ws[2])}
-
-        changes.sort(key=lambda x: x.row_number, reverse=True)
-        for change in changes:
-            if change.change_type == ChangeType.CREATE:
-                cls._handle_create(ws, change, file.data_types)
-            elif change.change_type == ChangeType.UPDATE:
-                cls._handle_update(ws, change)
-            else:
-                cls._handle_delete(ws, change)
-
-        cls._regenerate_formulas(ws, file.data_types, value_lookup)
+        try:
+            ws = SheetPatch(file.blob)
+            operations = cls._apply_to_sheet(ws, file.data_types, change_sets)
+            file_bytes = ws.save()
+            logger.info('Patched workbook')
+        except XlsxPatchError as e:
+            logger.info(f'Unable to patch workbook, rewriting it instead: {e}')
+            wb = cls._load_workbook(file.blob, read_only=False, data_only=False)
+            operations = cls._apply_to_sheet(wb.active, file.data_types, change_sets)  # only the first worksheet
+            file_bytes = cls._convert_to_bytes(wb, file.name)
+            logger.info('Converted workbook to bytes')
 
         session = db_session.get()
-        file_bytes = cls._convert_to_bytes(wb, file.name)
-        logger.info('Converted workbook to bytes')
+        previous = None
+        if any(data_type in ['e', 'f'] for data_type in file.data_types.values()):
+            # the results of formulas in any row may have changed, which are logged with the row changes once the
+            # cache rebuild has parsed the new version
+            previous = cls._current_snapshot(session, file)
         file.blob = file_bytes
+        file.version += 1
+        VersionService.add_delta(session, file.id, file.version, operations, pending=previous is not None)
         session.commit()
-        file_cache.remove(id_=file.id)  # remove old version of file data from cache
+        # the old version is served from the cache until it is rebuilt
+        cls._refresh_cache(file.id, file_bytes, file.data_types, file.version, previous)
         logger.info('Apply changes to workbook - complete')
         return True
 
+    @classmethod
+    def _current_snapshot(cls, session: Session, file: File) -> FileSnapshot:
+        """The snapshot of the file's version, from the cache or where it was saved if possible, without caching it"""
+        snapshot = file_cache.peek(id_=file.id)
+        if snapshot and snapshot.version == file.version:
+            return snapshot
+        record = session.query(Snapshot).filter_by(file_id=file.id, version=file.version).one_or_none()
+        if record:
+            try:
+                return load_snapshot(record.data)
+            except SnapshotError:
+                logger.warning(f'Unable to load saved snapshot of file {file.id!r}, reparsing', exc_info=True)
+        return cls._read_snapshot(file.id, file.blob, file.data_types)
+
+    @classmethod
+    def _apply_to_sheet(cls, ws: Worksheet or SheetPatch, data_types: dict, change_sets: tuple) -> List[list]:
+        """
+        Apply the changes of transactions in the order given, so each applies to the rows as the previous left them.
+        Changes of a transaction are applied in reverse row number order, so creates and deletes don't affect
+        subsequent changes. Returns the row changes as made, for the version log.
+        TODO - Other pending transactions will still be affected and need a solution.
+        """
+        # take a snapshot of row2 values for use in formula translation
+        value_lookup = {cell.coordinate: cell.value for cell in list(ws[2])}
+
+        operations = []
+        for changes in change_sets:
+            for change in sorted(changes, key=lambda x: x.row_number, reverse=True):
+                if change.change_type == ChangeType.CREATE:
+                    operation = cls._handle_create(ws, change, data_types)
+                elif change.change_type == ChangeType.UPDATE:
+                    operation = cls._handle_update(ws, change)
+                else:
+                    operation = cls._handle_delete(ws, change)
+                if operation:
+                    operations.append(operation)
+
+        cls._regenerate_formulas(ws, data_types, value_lookup)
+        return operations
+
     @classmethod
     def _load_workbook(cls, file_bytes: bytes, read_only: bool, data_only: bool) -> Workbook:
         """Load workbook in read/write mode for updating contents or getting data types"""
-        virtual_file = io.BytesIO(file_bytes)
+        virtual_file = as_file(file_bytes)
         wb = load_workbook(virtual_file, read_only=read_only, data_only=data_only)
         return wb
 
     @classmethod
-    def _handle_create(cls, ws: Worksheet, change: Change, data_types: dict):
+    def _handle_create(cls, ws: Worksheet, change: Change, data_types: dict) -> list:
         """Add a new row to the end of a spreadsheet"""
         logger.info('Create new row - begin')
         new_row_number = ws.max_row + 1
         new_row_data = change.after
         header_cells = list(ws[1])
+        values = [None] * len(header_cells)
 
         for hc in header_cells:
             if hc.value not in new_row_data:
@@ -180,26 +589,22 @@ class FileDataService:
             elif data_type == 'd':
                 new_cell.value = datetime.strptime(new_value_str, DATE_FORMAT)
                 new_cell.number_format = DATE_STYLE
+                values[hc.column - 1] = new_value_str
             elif data_type == 'n':
-                if new_value_str.isdigit():
-                    new_value = int(new_value_str)
-                else:
-                    try:
-                        new_value = float(new_value_str)
-                    except ValueError:
-                        new_value = new_value_str
-                new_cell.value = new_value
+                new_cell.value = values[hc.column - 1] = cls._parse_number(new_value_str)
             else:
-                new_cell.value = new_value_str
+                new_cell.value = values[hc.column - 1] = new_value_str
         logger.info('Create new row - complete')
+        return [VersionService.CREATE, new_row_number - 2, values]
 
     @classmethod
-    def _handle_delete(cls, ws: Worksheet, change: Change):
+    def _handle_delete(cls, ws: Worksheet, change: Change) -> list or None:
         """
         Delete row specified by change row_number, if data matches change before value
         If data does not match, iterate backwards to find a matching row to delete.
         TODO - Row insertions not supported yet, but logic would need to change to support those.
         """
+        operation = None
         logger.info('Delete row - begin')
         deletion_row_number = change.row_number + 1
         header_cells = list(ws[1])
@@ -207,15 +612,18 @@ class FileDataService:
 
         if cls._is_match(header_cells, row_cells, change.before):
             ws.delete_rows(deletion_row_number)
+            operation = [VersionService.DELETE, deletion_row_number - 2]
         else:
             logger.warning('Unable to delete row as it is not as expected')
             for alt_deletion_row_number in range(deletion_row_number-1, 2, -1):
                 row_cells = list(ws[alt_deletion_row_number])
                 if cls._is_match(header_cells, row_cells, change.before):
                     ws.delete_rows(alt_deletion_row_number)
+                    operation = [VersionService.DELETE, alt_deletion_row_number - 2]
                     logger.warning(f'Deleted row {alt_deletion_row_number} instead of {deletion_row_number}')
                     break
         logger.info('Delete row - complete')
+        return operation
 
     @classmethod
     def _is_match(cls, header_cells, row_cells, change_before) -> bool:
@@ -233,13 +641,14 @@ class FileDataService:
                 return False
         return True
 
-    @staticmethod
-    def _handle_update(ws: Worksheet, change: Change):
+    @classmethod
+    def _handle_update(cls, ws: Worksheet, change: Change) -> list:
         """Update an existing row in the spreadsheet"""
         logger.info('Update new row - begin')
         update_row_number = change.row_number + 1
         header_cells = list(ws[1])
         row_cells = list(ws[update_row_number])
+        values = [None] * len(header_cells)
 
         for hc, rc in zip(header_cells, row_cells):
             if hc.value not in change.before:
@@ -249,20 +658,25 @@ class FileDataService:
             if rc.data_type in ['e', 'f']:
                 continue
             elif rc.data_type == 'n':
-                if updated_value_str.isdigit():
-                    updated_value = int(updated_value_str)
-                else:
-                    try:
-                        updated_value = float(updated_value_str)
-                    except ValueError:
-                        updated_value = updated_value_str
-                rc.value = updated_value
+                rc.value = values[hc.column - 1] = cls._parse_number(updated_value_str)
             elif rc.data_type == 'd':
                 rc.value = datetime.strptime(updated_value_str, DATE_FORMAT)
                 rc.number_format = DATE_STYLE
+                values[hc.column - 1] = updated_value_str
             else:
-                rc.value = updated_value_str
+                rc.value = values[hc.column - 1] = updated_value_str
         logger.info('Update new row - complete')
+        return [VersionService.UPDATE, update_row_number - 2, values]
+
+    @staticmethod
+    def _parse_number(value_str: str) -> int or float or str:
+        """Number cell value of a change, which is kept as text if it isn't a number"""
+        if value_str.isdigit():
+            return int(value_str)
+        try:
+            return float(value_str)
+        except ValueError:
+            return value_str
 
     @classmethod
     def _regenerate_formulas(cls, ws: Worksheet, data_types: dict, value_lookup: dict):
@@ -280,14 +694,24 @@ class FileDataService:
 
     @classmethod
     def _convert_to_bytes(cls, wb: Workbook, filename: str):
-        """Convert workbook to bytes for saving into database. Will attempt to open-close the excel to evaluate
-        the formulas and cache the results, which differs per OS and requires MS Excel or LibreOffice installation.
-        Future alternative could be to use a python library to evaluate all the formulas when data is being returned.
+        """Convert workbook to bytes for saving into database, with the results of its formulas cached in it.
+        The formulas are evaluated in Python where possible. Otherwise it will attempt to open-close the excel to
+        evaluate them, which differs per OS and requires MS Excel or LibreOffice installation.
         """
         logger.info('Converting workbook to bytes')
+        try:
+            values = evaluate_formulas(wb.active)
+        except FormulaError as e:
+            logger.info(f'Unable to evaluate formulas, recalculating with Excel/LibreOffice instead: {e}')
+            values = None
+
         with tempfile.TemporaryDirectory() as temp_dir:
             temp_path = os.path.join(temp_dir, f'temp-{filename}')
             wb.save(temp_path)
-            open_close_excel(temp_path)
+            if values is None:
+                open_close_excel(temp_path)
             with open(temp_path, 'rb') as temp_file:
-                return temp_file.read()
+                file_bytes = temp_file.read()
+        if values:
+            file_bytes = write_cached_values(file_bytes, wb.active.path.lstrip('/'), values, wb.epoch)
+        return file_bytes
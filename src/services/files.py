@@ -1,11 +1,18 @@
 import io
-from typing import List
+import os
+from typing import List, BinaryIO
 
+from sqlalchemy import func
+
+from config import Config
 from context import db_session, current_user_id
+from database.blob_reader import DatabaseBlobReader
 from database.models import File, Permission
 from decorators import enforce_permission
 from error import NotFoundError, BadRequestError
-from services.file_data import file_cache
+from services.file_data import FileDataService, file_cache
+from services.versions import VersionService
+from util.snapshot import FileSnapshot
 
 
 class FileService:
@@ -35,20 +42,36 @@ class FileService:
         return [cls._file_to_dict(f) for f in files]
 
     @classmethod
-    def create(cls, file_bytes: bytes, filename: str, content_type: str, data_types: dict) -> dict:
-        if any(f['name'] == filename for f in cls.list()):
+    def create(
+        cls, file_bytes: bytes, filename: str, content_type: str, data_types: dict, snapshot: FileSnapshot = None
+    ) -> dict:
+        session = db_session.get()
+        name_in_use = (
+            session.query(File.id)
+            .join(Permission, Permission.file_id == File.id)
+            .filter(Permission.user_id == current_user_id.get(), File.name == filename)
+            .first()
+        )
+        if name_in_use:
             raise BadRequestError(f'Filename {filename!r} already in use')
 
-        session = db_session.get()
         file = File(blob=file_bytes, name=filename, content_type=content_type, data_types=data_types)
         session.add(file)
         session.commit()
         session.refresh(file)
+        if snapshot:
+            snapshot.version = file.version
+            file_cache.replace(snapshot, id_=file.id)  # so the first read of the new file is a cache hit
+            FileDataService.save_snapshot(session, file.id, snapshot)
+            VersionService.add_checkpoint(session, file.id, snapshot)
         return cls._file_to_dict(file)
 
     @classmethod
     @enforce_permission(file_id_key='id_', required_roles=['OWNER'])
-    def update(cls, id_: str, file_bytes: bytes, filename: str, content_type: str, data_types: dict):
+    def update(
+        cls, id_: str, file_bytes: bytes, filename: str, content_type: str, data_types: dict,
+        snapshot: FileSnapshot = None
+    ):
         session = db_session.get()
         file = cls.get(id_=id_, internal=True)
 
@@ -60,12 +83,19 @@ class FileService:
         file.name = filename
         file.content_type = content_type
         file.data_types = data_types
+        file.version += 1
 
         for t in file.transactions:
             session.delete(t)
 
         session.commit()
-        file_cache.remove(id_=id_)  # remove old version of file data from cache
+        if snapshot:
+            snapshot.version = file.version
+            file_cache.replace(snapshot, id_=id_)  # replace old version of file data in cache
+            FileDataService.save_snapshot(session, id_, snapshot)
+            VersionService.add_checkpoint(session, id_, snapshot)  # the whole file changed, so can't be a delta
+        else:
+            file_cache.remove(id_=id_)  # remove old version of file data from cache
         return cls._file_to_dict(file)
 
     @classmethod
@@ -79,10 +109,38 @@ class FileService:
 
     @classmethod
     @enforce_permission(file_id_key='id_', required_roles=['*'])
-    def download(cls, id_: str) -> (bytes, str, str):
+    def get_version(cls, id_: str) -> int:
+        """Get the version of a file without loading it, for validating what a client or cache holds"""
+        session = db_session.get()
+        version = session.query(File.version).filter_by(id=id_).scalar()
+        if version is None:
+            raise NotFoundError(message=f'File {id_!r} not found')
+        return version
+
+    @classmethod
+    @enforce_permission(file_id_key='id_', required_roles=['*'])
+    def download(cls, id_: str) -> (str or BinaryIO, int, str, str, int):
+        """
+        The blob is returned as its path if it's in the blob store, otherwise as a reader of it in the database,
+        so it is sent in chunks, or only the range requested, rather than loaded whole. Either is of the version
+        returned with it, which a new blob in the store or the reader's queries can't change.
+        """
         file = cls.get(id_=id_, internal=True)
-        blob = io.BytesIO(file.blob)
-        return blob, file.name, file.content_type
+        size = cls._get_size(file)
+        blob = file.blob_path or io.BufferedReader(
+            DatabaseBlobReader(file.id, size, file.version), buffer_size=Config.DOWNLOAD_CHUNK_KB * 1024
+        )
+        return blob, size, file.name, file.content_type, file.version
+
+    @classmethod
+    def _get_size(cls, file: File) -> int:
+        """The size of the blob, which is read from it for files saved before sizes were, until they're backfilled"""
+        if file.size_bytes:
+            return file.size_bytes
+        if file.blob_key:
+            return os.path.getsize(file.blob_path)
+        session = db_session.get()
+        return session.query(func.length(File._blob)).filter_by(id=file.id).scalar() or 0
 
     @classmethod
     def _file_to_dict(cls, file: File):
@@ -90,7 +148,7 @@ class FileService:
             'id': file.id,
             'name': file.name,
             'content_type': file.content_type,
-            'size_bytes ': len(file.blob)
+            'size_bytes ': cls._get_size(file)
         }
 
     @classmethod
@@ -7,7 +7,7 @@ from database.models import Transaction, Change
 from decorators import enforce_permission
 from enums import ChangeType, ApprovalStatus, Role
 from error import NotFoundError, BadRequestError
-from services import FileDataService
+from services import ApplyJobService
 
 logger = logging.getLogger(__name__)
 
@@ -57,37 +57,63 @@ class TransactionService:
         session.commit()
         session.refresh(transaction)
 
+        result = cls._transaction_to_dict(transaction)
         if status == ApprovalStatus.AUTO_APPROVED:
-            try:
-                FileDataService.apply_changes(transaction.file, transaction.changes)
-            except Exception as e:
-                logger.exception(e)
-                raise BadRequestError(f'unable to apply changes in transaction {transaction.id}: {e}')
-
-        return cls._transaction_to_dict(transaction)
+            result['job'] = ApplyJobService.enqueue(session, transaction)
+        return result
 
     @classmethod
     @enforce_permission(file_id_key='file_id', required_roles=['OWNER'])
     def update(cls, id_: str, user_id: str, status: str, file_id: str, notes: str = None):
+        if ApprovalStatus[status] == ApprovalStatus.APPROVED:
+            return cls._approve([id_], user_id, file_id, notes)[0]
+
         session = db_session.get()
         transaction = cls.get(id_=id_, internal=True)
-
         transaction.status = ApprovalStatus[status]
-        if transaction.status == ApprovalStatus.APPROVED:
-            try:
-                FileDataService.apply_changes(transaction.file, transaction.changes)
-            except Exception as e:
-                logger.exception(e)
-                raise BadRequestError(f'unable to apply changes in transaction {id_}: {e}')
-
-            transaction.approver_id = user_id
-
         if notes:
             transaction.notes = notes
-
         session.commit()
         return cls._transaction_to_dict(transaction)
 
+    @classmethod
+    @enforce_permission(file_id_key='file_id', required_roles=['OWNER'])
+    def approve(cls, ids: List[str], user_id: str, file_id: str, notes: str = None) -> List[dict]:
+        """
+        Approve pending transactions of a file together, so their changes are applied in one rewrite of it,
+        in the order of the ids given
+        """
+        return cls._approve(ids, user_id, file_id, notes)
+
+    @classmethod
+    def _approve(cls, ids: List[str], user_id: str, file_id: str, notes: str = None) -> List[dict]:
+        """
+        Approve transactions of a file and queue applying them, for both a single and a bulk approval. Transactions
+        already approved are refused, as applying them again would repeat their changes.
+        """
+        session = db_session.get()
+        found = session.query(Transaction).filter(Transaction.id.in_(ids), Transaction.file_id == file_id).all()
+        missing = set(ids) - {t.id for t in found}
+        if missing:
+            raise NotFoundError(message=f'Transactions {sorted(missing)} not found')
+        transactions = sorted(found, key=lambda t: ids.index(t.id))
+        approved = [t.id for t in transactions if t.status in [ApprovalStatus.APPROVED, ApprovalStatus.AUTO_APPROVED]]
+        if approved:
+            raise BadRequestError(message=f'Transactions {approved} already approved')
+
+        approved_at = datetime.now()
+        for transaction in transactions:
+            transaction.status = ApprovalStatus.APPROVED
+            transaction.approver_id = user_id
+            transaction.approved_at = approved_at
+            if notes:
+                transaction.notes = notes
+        session.commit()
+        results = [cls._transaction_to_dict(t) for t in transactions]
+        for result, job in zip(results, ApplyJobService.enqueue_all(session, transactions)):
+            result['job'] = job
+        return results
+
     @classmethod
     def delete(cls, id_: str) -> bool:
         session = db_session.get()
@@ -0,0 +1,213 @@
+import json
+import logging
+import zlib
+from typing import List
+
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.orm import Session
+
+from config import Config
+from context import db_session
+from database.models import FileVersion
+from decorators import enforce_permission
+from error import NotFoundError
+from util.LRU import LRUCache
+from util.snapshot import BLANK, FileSnapshot, SnapshotBuilder, SnapshotError, dump_snapshot, load_snapshot
+
+logger = logging.getLogger(__name__)
+
+
+class VersionCache(LRUCache):
+    """Past versions never change, so entries are keyed by file and version and never need invalidating"""
+
+    @staticmethod
+    def _generate_key(*args, **kwargs):
+        return kwargs['id_'], kwargs['version']
+
+
+version_cache = VersionCache(maxsize=Config.VERSION_CACHE_SIZE)
+
+
+class VersionService:
+    # row change operations held in a delta, applied in order to the rows of the previous version
+    CREATE, UPDATE, DELETE = 'c', 'u', 'd'
+
+    @classmethod
+    @enforce_permission(file_id_key='file_id', required_roles=['*'])
+    def list(cls, file_id: str) -> List[dict]:
+        """The versions in the log of a file, oldest first, and which of them are checkpoints"""
+        session = db_session.get()
+        entries = (
+            session.query(FileVersion.version, FileVersion.checkpoint, FileVersion.created_at)
+            .filter_by(file_id=file_id)
+            .order_by(FileVersion.version, FileVersion.checkpoint)
+            .all()
+        )
+        versions = {}
+        for version, checkpoint, created_at in entries:
+            entry = versions.setdefault(version, {'version': version, 'checkpoint': False, 'createdAt': created_at})
+            entry['checkpoint'] = entry['checkpoint'] or checkpoint
+        return list(versions.values())
+
+    @classmethod
+    def add_checkpoint(cls, session: Session, file_id: str, snapshot: FileSnapshot):
+        """Save the full row data of a version, which later versions are replayed from"""
+        data = dump_snapshot(snapshot)
+        session.add(FileVersion(file_id=file_id, version=snapshot.version, checkpoint=True, data=data))
+        try:
+            session.commit()
+        except IntegrityError:
+            session.rollback()  # already saved, e.g. by another worker
+
+    @classmethod
+    def add_delta(cls, session: Session, file_id: str, version: int, operations: List[list], pending: bool = False):
+        """
+        Add the row changes from the previous version to the session, so they are committed with the new version.
+        Each operation is [CREATE, row index, values], [UPDATE, row index, values] or [DELETE, row index], where
+        values are in header order and None for a cell the update left as it was. Row indexes are of the worksheet,
+        which may have blank rows with styles after the last row of the data, that rows are created after. Updates
+        of the formula results that changed follow the row changes, see formula_changes. A pending delta is only
+        replayed once complete_delta has added them.
+        """
+        session.add(FileVersion(
+            file_id=file_id, version=version, checkpoint=False, data=cls._compress(operations), pending=pending
+        ))
+
+    @classmethod
+    def complete_delta(cls, session: Session, file_id: str, previous: FileSnapshot, snapshot: FileSnapshot):
+        """Add the updates of the formula results that changed to the pending delta of the snapshot's version"""
+        delta = (
+            session.query(FileVersion)
+            .filter_by(file_id=file_id, version=snapshot.version, checkpoint=False, pending=True)
+            .one_or_none()
+        )
+        if not delta:
+            return
+        operations = json.loads(zlib.decompress(delta.data))
+        delta.data = cls._compress(operations + cls.formula_changes(previous, snapshot, operations))
+        delta.pending = False
+        session.commit()
+
+    @classmethod
+    def is_checkpoint_due(cls, version: int) -> bool:
+        return version % Config.VERSION_CHECKPOINT_INTERVAL == 0
+
+    @classmethod
+    @version_cache
+    def get_snapshot(cls, id_: str, version: int) -> FileSnapshot:
+        """
+        Rebuild the row data of a past version from the last checkpoint at or before it and the deltas since.
+        Raises NotFoundError if the log doesn't cover the version, e.g. versions from before the log was kept.
+        """
+        session = db_session.get()
+        checkpoint = (
+            session.query(FileVersion)
+            .filter(FileVersion.file_id == id_, FileVersion.checkpoint, FileVersion.version <= version)
+            .order_by(FileVersion.version.desc())
+            .first()
+        )
+        if not checkpoint:
+            raise NotFoundError(f'Version {version} of file {id_!r} not found')
+        deltas = (
+            session.query(FileVersion)
+            .filter(
+                FileVersion.file_id == id_, ~FileVersion.checkpoint,
+                FileVersion.version > checkpoint.version, FileVersion.version <= version
+            )
+            .order_by(FileVersion.version)
+            .all()
+        )
+        if [delta.version for delta in deltas] != list(range(checkpoint.version + 1, version + 1)):
+            # a version without a delta replaced the whole file, and had no checkpoint saved
+            raise NotFoundError(f'Version {version} of file {id_!r} not found')
+        if any(delta.pending for delta in deltas):
+            raise NotFoundError(f'Version {version} of file {id_!r} is not available yet')
+
+        try:
+            snapshot = load_snapshot(checkpoint.data)
+        except SnapshotError:
+            logger.warning(f'Unable to load checkpoint {checkpoint.version} of file {id_!r}', exc_info=True)
+            raise NotFoundError(f'Version {version} of file {id_!r} not found')
+        if deltas:
+            try:
+                snapshot = cls._replay(snapshot, [json.loads(zlib.decompress(delta.data)) for delta in deltas])
+            except (IndexError, ValueError):
+                logger.warning(f'Unable to replay version {version} of file {id_!r}', exc_info=True)
+                raise NotFoundError(f'Version {version} of file {id_!r} not found')
+        snapshot.version = version
+        return snapshot
+
+    @classmethod
+    def formula_changes(cls, previous: FileSnapshot, snapshot: FileSnapshot, operations: List[list]) -> List[list]:
+        """
+        Updates of the formula results of a version, for the rows where they differ from what replaying its row
+        changes on the previous version gives. The row changes leave the results of formula cells as they were, or
+        blank for created rows, while any row's results may have changed, e.g. with a total of a column.
+        """
+        columns = [i for i, header in enumerate(snapshot.headers) if snapshot.data_types.get(header) in ['e', 'f']]
+        if not columns or previous.headers != snapshot.headers:
+            return []
+
+        def project(values: list) -> list:
+            return [values[i] for i in columns]
+
+        rows = [list(values) for values in zip(*(previous.columns[i].slice(0, previous.row_count) for i in columns))]
+        rows = cls._replay_rows(rows, [[
+            operation if operation[0] == cls.DELETE else [*operation[:-1], project(operation[-1])]
+            for operation in operations
+        ]], len(columns))
+
+        changes = []
+        blank_row = [BLANK] * len(columns)
+        results = zip(*(snapshot.columns[i].slice(0, snapshot.row_count) for i in columns))
+        for index, row in enumerate(results):
+            before = [BLANK if value is None else value for value in rows[index]] if index < len(rows) else blank_row
+            if list(row) != before:
+                values = [None] * len(snapshot.headers)
+                for i, old, new in zip(columns, before, row):
+                    if old != new:
+                        values[i] = new
+                changes.append([cls.UPDATE, index, values])
+        return changes
+
+    @staticmethod
+    def _compress(operations: List[list]) -> bytes:
+        return zlib.compress(json.dumps(operations, separators=(',', ':')).encode('utf-8'))
+
+    @classmethod
+    def _replay(cls, snapshot: FileSnapshot, deltas: List[List[list]]) -> FileSnapshot:
+        """Apply deltas to the rows of a snapshot"""
+        rows = cls._replay_rows([row[1:] for row in snapshot.rows(compact=True)], deltas, len(snapshot.headers))
+        builder = SnapshotBuilder(snapshot.headers, snapshot.column_letters)
+        for row in rows:
+            builder.append(row)
+        return builder.build(snapshot.data_types)
+
+    @classmethod
+    def _replay_rows(cls, rows: List[list], deltas: List[List[list]], width: int) -> List[list]:
+        """
+        Apply deltas to rows of values. Snapshots have no trailing blank rows, which the worksheet may still have,
+        so rows are padded with blanks up to the row an operation is for.
+        """
+        blank_row = [None] * width
+
+        def pad(length: int):
+            rows.extend(list(blank_row) for _ in range(length - len(rows)))
+
+        for operations in deltas:
+            for operation in operations:
+                index = operation[1]
+                if index < 0:
+                    raise IndexError(f'Row index {index} out of range')
+                if operation[0] == cls.CREATE:
+                    if index < len(rows):
+                        raise IndexError(f'Row {index} created before the last row {len(rows) - 1}')
+                    pad(index)
+                    rows.append(operation[2])
+                elif operation[0] == cls.UPDATE:
+                    pad(index + 1)
+                    rows[index] = [old if new is None else new for old, new in zip(rows[index], operation[2])]
+                else:
+                    pad(index + 1)
+                    del rows[index]
+        return rows
@@ -6,6 +6,8 @@ from pathlib import Path
 os.environ['DB_ENGINE'] = 'sqlite'
 os.environ['DB_URL'] = 'sqlite:///:memory:'
 os.environ['JWT_SECRET_KEY'] = 'test-secret'
+os.environ['CACHE_REBUILD_ASYNC'] = 'false'  # so file data reflects applied changes as soon as they're approved
+os.environ['APPLY_ASYNC'] = 'false'
 
 # src dir must be on sys.path to run tests from cli
 src_dir = Path(__file__).resolve().parent.parent
@@ -0,0 +1,52 @@
+"""
+Stand-in for util/lo_worker.py which speaks the same protocol without LibreOffice. A job appends a line to the file
+naming the worker's pid, unless the file name asks the worker to crash, hang or report an error. Like the real
+worker, it exits when the process which started it does.
+"""
+import argparse
+import json
+import os
+import socket
+import threading
+import time
+
+
+def _watch_parent(parent_pid: int):
+    while os.getppid() == parent_pid:
+        time.sleep(0.1)
+    os._exit(0)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', required=True)
+    parser.add_argument('--profile', required=True)
+    args = parser.parse_args()
+
+    threading.Thread(target=_watch_parent, args=(os.getppid(),), daemon=True).start()
+    time.sleep(0.1)  # starting up
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen()
+    while True:
+        connection, _ = server.accept()
+        with connection, connection.makefile('rwb') as stream:
+            request = json.loads(stream.readline())
+            reply = {'ok': True, 'pid': os.getpid()}
+            path = request.get('path', '')
+            if 'crash' in path:
+                os._exit(1)
+            elif 'hang' in path:
+                time.sleep(60)
+            elif 'error' in path:
+                reply = {'ok': False, 'error': 'Unable to load'}
+            elif path:
+                time.sleep(0.2)
+                with open(path, 'a') as file:
+                    file.write(f'{os.getpid()}\n')
+            stream.write(json.dumps(reply).encode('utf-8') + b'\n')
+            stream.flush()
+
+
+if __name__ == '__main__':
+    main()
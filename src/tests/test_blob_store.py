@@ -0,0 +1,86 @@
+import mmap
+import os
+import tempfile
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+
+from database import db
+from database.blob_store import LocalBlobStore
+from database.migrate_blobs import migrate_to_store, migrate_to_database, collect_garbage
+from database.models import File
+from services.file_data import file_cache
+from tests.conftest import get_file_bytes, get_results, TEST_EXCEL
+
+
+@pytest.fixture(scope="function")
+def local_blob_store():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        store = LocalBlobStore(temp_dir)
+        with patch('database.models.blob_store', store), patch('database.migrate_blobs.blob_store', store):
+            yield store
+    file_cache.clear()  # entries of files whose blobs were in the removed store
+
+
+class TestLocalBlobStore:
+
+    def test_put_get(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = LocalBlobStore(temp_dir)
+            key = store.put(b'workbook')
+            os.utime(store.path(key), (0, 0))
+            assert store.put(b'workbook') == key
+            assert os.path.getmtime(store.path(key)) > 0  # stored again, so not collected as garbage yet
+            blob = store.get(key)
+            assert isinstance(blob, mmap.mmap)
+            assert blob[:] == b'workbook'
+            assert list(store.keys()) == [key]
+            assert store.get(store.put(b'')) == b''
+
+            store.delete(key)
+            assert key not in list(store.keys())
+
+    def test_files_in_store(self, client, local_blob_store):
+        file_bytes = get_file_bytes(TEST_EXCEL)
+        response = client.post("/files", data={'file': (BytesIO(file_bytes), 'test.xlsx')})
+        assert response.status_code == 200
+        file_id = response.json['id']
+
+        file = db.get_session().query(File).filter_by(id=file_id).one()
+        assert file._blob is None
+        assert isinstance(file.blob, mmap.mmap)
+        assert list(local_blob_store.keys()) == [file.blob_key]
+
+        client.delete('/cache')
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert response.json == get_results('file_data.json')
+
+        response = client.get("/files/download", query_string={'id': file_id})
+        assert response.status_code == 200
+        assert response.data == file_bytes
+        response = client.get("/files/download", query_string={'id': file_id}, headers={'Range': 'bytes=100-199'})
+        assert response.status_code == 206
+        assert response.data == file_bytes[100:200]
+
+    def test_migrate(self, test_file, local_blob_store):
+        file_bytes = get_file_bytes(TEST_EXCEL)
+        assert migrate_to_store(local_blob_store) == 1
+        assert migrate_to_store(local_blob_store) == 0
+
+        session = db.get_session()
+        file = session.query(File).filter_by(id=test_file['id']).one()
+        assert file._blob is None
+        assert file.blob[:] == file_bytes
+        session.close()
+
+        unreferenced = local_blob_store.put(b'previous version')
+        assert collect_garbage(local_blob_store) == 0  # may be for a file not yet committed
+        assert collect_garbage(local_blob_store, grace_minutes=0) == 1
+        assert list(local_blob_store.keys()) == [file.blob_key]
+        assert unreferenced not in list(local_blob_store.keys())
+
+        assert migrate_to_database(local_blob_store) == 1
+        file = db.get_session().query(File).filter_by(id=test_file['id']).one()
+        assert file.blob_key is None
+        assert file.blob == file_bytes
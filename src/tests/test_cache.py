@@ -5,10 +5,14 @@ class TestCache:
         response = client.get('/cache')
         assert response.status_code == 200
         assert response.json == {
+            'currbytes': 0,
             'currsize': 0,
             'hits': 0,
+            'inflight': 0,
+            'maxbytes': 512 * 1024 * 1024,
             'maxsize': 50,
-            'misses': 0
+            'misses': 0,
+            'waits': 0
         }
 
     def test_get_cache_keys(self, client, mock_jwt_required):
@@ -0,0 +1,44 @@
+import os
+import sqlite3
+import tempfile
+
+from sqlalchemy import inspect
+
+from database.db import Database
+from database.models import File, Snapshot, View
+
+
+class TestDatabase:
+
+    def test_upgrade_schema(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'old.db')
+            # the tables as created before blobs could be kept elsewhere and files were versioned
+            with sqlite3.connect(path) as connection:
+                connection.executescript("""
+                    CREATE TABLE file (
+                        id VARCHAR(22) NOT NULL, name VARCHAR NOT NULL, content_type VARCHAR NOT NULL,
+                        blob BLOB NOT NULL, _data_types VARCHAR NOT NULL, PRIMARY KEY (id)
+                    );
+                    CREATE TABLE view (
+                        id VARCHAR(22) NOT NULL, file_id VARCHAR(22) NOT NULL, name VARCHAR NOT NULL,
+                        _fields VARCHAR NOT NULL, PRIMARY KEY (id), FOREIGN KEY(file_id) REFERENCES file (id)
+                    );
+                    INSERT INTO file VALUES ('f1', 'test.xlsx', 'application/xlsx', x'0102', '{}');
+                    INSERT INTO view VALUES ('v1', 'f1', 'test view', '[]');
+                """)
+            connection.close()
+
+            for _ in range(2):  # and again, when there's nothing left to change
+                database = Database(f'sqlite:///{path}')
+                session = database.get_session()
+                file = session.query(File).one()
+                assert (file.blob, file.blob_key, file.size_bytes, file.version) == (b'\x01\x02', None, 0, 1)
+                assert session.query(View).one().file_id == 'f1'
+                assert session.query(Snapshot).count() == 0
+                session.close()
+
+            inspector = inspect(database.engine)
+            assert {column['name']: column['nullable'] for column in inspector.get_columns('file')}['blob']
+            assert inspector.get_foreign_keys('view')[0]['referred_table'] == 'file'
+            database.engine.dispose()
@@ -1,4 +1,26 @@
-from tests.conftest import get_results
+import gzip
+import json
+import pickle
+import threading
+import zlib
+from datetime import date, datetime, timedelta
+from io import BytesIO
+from unittest.mock import patch
+
+import pytest
+from openpyxl import Workbook, load_workbook
+from openpyxl.styles import PatternFill
+from sqlalchemy.exc import OperationalError
+
+from config import Config
+from context import db_session
+from database import db
+from database.models import Snapshot
+from services.file_data import FileDataService, file_cache, cache_rebuilder
+from services.versions import VersionService
+from tests.conftest import get_results, get_file_bytes, TEST_EXCEL
+from util.arrow import ARROW_STREAM_MIMETYPE
+from util.snapshot import SnapshotBuilder, SnapshotError, dump_snapshot, load_snapshot
 
 
 class TestFileData:
@@ -14,6 +36,553 @@ class TestFileData:
             'message': "id not found in request"
         }
 
+    def test_get_file_data_from_cache(self, client, test_file):
+        client.delete('/cache')
+        response = client.get("/files/data", query_string={'id': test_file['id']})
+        assert response.status_code == 200
+        response = client.get("/files/data", query_string={'id': test_file['id']})
+        assert response.status_code == 200
+        assert response.json == get_results('file_data.json')
+
+        response = client.get('/cache')
+        assert response.json['hits'] == 1
+        assert response.json['misses'] == 1
+
+    def test_get_file_data_rows(self, client, test_file):
+        expected = get_results('file_data.json')
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'startRow': 1, 'endRow': 3})
+        assert response.status_code == 200
+        assert response.json == {
+            'columnDefs': expected['columnDefs'],
+            'rowData': expected['rowData'][1:3],
+            'rowCount': 4
+        }
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'startRow': 2, 'endRow': 100})
+        assert response.status_code == 200
+        assert response.json['rowData'] == expected['rowData'][2:]
+        assert response.json['rowCount'] == 4
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'startRow': 3, 'endRow': 1})
+        assert response.status_code == 400
+        assert response.json == {
+            'message': "Invalid row range 3 to 1"
+        }
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'startRow': -1})
+        assert response.status_code == 400
+        assert response.json == {
+            'message': "startRow must be a non-negative integer"
+        }
+
+    def test_get_file_data_view(self, client, test_file):
+        view_data = {
+            'fileId': test_file['id'],
+            'name': 'test view',
+            'fields': [],
+            'filters': [
+                {
+                    'field': 'Age',
+                    'filterType': 'number',
+                    'operator': 'OR',
+                    'conditions': [{'operator': 'lessThan', 'value': '30'}, {'operator': 'greaterThan', 'value': '45'}]
+                },
+                {
+                    'field': 'Last Name',
+                    'filterType': 'text',
+                    'conditions': [{'operator': 'contains', 'value': 'AR'}]
+                },
+                {
+                    'field': 'Date Entered',
+                    'filterType': 'date',
+                    'conditions': [{'operator': 'inRange', 'value': '2023-01-01,2023-02-01'}]
+                }
+            ]
+        }
+        view = client.post("/views", json=view_data).json
+        expected = get_results('file_data.json')
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'viewId': view['id']})
+        assert response.status_code == 200
+        assert response.json == {
+            'columnDefs': expected['columnDefs'],
+            'rowData': [expected['rowData'][1], expected['rowData'][2]],
+            'rowCount': 2
+        }
+
+        response = client.get(
+            "/files/data", query_string={'id': test_file['id'], 'viewId': view['id'], 'startRow': 1, 'endRow': 2}
+        )
+        assert response.status_code == 200
+        assert response.json['rowData'] == [expected['rowData'][2]]
+        assert response.json['rowCount'] == 2
+
+        view_data['filters'] = [{
+            'field': 'Age', 'filterType': 'number', 'conditions': [{'operator': 'equals', 'value': 'abc'}]
+        }]
+        view = client.post("/views", json=view_data).json
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'viewId': view['id']})
+        assert response.status_code == 400
+        assert response.json == {
+            'message': f"Unable to apply filters of view {view['id']!r}: Invalid filter value 'abc'"
+        }
+
+    def test_get_file_data_sorted(self, client, test_file):
+        expected = get_results('file_data.json')
+
+        def get_sorted(sort_model, **params):
+            return client.get(
+                "/files/data", query_string={'id': test_file['id'], 'sortModel': json.dumps(sort_model), **params}
+            )
+
+        response = get_sorted([{'colId': 'Age', 'sort': 'desc'}])
+        assert response.status_code == 200
+        assert response.json == {
+            'columnDefs': expected['columnDefs'],
+            'rowData': [expected['rowData'][i] for i in [2, 0, 3, 1]],
+            'rowCount': 4
+        }
+
+        # the order of all rows is held once, and counted once towards the cache size
+        snapshot = file_cache.cache[test_file['id']]
+        [(order, _)] = snapshot.derived['order'].values()
+        assert list(order) == [2, 0, 3, 1]
+        assert snapshot.derived_nbytes == sum(
+            size for derived in snapshot.derived.values() for _, size in derived.values()
+        )
+
+        response = get_sorted([{'colId': 'Last Name', 'sort': 'asc'}], startRow=1, endRow=3)
+        assert response.status_code == 200
+        assert response.json['rowData'] == [expected['rowData'][i] for i in [1, 3]]
+
+        response = get_sorted([{'colId': 'Date Entered', 'sort': 'desc'}, {'colId': 'C', 'sort': 'asc'}])
+        assert response.status_code == 200
+        assert response.json['rowData'] == [expected['rowData'][i] for i in [1, 3, 0, 2]]
+
+        view_data = {
+            'fileId': test_file['id'],
+            'name': 'test view',
+            'fields': [],
+            'filters': [{
+                'field': 'Age', 'filterType': 'number', 'conditions': [{'operator': 'lessThan', 'value': '40'}]
+            }]
+        }
+        view = client.post("/views", json=view_data).json
+        response = get_sorted([{'colId': 'Age', 'sort': 'desc'}], viewId=view['id'])
+        assert response.status_code == 200
+        assert response.json['rowData'] == [expected['rowData'][i] for i in [3, 1]]
+        assert response.json['rowCount'] == 2
+
+        response = get_sorted([{'colId': 'Height', 'sort': 'asc'}])
+        assert response.status_code == 400
+        assert response.json == {'message': "Sort column 'Height' not found in file"}
+
+        response = get_sorted([{'colId': 'Age', 'sort': 'up'}])
+        assert response.status_code == 400
+        assert response.json == {'message': "Sort direction must be asc or desc but got 'up'"}
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'sortModel': '[{'})
+        assert response.status_code == 400
+        assert response.json == {'message': 'sortModel must be valid JSON'}
+
+    def test_get_file_data_compact(self, client, test_file):
+        expected = get_results('file_data.json')
+        fields = ['_rowNumber', *(column['field'] for column in expected['columnDefs'])]
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'format': 'compact'})
+        assert response.status_code == 200
+        assert response.json == {
+            'columnDefs': expected['columnDefs'],
+            'fields': fields,
+            'rowData': [[row[field] for field in fields] for row in expected['rowData']]
+        }
+
+        response = client.get(
+            "/files/data", query_string={'id': test_file['id'], 'format': 'compact', 'startRow': 1, 'endRow': 3}
+        )
+        assert response.status_code == 200
+        assert response.json['rowData'] == [[row[field] for field in fields] for row in expected['rowData'][1:3]]
+        assert response.json['rowCount'] == 4
+
+        response = client.get("/files/data", query_string={'id': test_file['id'], 'format': 'csv'})
+        assert response.status_code == 400
+        assert response.json == {'message': "format must be objects or compact but got 'csv'"}
+
+    def test_get_file_data_arrow(self, client, test_file):
+        pyarrow = pytest.importorskip('pyarrow')
+        import pyarrow.ipc
+
+        expected = get_results('file_data.json')
+        headers = {'Accept': ARROW_STREAM_MIMETYPE}
+        response = client.get("/files/data", query_string={'id': test_file['id']}, headers=headers)
+        assert response.status_code == 200
+        assert response.mimetype == ARROW_STREAM_MIMETYPE
+        assert response.get_etag() == (f"{test_file['id']}-1-arrow", False)
+
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        assert table.column_names == ['_rowNumber', *(column['field'] for column in expected['columnDefs'])]
+        assert str(table.schema.field('Age').type) == 'int64'
+        assert str(table.schema.field('Date Entered').type) == 'date32[day]'
+        assert table.schema.metadata[b'rowCount'] == b'4'
+        rows = table.to_pylist()
+        assert [row['Last Name'] for row in rows] == [row['Last Name'] for row in expected['rowData']]
+        assert [row['Age'] for row in rows] == [45, 28, 46, 32]
+        assert rows[0]['Date Entered'] == date(2023, 1, 14)
+
+        response = client.get("/files/data", headers=headers, query_string={
+            'id': test_file['id'], 'sortModel': json.dumps([{'colId': 'Age', 'sort': 'asc'}]), 'startRow': 1
+        })
+        table = pyarrow.ipc.open_stream(response.data).read_all()
+        assert table.column('_rowNumber').to_pylist() == [4, 1, 3]
+        assert table.schema.metadata[b'rowCount'] == b'4'
+
+    def test_get_file_data_arrow_unavailable(self, client, test_file):
+        with patch('services.file_data.pyarrow', None):
+            response = client.get(
+                "/files/data", query_string={'id': test_file['id']}, headers={'Accept': ARROW_STREAM_MIMETYPE}
+            )
+        assert response.status_code == 406
+        assert response.json == {'message': 'Arrow format is not available, pyarrow is not installed'}
+
+    def test_get_file_data_streamed(self, client, test_file):
+        expected = get_results('file_data.json')
+        with patch.object(Config, 'STREAM_CHUNK_ROWS', 3):
+            response = client.get("/files/data", query_string={'id': test_file['id'], 'stream': 'true'})
+            assert response.status_code == 200
+            assert response.is_streamed
+            assert response.json == expected
+
+            response = client.get(
+                "/files/data", query_string={'id': test_file['id'], 'stream': 'true', 'startRow': 1, 'endRow': 10},
+                headers={'Accept-Encoding': 'gzip'}
+            )
+            assert response.headers['Content-Encoding'] == 'gzip'
+            assert json.loads(gzip.decompress(response.data)) == {
+                'columnDefs': expected['columnDefs'],
+                'rowData': expected['rowData'][1:],
+                'rowCount': 4
+            }
+
+            response = client.get("/files/data", query_string={
+                'id': test_file['id'], 'stream': 'true', 'format': 'compact',
+                'sortModel': json.dumps([{'colId': 'Age', 'sort': 'desc'}])
+            })
+            assert [row[0] for row in response.json['rowData']] == [3, 1, 4, 2]
+
+        response = client.get(
+            "/files/data", query_string={'id': test_file['id'], 'stream': 'true', 'startRow': 2, 'endRow': 1}
+        )
+        assert response.status_code == 400
+        assert response.json == {'message': 'Invalid row range 2 to 1'}
+
+    def test_get_file_data_etag(self, client, test_file):
+        response = client.get("/files/data", query_string={'id': test_file['id']})
+        assert response.status_code == 200
+        etag, _ = response.get_etag()
+        etag_header = f'"{etag}"'
+        assert etag == f"{test_file['id']}-1"
+
+        response = client.get(
+            "/files/data", query_string={'id': test_file['id']}, headers={'If-None-Match': etag_header}
+        )
+        assert response.status_code == 304
+        assert response.data == b''
+        assert response.get_etag() == (etag, False)
+        assert response.headers['Vary'] == 'Accept, Accept-Encoding'
+
+        response = client.put("/files", query_string={'id': test_file['id']}, data={
+            'file': (BytesIO(get_file_bytes(TEST_EXCEL)), 'test.xlsx')
+        })
+        assert response.status_code == 200
+        response = client.get(
+            "/files/data", query_string={'id': test_file['id']}, headers={'If-None-Match': etag_header}
+        )
+        assert response.status_code == 200
+        assert response.get_etag() == (f"{test_file['id']}-2", False)
+        assert response.json == get_results('file_data.json')
+
+    def test_get_file_data_compressed(self, client, test_file):
+        response = client.get("/files/data", query_string={'id': test_file['id']}, headers={'Accept-Encoding': 'gzip'})
+        assert response.status_code == 200
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert response.headers['Vary'] == 'Accept, Accept-Encoding'
+        assert response.get_etag() == (f"{test_file['id']}-1-gzip", False)
+        assert json.loads(gzip.decompress(response.data)) == get_results('file_data.json')
+
+        # the JSON and its gzipped variant are both held with the snapshot, so a repeat request is served as is
+        snapshot = file_cache.cache[test_file['id']]
+        assert list(snapshot.derived) == ['json', 'json-gzip']
+        assert file_cache.sizes[test_file['id']] == snapshot.nbytes  # counted as soon as they were memoized
+        [(gzipped, gzipped_size)] = snapshot.derived['json-gzip'].values()
+        response = client.get("/files/data", query_string={'id': test_file['id']}, headers={'Accept-Encoding': 'gzip'})
+        assert response.data == gzipped
+
+        # and they count towards the cache size
+        assert {'id': test_file['id'], 'bytes': snapshot.nbytes} in client.get('/cache/keys').json
+        assert snapshot.derived_nbytes > gzipped_size
+
+        response = client.get("/files/data", query_string={'id': test_file['id']})
+        assert 'Content-Encoding' not in response.headers
+        assert response.json == get_results('file_data.json')
+
+    def test_cache_rebuilt_in_background(self, client, test_file):
+        response = client.get("/files/data", query_string={'id': test_file['id']})
+        assert response.status_code == 200
+        old_snapshot = file_cache.cache[test_file['id']]
+
+        release = threading.Event()
+        read_snapshot = FileDataService._read_snapshot.__func__
+
+        def slow_read_snapshot(cls, *args):
+            release.wait(5)
+            return read_snapshot(cls, *args)
+
+        with patch.object(Config, 'CACHE_REBUILD_ASYNC', True), \
+                patch.object(FileDataService, '_read_snapshot', classmethod(slow_read_snapshot)):
+            FileDataService._refresh_cache(
+                test_file['id'], get_file_bytes(TEST_EXCEL), old_snapshot.data_types, old_snapshot.version + 1
+            )
+            # readers get the old snapshot until the rebuild is done
+            response = client.get("/files/data", query_string={'id': test_file['id']})
+            assert response.json == get_results('file_data.json')
+            assert file_cache.cache[test_file['id']] is old_snapshot
+
+            release.set()
+            cache_rebuilder.submit(lambda: None).result()
+
+        assert file_cache.cache[test_file['id']] is not old_snapshot
+        response = client.get("/files/data", query_string={'id': test_file['id']})
+        assert response.json == get_results('file_data.json')
+
+    def test_memoize_concurrently(self, client, test_file):
+        client.get("/files/data", query_string={'id': test_file['id']})
+        snapshot = file_cache.cache[test_file['id']]
+        started = threading.Barrier(4)
+
+        def compute():
+            started.wait(5)  # so every thread misses the memo before any stores it
+            return [object()] * 100
+
+        results = []
+        threads = [
+            threading.Thread(target=lambda: results.append(snapshot.memoize('test', 1, compute, maxsize=1)))
+            for _ in range(4)
+        ]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # the first value computed is kept, and counted once
+        [(value, size)] = snapshot.derived['test'].values()
+        assert all(result is value for result in results)
+        assert snapshot.derived_nbytes == sum(
+            size for derived in snapshot.derived.values() for _, size in derived.values()
+        )
+        assert load_snapshot(dump_snapshot(snapshot)).memoize('test', 1, lambda: [], maxsize=1) == []
+
+    def test_saved_snapshot(self, client, test_file):
+        file_id = test_file['id']
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert response.status_code == 200
+        session = db.get_session()
+        record = session.query(Snapshot).filter_by(file_id=file_id).one()
+        assert record.version == 1
+
+        # a cold cache loads the saved snapshot rather than parsing the workbook
+        file_cache.remove(id_=file_id)
+        with patch('services.file_data.XlsxReader', side_effect=AssertionError('reparsed')), \
+                patch.object(FileDataService, '_load_workbook', side_effect=AssertionError('reparsed')):
+            response = client.get("/files/data", query_string={'id': file_id})
+        assert response.status_code == 200
+        assert response.json == get_results('file_data.json')
+
+        # a corrupt snapshot is replaced by reparsing the workbook
+        record.data = b'GRIDSNAP\x02\x00not a snapshot'
+        session.commit()
+        file_cache.remove(id_=file_id)
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert response.status_code == 200
+        assert response.json == get_results('file_data.json')
+        session.refresh(record)
+        assert load_snapshot(record.data).row_count == 4
+        session.close()
+
+    def test_snapshot_serialization(self):
+        builder = SnapshotBuilder(['Number', 'Text', 'Mixed', 7], ['A', 'B', 'C', 'D'])
+        builder.append([1, 'x', datetime(2020, 1, 2, 3, 4), True])
+        builder.append([2.5, 'ü', date(2021, 5, 6), 2 ** 60])
+        builder.append([None, '', 'text', timedelta(days=1)])
+        snapshot = builder.build({'Number': 'n', 'Text': 's', 7: 'n'})
+        snapshot.version = 3
+
+        loaded = load_snapshot(dump_snapshot(snapshot))
+        assert loaded.rows() == snapshot.rows()
+        assert loaded.data_types == snapshot.data_types
+        assert loaded.version == 3
+
+        # snapshots of the old pickled format are never unpickled, so they are reparsed
+        pickled = b'GRIDSNAP\x01\x00' + zlib.compress(pickle.dumps(snapshot))
+        with patch('pickle.loads', side_effect=AssertionError('unpickled')):
+            with pytest.raises(SnapshotError, match='format 1'):
+                load_snapshot(pickled)
+            with pytest.raises(SnapshotError, match='Corrupt'):
+                load_snapshot(b'GRIDSNAP\x02\x00' + zlib.compress(pickle.dumps(snapshot)))
+
+    def test_saved_snapshot_failure(self, client, test_file, caplog):
+        # reading file data doesn't commit the request's session, and a snapshot which isn't saved is only logged
+        sessions = []
+
+        def fail_save(session, *args):
+            sessions.append(session is db_session.get(None))
+            raise OperationalError('UPDATE snapshot', {}, Exception('database is locked'))
+
+        with patch.object(FileDataService, 'save_snapshot', side_effect=fail_save):
+            response = client.get("/files/data", query_string={'id': test_file['id']})
+            assert response.status_code == 200
+            assert response.json == get_results('file_data.json')
+
+            row = {
+                'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+                'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+            }
+            change = {'changeType': 'create', 'rowNumber': 5, 'after': row, 'before': None}
+            response = client.post("/transactions", json={'fileId': test_file['id'], 'changes': [change]})
+            assert response.status_code == 202
+        assert sessions == [False, False]
+        assert caplog.text.count(f"Unable to save snapshot of file {test_file['id']!r}") == 2
+
+    def test_file_versions(self, client):
+        response = client.post("/files", data={'file': (BytesIO(get_file_bytes(TEST_EXCEL)), 'test.xlsx')})
+        file_id = response.json['id']
+        row = {
+            'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+            'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+        }
+        updated_row = {**row, 'Age': '43', 'Date Entered': '15/04/2023', 'Speed': '70'}
+        transactions = [
+            {'changeType': 'create', 'rowNumber': 5, 'after': row, 'before': None},
+            {'changeType': 'update', 'rowNumber': 5, 'after': updated_row, 'before': row},
+            {'changeType': 'update', 'rowNumber': 2, 'after': {**row, 'First Name': 'Bruce'}, 'before': row},
+            {'changeType': 'delete', 'rowNumber': 5, 'after': None, 'before': updated_row},
+        ]
+        versions = [client.get("/files/data", query_string={'id': file_id}).json]
+        with patch.object(Config, 'VERSION_CHECKPOINT_INTERVAL', 3):
+            for change in transactions:
+                response = client.post("/transactions", json={'fileId': file_id, 'changes': [change]})
+                assert response.status_code == 202
+                versions.append(client.get("/files/data", query_string={'id': file_id}).json)
+
+        response = client.get("/files/versions", query_string={'id': file_id})
+        assert [(v['version'], v['checkpoint']) for v in response.json] == [
+            (1, True), (2, False), (3, True), (4, False), (5, False)
+        ]
+
+        # past versions are rebuilt from the last checkpoint and the deltas since, the same as when they were current
+        for version, expected in enumerate(versions, start=1):
+            response = client.get("/files/data", query_string={'id': file_id, 'version': version})
+            assert response.status_code == 200
+            assert response.json['columnDefs'] == expected['columnDefs']
+            assert response.json['rowData'] == expected['rowData']
+
+        response = client.get("/files/data", query_string={'id': file_id, 'version': 2, 'startRow': 4, 'endRow': 5})
+        assert response.json['rowData'] == versions[1]['rowData'][4:5]
+        assert response.json['rowCount'] == 5
+
+        response = client.get("/files/data", query_string={'id': file_id, 'version': 9})
+        assert response.status_code == 404
+
+    def test_file_versions_styled_rows(self, client):
+        # blank rows with styles are dropped from the data, but rows are still created after them in the workbook
+        wb = load_workbook(BytesIO(get_file_bytes(TEST_EXCEL)))
+        for row in wb.active.iter_rows(min_row=6, max_row=8, max_col=8):
+            for cell in row:
+                cell.fill = PatternFill('solid', start_color='FFFF00')
+        file_bytes = BytesIO()
+        wb.save(file_bytes)
+        response = client.post("/files", data={'file': (BytesIO(file_bytes.getvalue()), 'test.xlsx')})
+        file_id = response.json['id']
+        row = {
+            'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+            'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+        }
+        transactions = [
+            {'changeType': 'create', 'rowNumber': 5, 'after': row, 'before': None},
+            {'changeType': 'update', 'rowNumber': 8, 'after': {**row, 'Age': '43'}, 'before': row},
+            {'changeType': 'create', 'rowNumber': 9, 'after': {**row, 'First Name': 'Peter'}, 'before': None},
+        ]
+        versions = [client.get("/files/data", query_string={'id': file_id}).json]
+        for change in transactions:
+            response = client.post("/transactions", json={'fileId': file_id, 'changes': [change]})
+            assert response.status_code == 202
+            versions.append(client.get("/files/data", query_string={'id': file_id}).json)
+        assert [(row['_rowNumber'], row['First Name'], row['Age']) for row in versions[-1]['rowData'][4:]] == [
+            (5, '', ''), (6, '', ''), (7, '', ''), (8, 'Steve', 43), (9, 'Peter', 40)
+        ]
+
+        for version, expected in enumerate(versions, start=1):
+            response = client.get("/files/data", query_string={'id': file_id, 'version': version})
+            assert response.status_code == 200
+            assert response.json['rowData'] == expected['rowData']
+
+        session = db.get_session()
+        VersionService.add_delta(session, file_id, len(versions) + 1, [[VersionService.UPDATE, -1, [None] * 8]])
+        session.commit()
+        session.close()
+        response = client.get("/files/data", query_string={'id': file_id, 'version': len(versions) + 1})
+        assert response.status_code == 404
+
+    def test_file_versions_formulas(self, client):
+        # the share of each row changes with the score of any row, so untouched rows' results are logged too
+        wb = Workbook()
+        wb.active.append(['Name', 'Score', 'Share'])
+        for i, (name, score) in enumerate([('Bruce', 10), ('Natasha', 30), ('Tony', 60)], start=2):
+            wb.active.append([name, score, f'=B{i}/SUM($B$2:$B$4)'])
+        file_bytes = BytesIO()
+        wb.save(file_bytes)
+        response = client.post("/files", data={'file': (BytesIO(file_bytes.getvalue()), 'test.xlsx')})
+        file_id = response.json['id']
+        bruce, tony = {'Name': 'Bruce', 'Score': '10', 'Share': None}, {'Name': 'Tony', 'Score': '60', 'Share': None}
+        transactions = [
+            {'changeType': 'update', 'rowNumber': 1, 'after': {**bruce, 'Score': '110'}, 'before': bruce},
+            {'changeType': 'update', 'rowNumber': 3, 'after': {**tony, 'Score': '260'}, 'before': tony},
+        ]
+        versions = [client.get("/files/data", query_string={'id': file_id}).json]
+        for change in transactions:
+            response = client.post("/transactions", json={'fileId': file_id, 'changes': [change]})
+            assert response.status_code == 202
+            versions.append(client.get("/files/data", query_string={'id': file_id}).json)
+        assert [row['Share'] for row in versions[1]['rowData']] == [0.55, 0.15, 0.3]
+        assert [row['Share'] for row in versions[2]['rowData']] == [0.275, 0.075, 0.65]
+
+        for version, expected in enumerate(versions, start=1):
+            response = client.get("/files/data", query_string={'id': file_id, 'version': version})
+            assert response.status_code == 200
+            assert response.json['rowData'] == expected['rowData']
+
+        # the formula results are logged by the cache rebuild, rather than by parsing the workbook when applying
+        release = threading.Event()
+        read_snapshot = FileDataService._read_snapshot.__func__
+
+        def slow_read_snapshot(cls, *args):
+            release.wait(5)
+            return read_snapshot(cls, *args)
+
+        natasha = {'Name': 'Natasha', 'Score': '30', 'Share': None}
+        change = {'changeType': 'update', 'rowNumber': 2, 'after': {**natasha, 'Score': '0'}, 'before': natasha}
+        with patch.object(Config, 'CACHE_REBUILD_ASYNC', True), \
+                patch.object(FileDataService, '_read_snapshot', classmethod(slow_read_snapshot)):
+            response = client.post("/transactions", json={'fileId': file_id, 'changes': [change]})
+            assert response.status_code == 202
+            assert not release.is_set()
+            # the version isn't replayed from the log until its formula results are in it
+            response = client.get("/files/data", query_string={'id': file_id, 'version': 4})
+            assert response.status_code == 404
+            release.set()
+            cache_rebuilder.submit(lambda: None).result()
+        response = client.get("/files/data", query_string={'id': file_id, 'version': 4})
+        assert response.status_code == 200
+        assert [row['Share'] for row in response.json['rowData']] == [110 / 370, 0, 260 / 370]
+
     def test_file_data_changes(self, client, test_file):
         create_row_transaction = {
             'fileId': test_file['id'],
@@ -36,7 +605,7 @@ class TestFileData:
             ]
         }
         response = client.post("/transactions", json=create_row_transaction)
-        assert response.status_code == 200
+        assert response.status_code == 202
 
         response = client.get("/files/data", query_string={'id': test_file['id']})
         assert response.status_code == 200
@@ -72,7 +641,7 @@ class TestFileData:
             ]
         }
         response = client.post("/transactions", json=update_row_transaction)
-        assert response.status_code == 200
+        assert response.status_code == 202
 
         response = client.get("/files/data", query_string={'id': test_file['id']})
         assert response.status_code == 200
@@ -99,12 +668,19 @@ class TestFileData:
             ]
         }
         response = client.post("/transactions", json=delete_row_transaction)
-        assert response.status_code == 200
+        assert response.status_code == 202
 
         response = client.get("/files/data", query_string={'id': test_file['id']})
         assert response.status_code == 200
         assert response.json == get_results('file_data_delete_row.json')
 
+        # each applied transaction saves a snapshot of the new version
+        session = db.get_session()
+        record = session.query(Snapshot).filter_by(file_id=test_file['id']).one()
+        assert record.version == 4
+        assert load_snapshot(record.data).rows() == get_results('file_data_delete_row.json')['rowData']
+        session.close()
+
         multi_row_transaction = {
             'fileId': test_file['id'],
             'changes': [
@@ -165,7 +741,7 @@ class TestFileData:
             ]
         }
         response = client.post("/transactions", json=multi_row_transaction)
-        assert response.status_code == 200
+        assert response.status_code == 202
 
         response = client.get("/files/data", query_string={'id': test_file['id']})
         assert response.status_code == 200
@@ -1,5 +1,14 @@
 from io import BytesIO
+from unittest.mock import patch
 
+import pytest
+from sqlalchemy import event
+
+from config import Config
+from database import db
+from database.migrate_blobs import backfill_sizes
+from database.models import File
+from services.file_data import file_cache
 from tests.conftest import get_results, get_file_bytes, TEST_EXCEL, TEST_TXT
 from tests.util import mask_values
 
@@ -40,6 +49,24 @@ class TestFiles:
             'message': "User not permitted to perform action"
         }
 
+    def test_get_files_without_blobs(self, client, test_file):
+        blob_queries = []
+
+        def record_blob_query(conn, cursor, statement, *args):
+            if statement.startswith('SELECT') and 'file.blob AS' in statement:
+                blob_queries.append(statement)
+
+        event.listen(db.engine, 'before_cursor_execute', record_blob_query)
+        try:
+            assert client.get("/files").status_code == 200
+            assert client.get("/files", query_string={'id': test_file['id']}).status_code == 200
+            response = client.post("/files", data={'file': (BytesIO(get_file_bytes(TEST_EXCEL)), 'other.xlsx')})
+            assert response.status_code == 200
+            assert response.json['size_bytes '] == 9429
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', record_blob_query)
+        assert blob_queries == []
+
     def test_add_file(self, client):
         text_excel_bytes = get_file_bytes(TEST_EXCEL)
         virtual_file = BytesIO(text_excel_bytes)
@@ -81,6 +108,27 @@ class TestFiles:
             'message': "unsupported file type 'text/plain'"
         }
 
+    def test_add_file_populates_cache(self, client):
+        client.delete('/cache')
+        virtual_file = BytesIO(get_file_bytes(TEST_EXCEL))
+        response = client.post("/files", data={
+            'file': (virtual_file, 'test.xlsx')
+        })
+        assert response.status_code == 200
+        file_id = response.json['id']
+        cache_keys = client.get('/cache/keys').json
+        assert [key['id'] for key in cache_keys] == [file_id]
+        assert cache_keys[0]['bytes'] > 0
+        assert 'column_stats' not in file_cache.peek(id_=file_id).derived  # only computed for debug logging
+
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert response.status_code == 200
+        assert response.json == get_results('file_data.json')
+        response = client.get('/cache')
+        assert response.json['hits'] == 1
+        assert response.json['misses'] == 0
+        assert response.json['currbytes'] == client.get('/cache/keys').json[0]['bytes']
+
     def test_update_file(self, client, test_file):
         text_excel_bytes = get_file_bytes(TEST_EXCEL)
         virtual_file = BytesIO(text_excel_bytes)
@@ -131,6 +179,14 @@ class TestFiles:
         assert response.headers['Content-Disposition'] == 'attachment; filename=test.xlsx'
         assert int(response.headers['Content-Length']) == 9429
         assert isinstance(response.data, bytes)
+        etag, _ = response.get_etag()
+        etag_header = f'"{etag}"'
+
+        response = client.get(
+            "/files/download", query_string={'id': test_file['id']}, headers={'If-None-Match': etag_header}
+        )
+        assert response.status_code == 304
+        assert response.data == b''
 
         response = client.get("/files/download")
         assert response.status_code == 400
@@ -138,6 +194,70 @@ class TestFiles:
             'message': "id not found in request"
         }
 
+    def test_download_range(self, client, test_file):
+        file_bytes = get_file_bytes(TEST_EXCEL)
+        query_string = {'id': test_file['id']}
+        response = client.get("/files/download", query_string=query_string)
+        assert response.headers['Accept-Ranges'] == 'bytes'
+        assert response.data == file_bytes
+        etag = response.headers['ETag']
+
+        response = client.get("/files/download", query_string=query_string, headers={'Range': 'bytes=100-199'})
+        assert response.status_code == 206
+        assert response.headers['Content-Range'] == 'bytes 100-199/9429'
+        assert int(response.headers['Content-Length']) == 100
+        assert response.data == file_bytes[100:200]
+
+        response = client.get("/files/download", query_string=query_string, headers={'Range': 'bytes=9000-'})
+        assert response.status_code == 206
+        assert response.data == file_bytes[9000:]
+
+        # resuming against a file which has changed since gets the whole file
+        response = client.get(
+            "/files/download", query_string=query_string, headers={'Range': 'bytes=100-', 'If-Range': '"stale"'}
+        )
+        assert response.status_code == 200
+        assert response.data == file_bytes
+        response = client.get(
+            "/files/download", query_string=query_string, headers={'Range': 'bytes=100-', 'If-Range': etag}
+        )
+        assert response.status_code == 206
+        assert response.data == file_bytes[100:]
+
+        response = client.get("/files/download", query_string=query_string, headers={'Range': 'bytes=10000-'})
+        assert response.status_code == 416
+
+    def test_download_changed(self, client, test_file):
+        # the file changes after the first chunk of it is sent, so the rest isn't sent from the new version
+        with patch.object(Config, 'DOWNLOAD_CHUNK_KB', 1):
+            response = client.get("/files/download", query_string={'id': test_file['id']}, buffered=False)
+        chunks = iter(response.response)
+        assert next(chunks) == get_file_bytes(TEST_EXCEL)[:8192]
+        session = db.get_session()
+        session.query(File).filter_by(id=test_file['id']).update({File.version: File.version + 1})
+        session.commit()
+        session.close()
+        with pytest.raises(IOError, match='changed or deleted while being read'):
+            next(chunks)
+        response.close()
+
+    def test_download_without_size(self, client, test_file):
+        # files saved before sizes were stored have a size of 0, until backfilled
+        file_bytes = get_file_bytes(TEST_EXCEL)
+        session = db.get_session()
+        session.query(File).filter_by(id=test_file['id']).update({File.size_bytes: 0})
+        session.commit()
+        response = client.get("/files/download", query_string={'id': test_file['id']})
+        assert response.status_code == 200
+        assert response.data == file_bytes
+        response = client.get("/files")
+        assert response.json[0]['size_bytes '] == len(file_bytes)
+
+        assert backfill_sizes() == 1
+        assert session.query(File.size_bytes).filter_by(id=test_file['id']).scalar() == len(file_bytes)
+        assert backfill_sizes() == 0
+        session.close()
+
     def test_delete(self, client, test_file):
         response = client.delete("/files", query_string={'id': test_file['id']})
         assert response.status_code == 200
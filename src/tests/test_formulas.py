@@ -0,0 +1,82 @@
+from io import BytesIO
+
+import pytest
+from openpyxl import Workbook, load_workbook
+
+from util.formulas import DIV0, NA, FormulaError, FormulaEvaluator, evaluate_formulas, write_cached_values
+
+
+@pytest.fixture(scope="function")
+def worksheet():
+    wb = Workbook()
+    ws = wb.active
+    ws.append(['Name', 'Score', 'Bonus', 'Total'])
+    ws.append(['Ann', 10, 2, '=B2+C2'])
+    ws.append(['Bob', 20, None, '=B3+C3'])
+    ws.append(['Cid', 30, 5, '=D2+B4*C4'])
+    return ws
+
+
+class TestFormulas:
+
+    def test_arithmetic(self, worksheet):
+        evaluator = FormulaEvaluator(worksheet)
+        assert evaluator.evaluate('=1+2*3^2') == 19
+        assert evaluator.evaluate('=-B2+50%') == -9.5
+        assert evaluator.evaluate('="a"&B2') == 'a10'
+        assert evaluator.evaluate('=B2/0') == DIV0
+
+    def test_functions(self, worksheet):
+        evaluator = FormulaEvaluator(worksheet)
+        assert evaluator.evaluate('=SUM(B2:B4)') == 60
+        assert evaluator.evaluate('=AVERAGE(B2:C4)') == 13.4  # blanks are skipped
+        assert evaluator.evaluate('=COUNTIF(B2:B4,">15")') == 2
+        assert evaluator.evaluate('=IF(B2>5,"high","low")') == 'high'
+        assert evaluator.evaluate('=IFERROR(1/0,"none")') == 'none'
+        assert evaluator.evaluate('=VLOOKUP("Bob",A2:C4,2,FALSE)') == 20
+        assert evaluator.evaluate('=VLOOKUP("Dan",A2:C4,2,FALSE)') == NA
+        assert evaluator.evaluate('=INDEX(A2:A4,MATCH(30,B2:B4,0))') == 'Cid'
+        assert evaluator.evaluate('=ROUND(AVERAGE(B2:B4)/7,2)') == 2.86
+        assert evaluator.evaluate('=UPPER(LEFT(A2,2))') == 'AN'
+
+    def test_evaluate_all(self, worksheet):
+        # formulas referring to other formulas are evaluated first, and blank cells count as 0
+        assert evaluate_formulas(worksheet) == {'D2': 12, 'D3': 20, 'D4': 162}
+
+    def test_long_chain(self):
+        # each running total refers to the one below, which would be evaluated first
+        ws = Workbook().active
+        ws.append(['Score', 'Total'])
+        for row in range(2, 5002):
+            ws.append([1, f'=A{row}+B{row + 1}'])
+        results = evaluate_formulas(ws)
+        assert results['B2'] == 5000 and results['B5001'] == 1
+
+        # chains through ranges are still evaluated by recursion, and fall back to Excel/LibreOffice
+        for row in range(2, 5002):
+            ws[f'B{row}'] = f'=A{row}+SUM(B{row + 1}:B{row + 1})'
+        with pytest.raises(FormulaError, match='too deeply'):
+            evaluate_formulas(ws)
+
+    # other sheets, defined names, functions the evaluator doesn't have and circular references
+    @pytest.mark.parametrize('formula', ['=Sheet2!A1', '=SUM(Scores)', '=XLOOKUP(1,A2:A4,B2:B4)', '=E3', '=E2+1'])
+    def test_unsupported(self, worksheet, formula):
+        worksheet['E2'] = formula
+        worksheet['E3'] = '=E2'
+        with pytest.raises(FormulaError):
+            evaluate_formulas(worksheet)
+
+    def test_write_cached_values(self, worksheet):
+        worksheet['E2'] = '=B2>5'
+        worksheet['F2'] = '=A2&"!"'
+        worksheet['G2'] = '=B2/0'
+        values = evaluate_formulas(worksheet)
+        output = BytesIO()
+        worksheet.parent.save(output)
+
+        file_bytes = write_cached_values(output.getvalue(), worksheet.path.lstrip('/'), values, worksheet.parent.epoch)
+        wb = load_workbook(BytesIO(file_bytes), data_only=True)
+        assert [cell.value for cell in wb.active[2]] == ['Ann', 10, 2, 12, True, 'Ann!', '#DIV/0!']
+        assert [cell.value for cell in wb.active['D']] == ['Total', 12, 20, 162]
+        # the formulas are kept
+        assert load_workbook(BytesIO(file_bytes)).active['D4'].value == '=D2+B4*C4'
@@ -0,0 +1,60 @@
+import threading
+import time
+
+from util.keyed_queue import KeyedQueue
+
+
+class TestKeyedQueue:
+
+    def test_same_key_serialized(self):
+        running, overlaps, handled = set(), [], []
+        lock = threading.Lock()
+        done = threading.Event()
+
+        def handler(key, items):
+            with lock:
+                if key in running:
+                    overlaps.append(key)
+                running.add(key)
+            time.sleep(0.05)
+            with lock:
+                running.discard(key)
+                handled.extend(items)
+                if len(handled) == 6:
+                    done.set()
+
+        queue = KeyedQueue(handler, max_workers=4, name='test-queue')
+        for i in range(6):
+            queue.put('file', i)
+        assert done.wait(5)
+        assert overlaps == []
+        assert handled == list(range(6))  # in order, with the items put while busy handled in one batch
+
+    def test_different_keys_parallel(self):
+        barrier = threading.Barrier(4, timeout=5)
+
+        def handler(key, items):
+            barrier.wait()  # only passes if all three keys are handled at once
+
+        queue = KeyedQueue(handler, max_workers=3, name='test-queue')
+        for key in ['a', 'b', 'c']:
+            queue.put(key, key)
+        barrier.wait()
+
+    def test_failed_batch(self):
+        handled = []
+        done = threading.Event()
+
+        def handler(key, items):
+            if items == ['bad']:
+                raise ValueError('bad item')
+            handled.extend(items)
+            done.set()
+
+        queue = KeyedQueue(handler, max_workers=1, name='test-queue')
+        queue.put('file', 'bad')
+        time.sleep(0.05)
+        queue.put('file', 'good')
+        assert done.wait(5)
+        assert handled == ['good']
+        assert queue.pending('file') == 0
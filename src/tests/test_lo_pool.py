@@ -0,0 +1,129 @@
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from unittest.mock import patch
+
+import pytest
+
+from util.lo_pool import RecalcPool, RecalcError
+from util.subprocess import open_close_excel
+
+FAKE_WORKER = [sys.executable, os.path.join(os.path.dirname(__file__), 'fake_recalc_worker.py')]
+
+
+@pytest.fixture(scope="function")
+def pool():
+    pool = RecalcPool(FAKE_WORKER, size=2, job_timeout=2, startup_timeout=10)
+    yield pool
+    pool.close()
+
+
+@pytest.fixture(scope="function")
+def temp_dir():
+    with tempfile.TemporaryDirectory() as temp_dir:
+        yield temp_dir
+
+
+def _pids(path: str) -> list:
+    with open(path) as file:
+        return [int(line) for line in file]
+
+
+def _is_running(pid: int) -> bool:
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    return True
+
+
+class TestRecalcPool:
+
+    def test_workers_are_reused(self, pool, temp_dir):
+        path = os.path.join(temp_dir, 'book.xlsx')
+        for _ in range(4):
+            pool.recalculate(path)
+        assert set(_pids(path)) <= {worker.process.pid for worker in pool.workers}
+        assert pool.summary() == {'size': 2, 'alive': 2, 'idle': 2, 'jobs': 4, 'restarts': 0}
+
+    def test_bounded_concurrency(self, pool, temp_dir):
+        paths = [os.path.join(temp_dir, f'book-{i}.xlsx') for i in range(6)]
+        started = time.monotonic()
+        threads = [threading.Thread(target=pool.recalculate, args=(path,)) for path in paths]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        # each job takes 0.2s, and only two run at once
+        assert time.monotonic() - started >= 0.6
+        assert len({pid for path in paths for pid in _pids(path)}) == 2
+
+    def test_crashed_worker_restarted(self, pool, temp_dir):
+        pool.start()
+        with pytest.raises(RecalcError):
+            pool.recalculate(os.path.join(temp_dir, 'crash.xlsx'))
+        assert pool.summary()['restarts'] == 1
+        assert pool.summary()['alive'] == 2
+        path = os.path.join(temp_dir, 'book.xlsx')
+        pool.recalculate(path)
+        pool.recalculate(path)
+        assert pool.summary()['jobs'] == 2
+
+    def test_hung_worker_restarted(self, temp_dir):
+        pool = RecalcPool(FAKE_WORKER, size=1, job_timeout=0.5, startup_timeout=10)
+        try:
+            pool.start()
+            pid = pool.workers[0].process.pid
+            with pytest.raises(RecalcError):
+                pool.recalculate(os.path.join(temp_dir, 'hang.xlsx'))
+            assert pool.workers[0].process.pid != pid
+            path = os.path.join(temp_dir, 'book.xlsx')
+            pool.recalculate(path)
+            assert _pids(path) == [pool.workers[0].process.pid]
+        finally:
+            pool.close()
+
+    def test_failed_job(self, pool, temp_dir):
+        with pytest.raises(RecalcError, match='Unable to load'):
+            pool.recalculate(os.path.join(temp_dir, 'error.xlsx'))
+        assert pool.summary()['restarts'] == 0
+
+    def test_health_check(self, pool):
+        pool.start()
+        pids = [worker.process.pid for worker in pool.workers]
+        pool.workers[0].process.kill()
+        pool.workers[0].process.wait()
+        pool.health_check()
+        assert pool.summary()['restarts'] == 1
+        assert pool.summary()['alive'] == 2
+        assert pool.workers[0].process.pid != pids[0]
+        assert pool.workers[1].process.pid == pids[1]
+
+    def test_open_close_uses_pool(self, pool, temp_dir):
+        path = os.path.join(temp_dir, 'book.xlsx')
+        with patch('util.subprocess.Config.LO_AVAILABLE', True), patch('util.subprocess.platform', 'linux'), \
+                patch('util.subprocess.get_recalc_pool', return_value=pool):
+            open_close_excel(path)
+            assert len(_pids(path)) == 1
+
+    def test_workers_exit_with_parent(self):
+        # the app worker is killed without closing its pool, as on a timeout
+        script = (
+            'import os, sys\n'
+            'from util.lo_pool import RecalcPool\n'
+            f'pool = RecalcPool({FAKE_WORKER!r}, size=2, job_timeout=2, startup_timeout=10)\n'
+            'pool.start()\n'
+            'print(*[worker.process.pid for worker in pool.workers], flush=True)\n'
+            'os._exit(1)\n'
+        )
+        parent = subprocess.run([sys.executable, '-c', script], capture_output=True, text=True, timeout=30,
+                                cwd=os.path.dirname(os.path.dirname(__file__)))
+        pids = [int(pid) for pid in parent.stdout.split()]
+        assert len(pids) == 2
+        deadline = time.monotonic() + 5
+        while any(_is_running(pid) for pid in pids) and time.monotonic() < deadline:
+            time.sleep(0.1)
+        assert not any(_is_running(pid) for pid in pids)
@@ -0,0 +1,140 @@
+import threading
+import time
+
+import pytest
+
+from util.LRU import LRUCache
+
+
+class TestLRUCache:
+
+    def test_single_flight(self):
+        cache = LRUCache(maxsize=2)
+        calls = []
+
+        @cache
+        def load(id_):
+            calls.append(id_)
+            time.sleep(0.05)
+            return {'id': id_}
+
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(load(id_='a'))) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        assert calls == ['a']
+        assert len(results) == 8 and all(result is results[0] for result in results)
+        summary = cache.summary()
+        assert summary['misses'] == 1
+        assert summary['hits'] + summary['waits'] == 7
+        assert summary['inflight'] == 0
+
+    def test_eviction(self):
+        cache = LRUCache(maxsize=2)
+        load = cache(lambda id_: id_.upper())
+        for id_ in ['a', 'b', 'a', 'c']:
+            load(id_=id_)
+        assert [key['id'] for key in cache.keys()] == ['a', 'c']
+        assert cache.summary()['hits'] == 1
+
+    def test_byte_budget(self):
+        cache = LRUCache(maxsize=10, maxbytes=100, sizeof=len)
+        load = cache(lambda id_: id_ * 40)
+        load(id_='a')
+        load(id_='b')
+        assert cache.keys() == [{'id': 'a', 'bytes': 40}, {'id': 'b', 'bytes': 40}]
+        assert cache.summary()['currbytes'] == 80
+
+        load(id_='c')
+        assert cache.keys() == [{'id': 'b', 'bytes': 40}, {'id': 'c', 'bytes': 40}]
+
+        cache.replace('x' * 150, id_='d')  # too big for the budget alone, but the newest entry is kept
+        assert cache.keys() == [{'id': 'd', 'bytes': 150}]
+        cache.remove(id_='d')
+        assert cache.summary()['currbytes'] == 0
+
+    def test_resize(self):
+        cache = LRUCache(maxsize=10, maxbytes=100, sizeof=len)
+        load = cache(lambda id_: [id_] * 40)
+        load(id_='a')
+        value = load(id_='b')
+        value.extend(['b'] * 40)  # grown since cached, e.g. by memoizing a rendered block
+        assert cache.summary()['currbytes'] == 80
+
+        cache.resize(id_='b')
+        assert cache.keys() == [{'id': 'b', 'bytes': 80}]
+        assert cache.summary()['currbytes'] == 80
+
+    def test_error_not_cached(self):
+        cache = LRUCache(maxsize=2)
+        attempts = []
+
+        @cache
+        def load(id_):
+            attempts.append(id_)
+            if len(attempts) == 1:
+                raise ValueError('failed')
+            return id_
+
+        with pytest.raises(ValueError):
+            load(id_='a')
+        assert load(id_='a') == 'a'
+        assert [key['id'] for key in cache.keys()] == ['a']
+
+    def test_remove_during_load(self):
+        cache = LRUCache(maxsize=2)
+        started = threading.Event()
+
+        @cache
+        def load(id_):
+            started.set()
+            time.sleep(0.05)
+            return 'stale'
+
+        thread = threading.Thread(target=lambda: load(id_='a'))
+        thread.start()
+        started.wait()
+        cache.remove(id_='a')
+        thread.join()
+        assert cache.keys() == []
+
+    def test_replace_generation(self):
+        cache = LRUCache(maxsize=2)
+        cache.replace('v1', id_='a')
+        generation = cache.generation(id_='a')
+
+        cache.replace('v2', id_='a')
+        assert not cache.replace('stale', generation=generation, id_='a')
+        assert cache.cache['a'] == 'v2'
+
+        generation = cache.generation(id_='a')
+        assert cache.replace('v3', generation=generation, id_='a')
+        assert cache.cache['a'] == 'v3'
+
+    def test_remove_generation(self):
+        cache = LRUCache(maxsize=2)
+        cache.replace('v1', id_='a')
+        generation = cache.generation(id_='a')
+        cache.replace('v2', id_='a')
+        assert not cache.remove(generation=generation, id_='a')
+        assert cache.cache['a'] == 'v2'
+        assert cache.remove(generation=cache.generation(id_='a'), id_='a')
+        assert cache.keys() == []
+
+    def test_generations_pruned(self):
+        cache = LRUCache(maxsize=2)
+        load = cache(lambda id_: id_.upper())
+        generation = cache.generation(id_='a')
+        for id_ in ['a', 'b', 'c', 'd']:
+            cache.replace(id_, id_=id_)
+            load(id_=id_)
+        cache.remove(id_='d')
+        assert set(cache.generations) == {'c'}
+
+        # a generation read before a key was dropped is never current again
+        load(id_='a')
+        assert not cache.replace('stale', generation=generation, id_='a')
+        assert cache.cache['a'] == 'A'
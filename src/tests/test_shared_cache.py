@@ -0,0 +1,108 @@
+import os
+import tempfile
+import threading
+from unittest.mock import patch
+
+import pytest
+
+from util.shared_cache import SharedLRUCache, SharedStore, SharedStoreError
+
+
+class TestSharedLRUCache:
+
+    @classmethod
+    def _worker_caches(cls, path, count=2):
+        """Caches as each gunicorn worker would have them, sharing one store file"""
+        caches, calls = [], []
+        for worker in range(count):
+            cache = SharedLRUCache(SharedStore(path), maxsize=10)
+            load = cache(lambda id_, worker=worker: calls.append((worker, id_)) or {'id': id_, 'version': len(calls)})
+            caches.append((cache, load))
+        return caches, calls
+
+    def test_loads_value_built_by_other_worker(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            (cache_a, load_a), (cache_b, load_b) = self._worker_caches(os.path.join(temp_dir, 'cache.db'))[0]
+            assert load_a(id_='f1') == {'id': 'f1', 'version': 1}
+            assert load_b(id_='f1') == {'id': 'f1', 'version': 1}
+            assert cache_b.summary()['sharedhits'] == 1
+            assert cache_b.summary()['sharedsize'] == 1
+
+    def test_invalidation_seen_by_all_workers(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            caches, calls = self._worker_caches(os.path.join(temp_dir, 'cache.db'))
+            (cache_a, load_a), (cache_b, load_b) = caches
+            load_a(id_='f1')
+            load_b(id_='f1')
+
+            cache_a.remove(id_='f1')
+            assert load_b(id_='f1') == {'id': 'f1', 'version': 2}  # rebuilt, not the stale local value
+            assert load_a(id_='f1') == {'id': 'f1', 'version': 2}
+            assert calls == [(0, 'f1'), (1, 'f1')]
+
+            cache_b.replace({'id': 'f1', 'version': 'new'}, id_='f1')
+            assert load_a(id_='f1') == {'id': 'f1', 'version': 'new'}
+
+            generation = cache_a.generation(id_='f1')
+            cache_b.clear()
+            assert not cache_a.replace('stale', generation=generation, id_='f1')
+            assert load_a(id_='f1') == {'id': 'f1', 'version': 3}
+
+            generation = cache_a.generation(id_='f1')
+            cache_b.replace({'id': 'f1', 'version': 'newer'}, id_='f1')
+            assert not cache_a.remove(generation=generation, id_='f1')  # a failed rebuild keeps the newer value
+            assert load_a(id_='f1') == {'id': 'f1', 'version': 'newer'}
+
+    def test_store_read_outside_lock(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            (cache, load), = self._worker_caches(os.path.join(temp_dir, 'cache.db'), count=1)[0]
+            load(id_='f1')
+            load(id_='f2')
+
+            reading, release = threading.Event(), threading.Event()
+            generation = cache.store.generation
+
+            def slow_generation(key):
+                if key == 'f2':
+                    reading.set()
+                    release.wait(5)
+                return generation(key)
+
+            with patch.object(cache.store, 'generation', side_effect=slow_generation):
+                thread = threading.Thread(target=load, kwargs={'id_': 'f2'})
+                thread.start()
+                assert reading.wait(5)
+                assert load(id_='f1') == {'id': 'f1', 'version': 1}
+                assert thread.is_alive()  # the hit wasn't held up by the read for f2
+                release.set()
+                thread.join()
+            assert cache.summary()['hits'] == 2
+
+    def test_store_private(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            path = os.path.join(temp_dir, 'cache.db')
+            SharedStore(path)
+            assert os.stat(path).st_mode & 0o777 == 0o600
+
+            os.chmod(path, 0o666)
+            SharedStore(path)
+            assert os.stat(path).st_mode & 0o777 == 0o600
+
+            # a store created by another user could hold anything to unpickle
+            with patch('os.getuid', return_value=os.getuid() + 1):
+                with pytest.raises(SharedStoreError, match='not owned by the user running the app'):
+                    SharedStore(path)
+
+    def test_store_evicts_oldest(self):
+        with tempfile.TemporaryDirectory() as temp_dir:
+            store = SharedStore(os.path.join(temp_dir, 'cache.db'), max_bytes=250)
+            for key in ['f1', 'f2', 'f3']:
+                store.save(key, 0, bytes(100))
+            assert store.summary() == {'sharedsize': 2, 'sharedbytes': 200}
+            assert store.load('f1', 0) is None
+            assert store.load('f3', 0) is not None
+
+            store.replace('f2', bytes(100))  # saved most recently, so f3 is evicted next
+            store.save('f4', 0, bytes(100))
+            assert store.load('f3', 0) is None
+            assert store.load('f2', 1) is not None
@@ -0,0 +1,21 @@
+from datetime import date, datetime, timedelta, timezone
+
+from util.snapshot import SnapshotBuilder
+from util.sorting import column_ranks, sort_key
+
+
+class TestSorting:
+
+    def test_mixed_dates(self):
+        # a column can hold dates and datetimes, with or without a timezone, which don't compare with each other
+        values = [
+            datetime(2023, 4, 14, 12), date(2023, 4, 14), None, datetime(2023, 4, 13, 23, tzinfo=timezone.utc),
+            datetime(2023, 4, 14, 9, tzinfo=timezone(timedelta(hours=10))), 'text', 7
+        ]
+        builder = SnapshotBuilder(['When'], ['A'])
+        for value in values:
+            builder.append([value])
+        snapshot = builder.build({'When': 'n'})
+
+        assert list(column_ranks(snapshot, 0)) == [4, 3, 0, 2, 2, 5, 1]
+        assert sort_key(date(2023, 4, 14), 'd') == sort_key('14/04/2023', 'd')
@@ -1,7 +1,15 @@
+import socket
 from copy import copy
+from unittest.mock import patch
 
+from database import db
+from database.models import ApplyJob, Transaction, Change, File
+from enums import ApprovalStatus, ChangeType, JobStatus
+from services import ApplyJobService
+from services.file_data import FileDataService
 from tests.conftest import get_results
 from tests.util import mask_values
+from util.xlsx_patch import SheetPatch
 
 
 class TestTransactions:
@@ -16,30 +24,27 @@ class TestTransactions:
     ]
     change_masks = [('id', '<<changeId>>')]
 
+    create_change = {
+        'changeType': 'create',
+        'rowNumber': '6',
+        'after': {
+            'Age': '40',
+            'Average': None,
+            'Date Entered': '14/04/2023',
+            'First Name': 'Steve',
+            'Intelligence': '85',
+            'Last Name': 'Rogers',
+            'Speed': '75',
+            'Strength': '90'
+        },
+        'before': None
+    }
+
     @classmethod
     def _add_transaction(cls, client, file_id):
-        transaction_data = {
-            'fileId': file_id,
-            'changes': [
-                {
-                    'changeType': 'create',
-                    'rowNumber': '6',
-                    'after': {
-                        'Age': '40',
-                        'Average': None,
-                        'Date Entered': '14/04/2023',
-                        'First Name': 'Steve',
-                        'Intelligence': '85',
-                        'Last Name': 'Rogers',
-                        'Speed': '75',
-                        'Strength': '90'
-                    },
-                    'before': None
-                }
-            ]
-        }
+        transaction_data = {'fileId': file_id, 'changes': [cls.create_change]}
         response = client.post("/transactions", json=transaction_data)
-        assert response.status_code == 200
+        assert response.status_code == 202
         return response.json
 
     def test_get_transactions(self, client, test_file):
@@ -98,13 +103,17 @@ class TestTransactions:
             ]
         }
         response = client.post("/transactions", json=transaction_data)
-        assert response.status_code == 200
-        masked_response = mask_values(response.json, self.masks)
+        assert response.status_code == 202
+        transaction = response.json
+        job = transaction.pop('job')
+        assert job['transactionId'] == transaction['id']
+        assert job['status'] == 'DONE'
+        masked_response = mask_values(transaction, self.masks)
         masked_response['changes'] = [mask_values(c, self.change_masks) for c in masked_response['changes']]
         assert masked_response == get_results('transaction.json')
 
-        # when transaction is approved, 'file_data.apply_changes' is called which in turn calls 'open_close_excel'
-        mock_open_close_excel.assert_called_once()
+        # when transaction is approved, 'file_data.apply_changes' evaluates the formulas without 'open_close_excel'
+        mock_open_close_excel.assert_not_called()
 
         invalid_data = copy(transaction_data)
         invalid_data.pop('fileId')
@@ -118,9 +127,8 @@ class TestTransactions:
         assert response.status_code == 400
         assert response.json == {'message': 'changes not found in request'}
 
-    def test_update_transactions(self, client, test_file, mock_open_close_excel):
-        transaction = self._add_transaction(client, test_file['id'])
-        transaction_id = transaction['id']
+    def test_update_transactions(self, client, test_file, test_user, mock_open_close_excel):
+        transaction_id = self._add_pending_transaction(test_file['id'], test_user['id'], self.create_change)
 
         update_data = {
             'fileId': test_file['id'],
@@ -129,16 +137,24 @@ class TestTransactions:
         }
 
         response = client.put("/transactions", query_string={'id': transaction_id}, json=update_data)
-        assert response.status_code == 200
-        masked_response = mask_values(response.json, self.masks)
+        assert response.status_code == 202
+        transaction = response.json
+        assert transaction.pop('job')['status'] == 'DONE'
+        masked_response = mask_values(transaction, self.masks)
         masked_response['changes'] = [mask_values(c, self.change_masks) for c in masked_response['changes']]
         expected_results = get_results('transaction.json')
         expected_results['notes'] = 'Test'
         expected_results['status'] = 'APPROVED'
         assert masked_response == expected_results
 
-        # when transaction is approved, 'file_data.apply_changes' is called which in turn calls 'open_close_excel'
-        mock_open_close_excel.assert_called()
+        # when transaction is approved, 'file_data.apply_changes' evaluates the formulas without 'open_close_excel'
+        mock_open_close_excel.assert_not_called()
+        assert transaction['approvedAt'] is not None
+
+        # approving it again would apply its changes twice, as for a bulk approval
+        response = client.put("/transactions", query_string={'id': transaction_id}, json=update_data)
+        assert response.status_code == 400
+        assert response.json == {'message': f"Transactions ['{transaction_id}'] already approved"}
 
         response = client.put("/transactions", json=update_data)
         assert response.status_code == 400
@@ -156,6 +172,208 @@ class TestTransactions:
         assert response.status_code == 400
         assert response.json == {'message': 'status not found in request'}
 
+    @classmethod
+    def _add_pending_transaction(cls, file_id: str, user_id: str, change: dict) -> str:
+        session = db.get_session()
+        transaction = Transaction(
+            file_id=file_id,
+            user_id=user_id,
+            status=ApprovalStatus.PENDING,
+            changes=[
+                Change(
+                    change_type=ChangeType(change['changeType']),
+                    row_number=change['rowNumber'],
+                    before=change.get('before'),
+                    after=change.get('after')
+                )
+            ]
+        )
+        session.add(transaction)
+        session.commit()
+        transaction_id = transaction.id
+        session.close()
+        return transaction_id
+
+    @classmethod
+    def _get_file_version(cls, file_id: str) -> int:
+        session = db.get_session()
+        version = session.query(File.version).filter_by(id=file_id).scalar()
+        session.close()
+        return version
+
+    def test_approve_transactions(self, client, test_file, test_user):
+        file_id = test_file['id']
+        response = client.get("/files/data", query_string={'id': file_id})
+        bruce = {k: v for k, v in response.json['rowData'][0].items() if k != '_rowNumber'}
+        steve = {
+            'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+            'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+        }
+        changes = [
+            {'changeType': 'create', 'rowNumber': 5, 'after': steve},
+            {'changeType': 'update', 'rowNumber': 1, 'before': bruce, 'after': {**bruce, 'Strength': 100}},
+            {'changeType': 'delete', 'rowNumber': 5, 'before': steve},
+            {'changeType': 'create', 'rowNumber': 5, 'after': {**steve, 'First Name': 'Peter', 'Last Name': 'Parker'}},
+        ]
+        ids = [self._add_pending_transaction(file_id, test_user['id'], change) for change in changes]
+        version = self._get_file_version(file_id)
+
+        response = client.put("/transactions/approve", json={'fileId': file_id, 'ids': ids})
+        assert response.status_code == 202
+        # applied in the order given, in a single rewrite of the file
+        assert [t['id'] for t in response.json] == ids
+        assert {(t['status'], t['job']['status']) for t in response.json} == {('APPROVED', 'DONE')}
+        assert all(t['approvedAt'] is not None for t in response.json)
+        assert self._get_file_version(file_id) == version + 1
+
+        response = client.get("/files/data", query_string={'id': file_id})
+        rows = response.json['rowData']
+        assert [(row['First Name'], row['Strength']) for row in rows] == [
+            ('Bruce', 100), ('Peter', 70), ('Tony', 50), ('Natasha', 45), ('Peter', 90)
+        ]
+
+        response = client.put("/transactions/approve", json={'fileId': file_id, 'ids': ids[:1]})
+        assert response.status_code == 400
+        response = client.put("/transactions/approve", json={'fileId': file_id, 'ids': ['missing']})
+        assert response.status_code == 404
+        response = client.put("/transactions/approve", json={'fileId': file_id})
+        assert response.status_code == 400
+        assert response.json == {'message': 'ids not found in request'}
+
+    def test_approve_transactions_failed(self, client, test_file, test_user):
+        file_id = test_file['id']
+        row = {
+            'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+            'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+        }
+        changes = [
+            {'changeType': 'create', 'rowNumber': 5, 'after': row},
+            {'changeType': 'create', 'rowNumber': 5, 'after': {'Age': '40'}},
+            {'changeType': 'create', 'rowNumber': 6, 'after': {**row, 'First Name': 'Peter'}},
+        ]
+        ids = [self._add_pending_transaction(file_id, test_user['id'], change) for change in changes]
+        version = self._get_file_version(file_id)
+
+        # the transactions are applied one at a time if they can't be together, so only the invalid one fails
+        with patch.object(SheetPatch, 'save', autospec=True, side_effect=SheetPatch.save) as save:
+            response = client.put("/transactions/approve", json={'fileId': file_id, 'ids': ids})
+        assert response.status_code == 202
+        # test.xlsx has a calculation chain, so the first is rewritten by openpyxl and only the last patched
+        save.assert_called_once()
+        assert [t['job']['status'] for t in response.json] == ['DONE', 'FAILED', 'DONE']
+        assert self._get_file_version(file_id) == version + 2
+
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert [row['First Name'] for row in response.json['rowData']][-2:] == ['Steve', 'Peter']
+
+    def test_apply_jobs(self, client, test_file, test_user):
+        file_id = test_file['id']
+        transaction = self._add_transaction(client, file_id)
+        pending_id = self._add_pending_transaction(file_id, test_user['id'], self.create_change)
+        update_data = {'fileId': file_id, 'status': 'APPROVED'}
+        response = client.put("/transactions", query_string={'id': pending_id}, json=update_data)
+        assert response.status_code == 202
+
+        response = client.get("/transactions/jobs", query_string={'fileId': file_id})
+        assert response.status_code == 200
+        assert [job['id'] for job in response.json] == [transaction['job']['id'], response.json[1]['id']]
+        assert {job['status'] for job in response.json} == {'DONE'}
+
+        job_id = transaction['job']['id']
+        response = client.get("/transactions/jobs", query_string={'fileId': file_id, 'id': job_id})
+        assert response.status_code == 200
+        assert response.json['transactionId'] == transaction['id']
+        assert response.json['startedAt'] and response.json['finishedAt']
+
+        # changes that can't be applied fail the job, rather than the request
+        invalid_data = {
+            'fileId': file_id,
+            'changes': [{'changeType': 'create', 'rowNumber': 6, 'after': {'Age': '40'}, 'before': None}]
+        }
+        response = client.post("/transactions", json=invalid_data)
+        assert response.status_code == 202
+        assert response.json['job']['status'] == 'FAILED'
+        assert "Column 'First Name' not found" in response.json['job']['error']
+
+        response = client.get("/transactions/jobs", query_string={'fileId': file_id, 'id': 'missing'})
+        assert response.status_code == 404
+
+        response = client.get("/transactions/jobs", query_string={'id': job_id})
+        assert response.status_code == 400
+        assert response.json == {'message': 'file id not found in request'}
+
+    def test_apply_jobs_concurrent(self, client, test_file, test_user):
+        file_id = test_file['id']
+        row = {
+            'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+            'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+        }
+        changes = [
+            {'changeType': 'create', 'rowNumber': 5, 'after': after} for after in [row, {**row, 'First Name': 'Peter'}]
+        ]
+        ids = [self._add_pending_transaction(file_id, test_user['id'], change) for change in changes]
+        session = db.get_session()
+        jobs = [
+            ApplyJob(file_id=file_id, transaction_id=id_, status=JobStatus.QUEUED, worker=ApplyJobService._worker())
+            for id_ in ids
+        ]
+        session.add_all(jobs)
+        session.commit()
+        job_ids = [job.id for job in jobs]
+        session.close()
+        version = self._get_file_version(file_id)
+
+        # another worker applies the second job while the first is being applied, so the first is applied again
+        apply_changes = FileDataService.apply_changes
+        calls = []
+
+        def apply_changes_concurrently(file, *change_sets):
+            calls.append(file.version)
+            if len(calls) == 1:
+                ApplyJobService._run(file_id, job_ids[1:])
+            return apply_changes(file, *change_sets)
+
+        with patch.object(FileDataService, 'apply_changes', side_effect=apply_changes_concurrently):
+            ApplyJobService._run(file_id, job_ids[:1])
+        assert calls == [version, version, version + 1]
+        assert self._get_file_version(file_id) == version + 2
+
+        response = client.get("/transactions/jobs", query_string={'fileId': file_id})
+        assert [job['status'] for job in response.json] == ['DONE', 'DONE']
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert [row['First Name'] for row in response.json['rowData']][-2:] == ['Peter', 'Steve']
+
+    def test_apply_jobs_released(self, client, test_file, test_user):
+        file_id = test_file['id']
+        row = {
+            'Age': '40', 'Average': None, 'Date Entered': '14/04/2023', 'First Name': 'Steve', 'Intelligence': '85',
+            'Last Name': 'Rogers', 'Speed': '75', 'Strength': '90'
+        }
+        changes = [
+            {'changeType': 'create', 'rowNumber': 5, 'after': after} for after in [row, {**row, 'First Name': 'Peter'}]
+        ]
+        ids = [self._add_pending_transaction(file_id, test_user['id'], change) for change in changes]
+        # jobs of a worker which exited while running one and with another queued, and of a worker still running
+        host = socket.gethostname()
+        session = db.get_session()
+        session.add_all([
+            ApplyJob(file_id=file_id, transaction_id=ids[0], status=JobStatus.RUNNING, worker=f'{host}:-1'),
+            ApplyJob(file_id=file_id, transaction_id=ids[1], status=JobStatus.QUEUED, worker=f'{host}:-1'),
+            ApplyJob(file_id=file_id, transaction_id=ids[1], status=JobStatus.QUEUED, worker=f'{host}:-2'),
+        ])
+        session.commit()
+        session.close()
+
+        assert ApplyJobService.release(-1) == 2
+        assert ApplyJobService.resume() == 2
+        response = client.get("/transactions/jobs", query_string={'fileId': file_id})
+        assert [job['status'] for job in response.json] == ['DONE', 'DONE', 'QUEUED']
+        response = client.get("/files/data", query_string={'id': file_id})
+        assert [row['First Name'] for row in response.json['rowData']][-2:] == ['Steve', 'Peter']
+
+        assert ApplyJobService.release() == 1  # when the server starts, none of its workers are running
+        assert ApplyJobService.resume() == 1
+
     def test_delete_transactions(self, client, test_file):
         transaction = self._add_transaction(client, test_file['id'])
         transaction_id = transaction['id']
@@ -0,0 +1,119 @@
+import re
+import zipfile
+from datetime import datetime
+from io import BytesIO
+
+import pytest
+from openpyxl import Workbook, load_workbook
+
+from database.models import Change
+from enums import ChangeType
+from services.file_data import FileDataService
+from tests.conftest import get_file_bytes, TEST_EXCEL
+from util.xlsx_patch import SheetPatch, XlsxPatchError
+from util.xlsx_reader import XlsxReader
+
+DATA_TYPES = {
+    'First Name': 's', 'Last Name': 's', 'Age': 'n', 'Strength': 'n', 'Speed': 'n', 'Intelligence': 'n',
+    'Average': 'f', 'Date Entered': 'd'
+}
+STEVE = {
+    'First Name': 'Steve', 'Last Name': 'Rogers', 'Age': '40', 'Strength': '90', 'Speed': '75', 'Intelligence': '85',
+    'Average': None, 'Date Entered': '14/04/2023'
+}
+
+
+def _rewrite(file_bytes: bytes, change_sets: list) -> bytes:
+    wb = load_workbook(BytesIO(file_bytes))
+    FileDataService._apply_to_sheet(wb.active, DATA_TYPES, change_sets)
+    return FileDataService._convert_to_bytes(wb, 'test.xlsx')
+
+
+def _patch(file_bytes: bytes, change_sets: list) -> bytes:
+    ws = SheetPatch(file_bytes)
+    FileDataService._apply_to_sheet(ws, DATA_TYPES, change_sets)
+    return ws.save()
+
+
+def _rows(file_bytes: bytes) -> list:
+    return list(XlsxReader(file_bytes).iter_rows(with_types=True))
+
+
+def _row_dict(file_bytes: bytes, row_number: int) -> dict:
+    rows = list(XlsxReader(file_bytes).iter_rows())
+    row = dict(zip(rows[0], rows[row_number]))
+    row['Date Entered'] = row['Date Entered'].strftime('%d/%m/%Y')
+    return {key: None if value is None else str(value) for key, value in row.items()}
+
+
+@pytest.fixture(scope="module")
+def workbook():
+    # the original is saved by Excel with shared formulas and a calcChain, so is rewritten by openpyxl once first
+    return _rewrite(get_file_bytes(TEST_EXCEL), [[Change(change_type=ChangeType.CREATE, row_number=5, after=STEVE)]])
+
+
+class TestXlsxPatch:
+
+    def test_same_as_rewrite(self, workbook):
+        bruce, tony = _row_dict(workbook, 1), _row_dict(workbook, 3)
+        change_sets = [
+            [
+                Change(change_type=ChangeType.DELETE, row_number=3, before=tony),
+                Change(change_type=ChangeType.UPDATE, row_number=1, before=bruce,
+                       after={**bruce, 'Strength': '100', 'First Name': 'Bruce & <Co>', 'Date Entered': '01/02/2024'})
+            ],
+            [Change(change_type=ChangeType.CREATE, row_number=5, after=STEVE)]
+        ]
+        patched = _patch(workbook, change_sets)
+        assert _rows(patched) == _rows(_rewrite(workbook, change_sets))
+        assert _rows(patched)[1][0][:4] == ['Bruce & <Co>', 'Banner', 45, 100]
+        assert _rows(patched)[5][0][6] == 83.33333333333333  # recalculated average of the new row
+
+        number_formats = [
+            [cell.number_format for cell in row] for row in load_workbook(BytesIO(patched)).active.iter_rows()
+        ]
+        assert number_formats == [
+            [cell.number_format for cell in row]
+            for row in load_workbook(BytesIO(_rewrite(workbook, change_sets))).active.iter_rows()
+        ]
+
+    def test_other_parts_unchanged(self, workbook):
+        change_sets = [[Change(change_type=ChangeType.CREATE, row_number=6, after=STEVE)]]
+        patched = _patch(workbook, change_sets)
+        with zipfile.ZipFile(BytesIO(workbook)) as before, zipfile.ZipFile(BytesIO(patched)) as after:
+            assert before.namelist() == after.namelist()
+            sheet_path = XlsxReader(workbook).sheet_path
+            for name in before.namelist():
+                if name != sheet_path:
+                    assert before.read(name) == after.read(name), name
+
+    def test_untouched_rows_copied(self, workbook):
+        sheet_path = XlsxReader(workbook).sheet_path
+        original = zipfile.ZipFile(BytesIO(workbook)).read(sheet_path).decode()
+        patched = _patch(workbook, [[Change(change_type=ChangeType.CREATE, row_number=6, after=STEVE)]])
+        sheet = zipfile.ZipFile(BytesIO(patched)).read(sheet_path).decode()
+        first_rows = original[original.index('<row '):original.index('<row r="5"')]
+        assert first_rows in sheet
+        assert re.search(r'<dimension ref="A1:H7"\s*/>', sheet)
+
+    def test_unsupported(self, workbook):
+        with pytest.raises(XlsxPatchError, match='calculation chain'):
+            SheetPatch(get_file_bytes(TEST_EXCEL))
+
+        wb = load_workbook(BytesIO(workbook))
+        wb.active.merge_cells('A2:B2')
+        merged = FileDataService._convert_to_bytes(wb, 'test.xlsx')
+        with pytest.raises(XlsxPatchError, match='mergeCells'):
+            SheetPatch(merged)
+
+    def test_missing_date_format(self):
+        wb = Workbook()
+        wb.active.append(['Name', 'Date Entered'])
+        wb.active.append(['Bruce', datetime(2023, 4, 14)])
+        wb.active['B2'].number_format = 'yyyy-mm-dd'  # so there's no cell format with the date style to reuse
+        ws = SheetPatch(FileDataService._convert_to_bytes(wb, 'test.xlsx'))
+        after = {'Name': 'Steve', 'Date Entered': '14/04/2023'}
+        change = Change(change_type=ChangeType.CREATE, row_number=2, after=after)
+        FileDataService._apply_to_sheet(ws, {'Name': 's', 'Date Entered': 'd'}, [[change]])
+        with pytest.raises(XlsxPatchError, match='number format'):
+            ws.save()
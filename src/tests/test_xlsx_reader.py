@@ -0,0 +1,28 @@
+import io
+
+import pytest
+from openpyxl import load_workbook
+
+from tests.conftest import get_file_bytes, TEST_EXCEL, TEST_LOOKUP_EXCEL, TEST_TXT
+from util.xlsx_reader import XlsxReader, XlsxReaderError
+
+
+class TestXlsxReader:
+
+    @pytest.mark.parametrize('filename', [TEST_EXCEL, TEST_LOOKUP_EXCEL])
+    def test_matches_openpyxl(self, filename):
+        file_bytes = get_file_bytes(filename)
+        wb = load_workbook(io.BytesIO(file_bytes), read_only=True, data_only=True)
+        expected = [list(row) for row in wb.active.values]
+        assert list(XlsxReader(file_bytes).iter_rows()) == expected
+
+    def test_data_types(self):
+        rows = XlsxReader(get_file_bytes(TEST_EXCEL)).iter_rows(with_types=True)
+        next(rows)
+        values, types = next(rows)
+        assert types == ['s', 's', 'n', 'n', 'n', 'n', 'f', 'd']
+        assert values[6] == 76.33333333333333
+
+    def test_invalid_file(self):
+        with pytest.raises(XlsxReaderError):
+            XlsxReader(get_file_bytes(TEST_TXT))
@@ -1,60 +1,218 @@
 import functools
+import sys
+import threading
 from collections import OrderedDict
-from typing import List
+from typing import List, Callable
+
+
+class _Flight:
+    """A value being computed for a key, which other threads missing on the same key wait for"""
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
 
 
 class LRUCache:
+    """
+    Thread-safe LRU cache decorator. Concurrent misses on the same key are single-flight: one thread computes
+    the value and the others wait for it, rather than every thread e.g. parsing the same workbook.
+    Entries are evicted when there are more than maxsize of them, or when their total size from sizeof is over
+    maxbytes. The most recently used entry is always kept, even if it alone is over maxbytes.
+    """
 
-    def __init__(self, maxsize: int):
+    def __init__(self, maxsize: int, maxbytes: int = None, sizeof: Callable = sys.getsizeof):
         self.cache = OrderedDict()
+        self.sizes = {}
         self.maxsize = maxsize
+        self.maxbytes = maxbytes
+        self.sizeof = sizeof
+        self.currbytes = 0
+        # generations of keys from a counter across keys, only held while a key is cached or being computed, and
+        # the floor which other keys are at, raised as keys are dropped so a generation read before is never reused
+        self.generations = {}
+        self._counter = 0
+        self._floor = 0
         self.hits = 0
         self.misses = 0
+        self.waits = 0
+        self._lock = threading.RLock()
+        self._flights = {}
 
     def __call__(self, func):
         @functools.wraps(func)
         def wrapper(*args, **kwargs):
             key = self._generate_key(*args, **kwargs)
-            cache = self.cache
-            if key in cache:
-                cache.move_to_end(key)
-                self.hits += 1
-                return cache[key]
-            result = func(*args, **kwargs)
-            cache[key] = result
-            if len(cache) > self.maxsize:
-                cache.popitem(last=False)
-            self.misses += 1
-            return result
+            self._sync(key)
+            with self._lock:
+                cache = self.cache
+                if key in cache:
+                    cache.move_to_end(key)
+                    self.hits += 1
+                    # entries can grow once cached, e.g. snapshots memoizing rendered blocks
+                    self._resize(key)
+                    return cache[key]
+                flight = self._flights.get(key)
+                if flight is None:
+                    flight = self._flights[key] = _Flight()
+                    self.generations.setdefault(key, self._floor)
+                    self.misses += 1
+                    leader = True
+                else:
+                    self.waits += 1
+                    leader = False
+
+            if not leader:
+                flight.done.wait()
+                if flight.error is not None:
+                    raise flight.error
+                return flight.result
+
+            try:
+                flight.result = self._compute(key, func, *args, **kwargs)
+            except BaseException as e:
+                flight.error = e
+                raise
+            finally:
+                with self._lock:
+                    # a remove or replace while computing drops the flight, so a stale result is not cached
+                    if self._flights.get(key) is flight:
+                        del self._flights[key]
+                        if flight.error is None:
+                            self._store(key, flight.result)
+                        elif key not in self.cache:
+                            self._forget(key)
+                flight.done.set()
+            return flight.result
         return wrapper
 
-    def remove(self, *args, **kwargs) -> bool:
+    def peek(self, *args, **kwargs):
+        """Get a cached value without computing it if missing, or counting it as a use"""
+        key = self._generate_key(*args, **kwargs)
+        self._sync(key)
+        with self._lock:
+            return self.cache.get(key)
+
+    def remove(self, *args, generation: int = None, **kwargs) -> bool:
+        """
+        Drop the value for the key. If a generation is given, it is only dropped if the key has not been replaced or
+        removed since that generation was read, so a failed rebuild can't drop a newer value.
+        """
+        key = self._generate_key(*args, **kwargs)
+        with self._lock:
+            if generation is not None and self._generation(key) != generation:
+                return False
+            self._flights.pop(key, None)
+            self._bump_generation(key)
+            if key in self.cache:
+                self._pop(key)
+                return True
+            self._forget(key)
+            return False
+
+    def replace(self, value, *args, generation: int = None, **kwargs) -> bool:
+        """
+        Store a value for the key. If a generation is given, the value is only stored if the key has not been
+        replaced or removed since that generation was read, so a slow rebuild can't overwrite a newer value.
+        """
         key = self._generate_key(*args, **kwargs)
-        if key in self.cache:
-            self.cache.pop(key)
+        with self._lock:
+            if generation is not None and self._generation(key) != generation:
+                return False
+            self._flights.pop(key, None)
+            self._bump_generation(key)
+            self._store(key, value)
             return True
-        return False
 
-    def replace(self, value, *args, **kwargs):
+    def resize(self, *args, **kwargs):
+        """Measure a cached value again after it has grown, e.g. by memoizing values derived from it, evicting to fit"""
         key = self._generate_key(*args, **kwargs)
-        self.cache[key] = value
+        with self._lock:
+            if key in self.cache:
+                self._resize(key)
+
+    def generation(self, *args, **kwargs) -> int:
+        key = self._generate_key(*args, **kwargs)
+        with self._lock:
+            return self._generation(key)
 
     def clear(self) -> bool:
-        self.cache.clear()
-        self.hits = 0
-        self.misses = 0
+        with self._lock:
+            self.cache.clear()
+            self.sizes.clear()
+            self.currbytes = 0
+            self._flights.clear()
+            self.generations.clear()
+            self._counter += 1
+            self._floor = self._counter
+            self.hits = 0
+            self.misses = 0
+            self.waits = 0
         return True
 
-    def keys(self) -> List[str]:
-        return list(self.cache.keys())
+    def keys(self) -> List[dict]:
+        """Cached keys from least to most recently used, with the bytes held by each"""
+        with self._lock:
+            return [{'id': key, 'bytes': self.sizes[key]} for key in self.cache]
 
     def summary(self) -> dict:
-        return {
-            'currsize': len(self.cache),
-            'maxsize': self.maxsize,
-            'hits': self.hits,
-            'misses': self.misses
-        }
+        with self._lock:
+            return {
+                'currsize': len(self.cache),
+                'maxsize': self.maxsize,
+                'currbytes': self.currbytes,
+                'maxbytes': self.maxbytes,
+                'hits': self.hits,
+                'misses': self.misses,
+                'waits': self.waits,
+                'inflight': len(self._flights)
+            }
+
+    def _sync(self, key):
+        """
+        Drop the cached value if it has been invalidated elsewhere, for subclasses where it can be. Called without
+        holding the lock, so any I/O to find out doesn't hold up other threads.
+        """
+        pass
+
+    def _compute(self, key, func: Callable, *args, **kwargs):
+        """Get the value for a missing key, for subclasses to load it from elsewhere first"""
+        return func(*args, **kwargs)
+
+    def _store(self, key, value):
+        self.generations.setdefault(key, self._floor)
+        self.cache[key] = value
+        self.cache.move_to_end(key)
+        self._resize(key)
+
+    def _resize(self, key):
+        size = self.sizeof(self.cache[key])
+        self.currbytes += size - self.sizes.get(key, 0)
+        self.sizes[key] = size
+        while len(self.cache) > 1 and (
+            len(self.cache) > self.maxsize or (self.maxbytes is not None and self.currbytes > self.maxbytes)
+        ):
+            self._pop(next(iter(self.cache)))
+
+    def _generation(self, key) -> int:
+        return self.generations.get(key, self._floor)
+
+    def _bump_generation(self, key):
+        self._counter += 1
+        self.generations[key] = self._counter
+
+    def _forget(self, key):
+        """Drop the generation of a key, which is then at the floor, at or past any generation it had"""
+        if key in self._flights:
+            return
+        self.generations.pop(key, None)
+        self._floor = self._counter
+
+    def _pop(self, key):
+        self.cache.pop(key)
+        self.currbytes -= self.sizes.pop(key)
+        self._forget(key)
 
     def _generate_key(*args, **kwargs):
         id_ = kwargs.pop('id_')
@@ -0,0 +1,92 @@
+import json
+from array import array
+from datetime import datetime
+
+try:
+    import pyarrow
+    import pyarrow.compute
+    import pyarrow.ipc
+except ImportError:  # pyarrow is optional, the arrow format is unavailable without it
+    pyarrow = None
+
+from constants import DATE_FORMAT
+from util.snapshot import FileSnapshot, NumberColumn, PackedStrings, BLANK
+
+ARROW_STREAM_MIMETYPE = 'application/vnd.apache.arrow.stream'
+
+
+def to_arrow_stream(snapshot: FileSnapshot, indexes: array = None, start: int = 0, end: int = None) -> bytes:
+    """
+    Encode the snapshot, or the rows at the given indexes, from start to end as an Arrow IPC stream with a
+    '_rowNumber' column and a column per header. The row count before start/end is in the schema metadata.
+    Columns are built from the snapshot's arrays and dictionaries rather than row by row: numeric columns are
+    float64, or int64 if they only hold ints, date columns are date32 and text columns are dictionary encoded
+    strings. Blank cells are nulls. The file data types are kept in the schema metadata.
+    """
+    row_numbers = pyarrow.array(range(1, snapshot.row_count + 1), pyarrow.int32())
+    columns = [row_numbers] + [
+        _to_arrow_array(column, snapshot.data_types.get(header))
+        for header, column in zip(snapshot.headers, snapshot.columns)
+    ]
+    table = pyarrow.table(columns, names=[str(field) for field in snapshot.fields])
+    if indexes is not None:
+        table = table.take(_uint32_array(indexes))
+    row_count = table.num_rows
+    end = row_count if end is None else end
+    table = table.slice(start, max(end - start, 0)).replace_schema_metadata({
+        'data_types': json.dumps(snapshot.data_types),
+        'rowCount': str(row_count)
+    })
+
+    sink = pyarrow.BufferOutputStream()
+    with pyarrow.ipc.new_stream(sink, table.schema) as writer:
+        writer.write_table(table)
+    return sink.getvalue().to_pybytes()
+
+
+def _uint32_array(values: array):
+    return pyarrow.Array.from_buffers(pyarrow.uint32(), len(values), [None, pyarrow.py_buffer(values)])
+
+
+def _to_arrow_array(column, data_type: str):
+    if isinstance(column, NumberColumn):
+        return _number_array(column)
+
+    indices = _uint32_array(column.codes)
+    indices = pyarrow.compute.if_else(pyarrow.compute.equal(indices, 0), None, indices)  # code 0 is a blank cell
+    indices = indices.cast(pyarrow.int32())
+
+    if data_type == 'd':
+        dictionary = pyarrow.array([_parse_date(value) for value in column.values], pyarrow.date32())
+        return dictionary.take(indices)
+
+    if isinstance(column.values, PackedStrings):
+        values = column.values
+        dictionary = pyarrow.LargeStringArray.from_buffers(
+            len(values), pyarrow.py_buffer(values.offsets), pyarrow.py_buffer(values.buffer)
+        )
+    else:
+        # mixed value types, e.g. a number column with some text cells, are sent as text
+        dictionary = pyarrow.array([str(value) for value in column.values], pyarrow.large_string())
+    return pyarrow.DictionaryArray.from_arrays(indices, dictionary)
+
+
+def _number_array(column: NumberColumn):
+    length = len(column)
+    kinds = pyarrow.Array.from_buffers(pyarrow.uint8(), length, [None, pyarrow.py_buffer(column.kinds)])
+    validity = pyarrow.compute.not_equal(kinds, NumberColumn.EMPTY)
+    values = pyarrow.Array.from_buffers(
+        pyarrow.float64(), length, [validity.buffers()[1], pyarrow.py_buffer(column.values)]
+    )
+    if NumberColumn.FLOAT not in column.kinds:
+        return values.cast(pyarrow.int64())  # ints are stored as doubles within the safe integer range
+    return values
+
+
+def _parse_date(value):
+    if value is None or value == BLANK:
+        return None
+    try:
+        return datetime.strptime(value, DATE_FORMAT).date()
+    except (TypeError, ValueError):
+        return None
@@ -0,0 +1,11 @@
+import io
+import mmap
+from typing import BinaryIO
+
+
+def as_file(data: bytes or mmap.mmap) -> BinaryIO:
+    """File-like access to file bytes. Memory mapped blobs are already file-like, so aren't copied."""
+    if isinstance(data, mmap.mmap):
+        data.seek(0)
+        return data
+    return io.BytesIO(data)
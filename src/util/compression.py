@@ -0,0 +1,30 @@
+import gzip
+import zlib
+from typing import Iterator
+
+try:
+    import brotli
+except ImportError:  # brotli is optional, responses are only gzipped without it
+    brotli = None
+
+# content encodings we can produce, in order of preference
+ENCODINGS = ['br', 'gzip'] if brotli else ['gzip']
+
+
+def compress(data: bytes, encoding: str) -> bytes:
+    """Compress with a content encoding, at levels which favour speed as responses are compressed on demand"""
+    if encoding == 'br' and brotli:
+        return brotli.compress(data, quality=5)
+    if encoding == 'gzip':
+        return gzip.compress(data, compresslevel=6)
+    raise ValueError(f'Unsupported content encoding {encoding!r}')
+
+
+def gzip_stream(chunks: Iterator[bytes]) -> Iterator[bytes]:
+    """Gzip a stream of chunks as they are produced, for streamed responses"""
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)  # wbits 31 writes a gzip header and trailer
+    for chunk in chunks:
+        compressed = compressor.compress(chunk)
+        if compressed:
+            yield compressed
+    yield compressor.flush()
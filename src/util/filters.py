@@ -0,0 +1,170 @@
+import json
+from array import array
+from datetime import datetime
+from itertools import compress
+from typing import List, Callable, Optional
+
+from constants import DATE_FORMAT
+from enums import ConditionOperator, FilterOperator, FilterType
+from util.snapshot import FileSnapshot, DictionaryColumn, BLANK
+
+DATE_INPUT_FORMATS = ['%Y-%m-%d %H:%M:%S', '%Y-%m-%d', DATE_FORMAT]
+
+
+class FilterError(ValueError):
+    pass
+
+
+def filter_key(filters: List[dict]) -> str:
+    """Canonical form of a set of filters, for caching their results"""
+    return json.dumps(filters, sort_keys=True)
+
+
+def filter_rows(snapshot: FileSnapshot, filters: List[dict]) -> array:
+    """
+    Get the indexes of the snapshot rows which match all the filters, in the dict form of a View's filters.
+    The conditions of a filter are joined by its operator (AND/OR). Each condition is only evaluated once per
+    distinct value of a dictionary encoded column, and the per-row results are combined as bitmasks.
+    """
+    mask = None
+    for filter_ in filters:
+        filter_mask = _filter_mask(snapshot, filter_)
+        mask = filter_mask if mask is None else mask & filter_mask
+
+    if mask is None:
+        return array('I', range(snapshot.row_count))
+    return array('I', compress(range(snapshot.row_count), mask.to_bytes(snapshot.row_count, 'little')))
+
+
+def _filter_mask(snapshot: FileSnapshot, filter_: dict) -> int:
+    """Bitmask of matching rows, held as an int with one byte per row so it can be combined with & and |"""
+    field = filter_['field']
+    if field not in snapshot.headers:
+        raise FilterError(f'Filter field {field!r} not found in file')
+    column = snapshot.columns[snapshot.headers.index(field)]
+    filter_type = FilterType(filter_['filterType'])
+    operator = FilterOperator(filter_['operator']) if filter_.get('operator') else FilterOperator.AND
+
+    mask = None
+    for condition in filter_['conditions']:
+        predicate = _compile_condition(filter_type, ConditionOperator(condition['operator']), condition.get('value'))
+        if predicate is None:
+            continue
+        condition_mask = _column_mask(column, predicate)
+        if mask is None:
+            mask = condition_mask
+        elif operator == FilterOperator.AND:
+            mask &= condition_mask
+        else:
+            mask |= condition_mask
+
+    if mask is None:
+        return int.from_bytes(b'\x01' * snapshot.row_count, 'little')
+    return mask
+
+
+def _column_mask(column, predicate: Callable) -> int:
+    if isinstance(column, DictionaryColumn):
+        values = column.values
+        matches = [bool(predicate(values[code])) for code in range(len(values))]
+        row_matches = bytes([matches[code] for code in column.codes])
+    else:
+        row_matches = bytes([bool(predicate(value)) for value in column.slice(0, len(column))])
+    return int.from_bytes(row_matches, 'little')
+
+
+def _compile_condition(filter_type: FilterType, operator: ConditionOperator, value: Optional[str]) -> Callable:
+    """Build a predicate on a single cell value, following the ag-grid simple filter semantics"""
+    if operator == ConditionOperator.EMPTY:
+        return None  # 'empty' is the ag-grid placeholder for no condition selected
+    if operator == ConditionOperator.BLANK:
+        return _is_blank
+    if operator == ConditionOperator.NOT_BLANK:
+        return lambda v: not _is_blank(v)
+
+    if filter_type == FilterType.TEXT:
+        return _compile_text_condition(operator, value)
+    if filter_type == FilterType.NUMBER:
+        return _compile_comparison(operator, value, _to_number)
+    return _compile_comparison(operator, value, parse_date)
+
+
+def _compile_text_condition(operator: ConditionOperator, value: Optional[str]) -> Callable:
+    """Text filters are case insensitive, and blank cells only match the negative operators"""
+    value = (value or '').lower()
+    comparisons = {
+        ConditionOperator.EQUALS: lambda v: v == value,
+        ConditionOperator.NOT_EQUAL: lambda v: v != value,
+        ConditionOperator.CONTAINS: lambda v: value in v,
+        ConditionOperator.NOT_CONTAINS: lambda v: value not in v,
+        ConditionOperator.STARTS_WITH: lambda v: v.startswith(value),
+        ConditionOperator.ENDS_WITH: lambda v: v.endswith(value),
+    }
+    if operator not in comparisons:
+        raise FilterError(f'Condition operator {operator.value!r} is not valid for a text filter')
+
+    comparison = comparisons[operator]
+    match_blank = operator in [ConditionOperator.NOT_EQUAL, ConditionOperator.NOT_CONTAINS]
+    return lambda v: match_blank if _is_blank(v) else comparison(str(v).lower())
+
+
+def _compile_comparison(operator: ConditionOperator, value: Optional[str], convert: Callable) -> Callable:
+    """Number and date filters, where cells which are blank or not convertible never match"""
+    if operator == ConditionOperator.IN_RANGE:
+        try:
+            value_from, value_to = (convert(v.strip()) for v in (value or '').split(','))
+        except ValueError:
+            value_from = value_to = None
+        if value_from is None or value_to is None:
+            raise FilterError(f'Expected inRange condition value as "from,to" but got {value!r}')
+        comparison = lambda v: value_from < v < value_to
+    else:
+        filter_value = convert(value)
+        if filter_value is None:
+            raise FilterError(f'Invalid filter value {value!r}')
+        comparisons = {
+            ConditionOperator.EQUALS: lambda v: v == filter_value,
+            ConditionOperator.NOT_EQUAL: lambda v: v != filter_value,
+            ConditionOperator.LESS_THAN: lambda v: v < filter_value,
+            ConditionOperator.LESS_THAN_OR_EQUAL: lambda v: v <= filter_value,
+            ConditionOperator.GREATER_THAN: lambda v: v > filter_value,
+            ConditionOperator.GREATER_THAN_OR_EQUAL: lambda v: v >= filter_value,
+        }
+        if operator not in comparisons:
+            raise FilterError(f'Condition operator {operator.value!r} is not valid for this filter type')
+        comparison = comparisons[operator]
+
+    def predicate(v):
+        v = convert(v)
+        return v is not None and comparison(v)
+
+    return predicate
+
+
+def _is_blank(value) -> bool:
+    return value is None or value == BLANK
+
+
+def _to_number(value) -> Optional[float]:
+    if isinstance(value, bool):
+        return None
+    if isinstance(value, (int, float)):
+        return value
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_date(value) -> Optional[datetime]:
+    """Date cells are held formatted as DATE_FORMAT, and ag-grid sends dates as 'YYYY-MM-DD hh:mm:ss'"""
+    if isinstance(value, datetime):
+        return value
+    if not isinstance(value, str) or not value:
+        return None
+    for date_format in DATE_INPUT_FORMATS:
+        try:
+            return datetime.strptime(value, date_format)
+        except ValueError:
+            continue
+    return None
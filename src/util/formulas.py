@@ -0,0 +1,808 @@
+import math
+import re
+import zipfile
+from datetime import datetime, date, time, timedelta
+from io import BytesIO
+from typing import Callable, Dict, List, Tuple
+from xml.sax.saxutils import escape
+
+from openpyxl.formula import Tokenizer
+from openpyxl.formula.tokenizer import Token, TokenizerError
+from openpyxl.utils.cell import range_boundaries
+from openpyxl.utils.datetime import to_excel, from_excel
+from openpyxl.worksheet.worksheet import Worksheet
+
+
+class FormulaError(Exception):
+    """A formula the evaluator doesn't support, so the workbook needs recalculating by Excel or LibreOffice"""
+    pass
+
+
+class ExcelError:
+    """An error value, such as #DIV/0!, which formulas can produce and pass on like any other value"""
+
+    def __init__(self, code: str):
+        self.code = code
+
+    def __eq__(self, other):
+        return isinstance(other, ExcelError) and other.code == self.code
+
+    def __hash__(self):
+        return hash(self.code)
+
+    def __repr__(self):
+        return self.code
+
+
+DIV0, NA, NUM, REF, VALUE = (ExcelError(code) for code in ['#DIV/0!', '#N/A', '#NUM!', '#REF!', '#VALUE!'])
+ERRORS = {error.code: error for error in [DIV0, NA, NUM, REF, VALUE, ExcelError('#NAME?'), ExcelError('#NULL!')]}
+
+
+class _Range:
+    """The values of a block of cells, in rows"""
+
+    def __init__(self, rows: List[list]):
+        self.rows = rows
+
+    def values(self) -> list:
+        return [value for row in self.rows for value in row]
+
+
+class FormulaEvaluator:
+    """
+    Evaluate the formulas of a worksheet in Python, so their results can be cached in the workbook without opening
+    it in Excel or LibreOffice. Covers arithmetic, comparison and text operators, and the common maths, logical,
+    lookup, text and date functions. Anything else, e.g. references to other sheets, raises a FormulaError.
+    """
+
+    def __init__(self, ws: Worksheet):
+        self.grid = [list(row) for row in ws.values]
+        self.epoch = ws.parent.epoch
+        self.results: Dict[Tuple[int, int], object] = {}
+        self._evaluating = set()
+        self._trees = {}
+
+    def evaluate_all(self) -> Dict[str, object]:
+        """Evaluate every formula cell, returning the result for each cell coordinate"""
+        results = {}
+        try:
+            for row_index, row in enumerate(self.grid):
+                for col_index, value in enumerate(row):
+                    if _is_formula(value):
+                        result = self._evaluate_in_order(row_index, col_index)
+                        results[f'{_column_letter(col_index + 1)}{row_index + 1}'] = 0 if result is None else result
+        except RecursionError:
+            # e.g. ranges of formulas referring to the next, which aren't evaluated in order
+            raise FormulaError('Formulas refer to each other too deeply to evaluate')
+        return results
+
+    def evaluate(self, formula: str):
+        return self._eval(_Parser(formula).parse())
+
+    def _evaluate_in_order(self, row_index: int, col_index: int):
+        """
+        Evaluate a formula cell after the formula cells it refers to directly, using a stack rather than recursion,
+        so a long chain of formulas each referring to the one below doesn't exceed the recursion limit.
+        """
+        stack, seen = [((row_index, col_index), False)], {(row_index, col_index)}
+        while stack:
+            key, ready = stack.pop()
+            if ready:
+                self._cell(*key)
+                continue
+            stack.append((key, True))
+            for reference in self._references(*key):
+                if reference not in seen and reference not in self.results:
+                    seen.add(reference)
+                    stack.append((reference, False))
+        return self._cell(row_index, col_index)
+
+    def _references(self, row_index: int, col_index: int) -> List[Tuple[int, int]]:
+        """The formula cells a formula refers to as single cells, rather than in ranges"""
+        references = []
+        nodes = [self._tree(row_index, col_index)]
+        while nodes:
+            node = nodes.pop()
+            if node[0] == 'ref':
+                if '!' in node[1] or ':' in node[1]:
+                    continue
+                try:
+                    col, row, _, _ = range_boundaries(node[1].replace('$', ''))
+                except ValueError:
+                    continue  # e.g. defined names, which evaluating raises a FormulaError for
+                if col is not None and row is not None and _is_formula(self._value(row - 1, col - 1)):
+                    references.append((row - 1, col - 1))
+            elif node[0] in ['neg', 'percent']:
+                nodes.append(node[1])
+            elif node[0] == 'op':
+                nodes.extend(node[2:])
+            elif node[0] == 'func':
+                nodes.extend(node[2])
+        return references
+
+    def _tree(self, row_index: int, col_index: int):
+        key = (row_index, col_index)
+        if key not in self._trees:
+            self._trees[key] = _Parser(self.grid[row_index][col_index]).parse()
+        return self._trees[key]
+
+    def _value(self, row_index: int, col_index: int):
+        if row_index >= len(self.grid) or col_index >= len(self.grid[row_index]):
+            return None
+        return self.grid[row_index][col_index]
+
+    def _cell(self, row_index: int, col_index: int):
+        value = self._value(row_index, col_index)
+        if not _is_formula(value):
+            if value is not None and not isinstance(value, (int, float, str, bool, datetime, date, time, timedelta)):
+                raise FormulaError(f'Unsupported cell value {value!r}')  # e.g. array formulas
+            return value
+
+        key = (row_index, col_index)
+        if key in self.results:
+            return self.results[key]
+        if key in self._evaluating:
+            raise FormulaError(f'Circular reference in {_column_letter(col_index + 1)}{row_index + 1}')
+        self._evaluating.add(key)
+        try:
+            result = self._eval(self._tree(row_index, col_index))
+            if isinstance(result, _Range):
+                result = self._implicit_value(result)
+        finally:
+            self._evaluating.discard(key)
+        self.results[key] = result
+        return result
+
+    def _eval(self, node):
+        kind = node[0]
+        if kind == 'value':
+            return node[1]
+        if kind == 'ref':
+            return self._reference(node[1])
+        if kind == 'neg':
+            value = self._number(self._scalar(self._eval(node[1])))
+            return value if isinstance(value, ExcelError) else -value
+        if kind == 'percent':
+            value = self._number(self._scalar(self._eval(node[1])))
+            return value if isinstance(value, ExcelError) else value / 100
+        if kind == 'op':
+            return self._operator(node[1], self._scalar(self._eval(node[2])), self._scalar(self._eval(node[3])))
+        if kind == 'func':
+            return self._function(node[1], node[2])
+        raise FormulaError(f'Unsupported expression {node!r}')
+
+    def _reference(self, ref: str):
+        if '!' in ref:
+            raise FormulaError(f'References to other sheets are not supported: {ref!r}')
+        try:
+            min_col, min_row, max_col, max_row = range_boundaries(ref.replace('$', ''))
+        except ValueError:
+            raise FormulaError(f'Unsupported reference {ref!r}')  # e.g. defined names
+        if min_col is None or max_col is None:
+            raise FormulaError(f'Unsupported reference {ref!r}')
+        min_row = min_row or 1
+        max_row = max_row or len(self.grid)
+        if min_row == max_row and min_col == max_col and ':' not in ref:
+            return self._cell(min_row - 1, min_col - 1)
+        return _Range([
+            [self._cell(row - 1, col - 1) for col in range(min_col, max_col + 1)]
+            for row in range(min_row, max_row + 1)
+        ])
+
+    def _implicit_value(self, value: _Range):
+        values = value.values()
+        return values[0] if len(values) == 1 else VALUE
+
+    def _scalar(self, value):
+        if isinstance(value, _Range):
+            return self._implicit_value(value)
+        return value
+
+    def _number(self, value):
+        """Coerce a value to a number as Excel does for arithmetic, or return a #VALUE! error"""
+        if isinstance(value, bool):
+            return int(value)
+        if isinstance(value, (int, float, ExcelError)):
+            return value
+        if value is None:
+            return 0
+        if isinstance(value, (datetime, date, time, timedelta)):
+            return to_excel(value, self.epoch)
+        if isinstance(value, str):
+            try:
+                return _to_int(float(value.strip()))
+            except ValueError:
+                return VALUE
+        return VALUE
+
+    def _text(self, value):
+        if isinstance(value, ExcelError) or isinstance(value, str):
+            return value
+        if value is None:
+            return ''
+        if isinstance(value, bool):
+            return 'TRUE' if value else 'FALSE'
+        if isinstance(value, (datetime, date, time, timedelta)):
+            value = to_excel(value, self.epoch)
+        if isinstance(value, float):
+            return f'{value:.15g}' if not value.is_integer() else str(int(value))
+        return str(value)
+
+    @staticmethod
+    def _boolean(value):
+        if isinstance(value, (bool, ExcelError)):
+            return value
+        if isinstance(value, (int, float)):
+            return value != 0
+        if value is None:
+            return False
+        if isinstance(value, str) and value.upper() in ['TRUE', 'FALSE']:
+            return value.upper() == 'TRUE'
+        return VALUE
+
+    def _operator(self, operator: str, left, right):
+        for value in [left, right]:
+            if isinstance(value, ExcelError):
+                return value
+        if operator == '&':
+            return self._text(left) + self._text(right)
+        if operator in COMPARISONS:
+            return COMPARISONS[operator](self._compare(left, right))
+
+        left, right = self._number(left), self._number(right)
+        for value in [left, right]:
+            if isinstance(value, ExcelError):
+                return value
+        if operator == '+':
+            return _to_int(left + right)
+        if operator == '-':
+            return _to_int(left - right)
+        if operator == '*':
+            return _to_int(left * right)
+        if operator == '/':
+            return DIV0 if right == 0 else _to_int(left / right)
+        if operator == '^':
+            try:
+                return _to_int(float(left) ** right)
+            except (OverflowError, ZeroDivisionError, ValueError):
+                return NUM
+        raise FormulaError(f'Unsupported operator {operator!r}')
+
+    def _compare(self, left, right) -> int:
+        """Compare as Excel does, where numbers sort before text before booleans and text ignores case"""
+        if left is None:
+            left = right.__class__() if isinstance(right, (str, bool)) else 0
+        if right is None:
+            right = left.__class__() if isinstance(left, (str, bool)) else 0
+        left, right = [
+            self._number(value) if isinstance(value, (datetime, date, time, timedelta)) else value
+            for value in [left, right]
+        ]
+        left_rank, right_rank = _type_rank(left), _type_rank(right)
+        if left_rank != right_rank:
+            return -1 if left_rank < right_rank else 1
+        if isinstance(left, str):
+            left, right = left.lower(), right.lower()
+        return (left > right) - (left < right)
+
+    def _function(self, name: str, args: list):
+        if name in LAZY_FUNCTIONS:
+            return LAZY_FUNCTIONS[name](self, args)
+        function = FUNCTIONS.get(name)
+        if function is None:
+            raise FormulaError(f'Unsupported function {name!r}')
+        return function(self, *[self._eval(arg) for arg in args])
+
+    def _numbers(self, args: list) -> list:
+        """Numbers to aggregate. Text and booleans in ranges are skipped, but given directly they are coerced."""
+        numbers = []
+        for arg in args:
+            if isinstance(arg, _Range):
+                for value in arg.values():
+                    if isinstance(value, ExcelError):
+                        raise _ErrorResult(value)
+                    if _is_number(value):
+                        numbers.append(self._number(value))
+            elif arg is not None:
+                number = self._number(arg)
+                if isinstance(number, ExcelError):
+                    raise _ErrorResult(number)
+                numbers.append(number)
+        return numbers
+
+    def _matches(self, criteria) -> Callable:
+        """Predicate for the criteria of COUNTIF/SUMIF, e.g. 5, ">=5" or "text" (without wildcards)"""
+        operator = '='
+        if isinstance(criteria, str):
+            match = re.match(r'(<=|>=|<>|=|<|>)?(.*)$', criteria, re.DOTALL)
+            operator, criteria = match.group(1) or '=', match.group(2)
+            number = self._number(criteria)
+            if not isinstance(number, ExcelError) and criteria != '':
+                criteria = number
+        compare = COMPARISONS[operator]
+
+        def matches(value) -> bool:
+            if value is None:
+                return operator in ['=', '<>'] and compare(0 if criteria == '' else 1)
+            if isinstance(criteria, str) != isinstance(value, str):
+                return operator == '<>'
+            return compare(self._compare(value, criteria))
+        return matches
+
+
+class _ErrorResult(Exception):
+    """Raised to return an error value from deep within a function"""
+
+    def __init__(self, error: ExcelError):
+        self.error = error
+
+
+COMPARISONS = {
+    '=': lambda c: c == 0, '<>': lambda c: c != 0, '<': lambda c: c < 0,
+    '>': lambda c: c > 0, '<=': lambda c: c <= 0, '>=': lambda c: c >= 0
+}
+
+
+def _type_rank(value) -> int:
+    if isinstance(value, bool):
+        return 2
+    if isinstance(value, str):
+        return 1
+    return 0
+
+
+def _to_int(value):
+    """Whole number results are kept as ints, as openpyxl reads them"""
+    if isinstance(value, float) and value.is_integer() and abs(value) < 2 ** 53:
+        return int(value)
+    return value
+
+
+def _is_formula(value) -> bool:
+    return isinstance(value, str) and value.startswith('=') and len(value) > 1
+
+
+def _column_letter(col: int) -> str:
+    letters = ''
+    while col:
+        col, remainder = divmod(col - 1, 26)
+        letters = chr(65 + remainder) + letters
+    return letters
+
+
+def _errors_first(function: Callable) -> Callable:
+    """Wrap a function so an error in any argument is the result, as for most Excel functions"""
+    def wrapper(evaluator: FormulaEvaluator, *args):
+        for arg in args:
+            if isinstance(arg, ExcelError):
+                return arg
+        try:
+            return function(evaluator, *args)
+        except _ErrorResult as e:
+            return e.error
+    return wrapper
+
+
+def _numeric(function: Callable) -> Callable:
+    """Wrap a function of scalar numbers, coercing its arguments"""
+    def wrapper(evaluator: FormulaEvaluator, *args):
+        numbers = [evaluator._number(evaluator._scalar(arg)) for arg in args]
+        for number in numbers:
+            if isinstance(number, ExcelError):
+                return number
+        try:
+            return _to_int(function(*numbers))
+        except (ValueError, OverflowError):
+            return NUM
+        except ZeroDivisionError:
+            return DIV0
+    return wrapper
+
+
+def _text_function(function: Callable) -> Callable:
+    """Wrap a function whose first argument is text and any others are numbers"""
+    def wrapper(evaluator: FormulaEvaluator, text, *args):
+        text = evaluator._text(evaluator._scalar(text))
+        numbers = [evaluator._number(evaluator._scalar(arg)) for arg in args]
+        for value in [text, *numbers]:
+            if isinstance(value, ExcelError):
+                return value
+        try:
+            return function(text, *[int(number) for number in numbers])
+        except ValueError:
+            return VALUE
+    return wrapper
+
+
+def _round(number, digits, direction=None):
+    factor = 10 ** int(digits)
+    if direction == 'up':
+        return math.copysign(math.ceil(abs(number) * factor - 1e-9), number) / factor
+    if direction == 'down':
+        return math.copysign(math.floor(abs(number) * factor + 1e-9), number) / factor
+    # Excel rounds halves away from zero, rather than to even
+    return math.copysign(math.floor(abs(number) * factor + 0.5 + 1e-9), number) / factor
+
+
+def _average(evaluator, *args):
+    numbers = evaluator._numbers(args)
+    return _to_int(sum(numbers) / len(numbers)) if numbers else DIV0
+
+
+def _min_max(function):
+    def aggregate(evaluator, *args):
+        numbers = evaluator._numbers(args)
+        return _to_int(function(numbers)) if numbers else 0
+    return aggregate
+
+
+def _is_number(value) -> bool:
+    return isinstance(value, (int, float, datetime, date)) and not isinstance(value, bool)
+
+
+def _count(evaluator, *args):
+    """Numbers in ranges are counted, and arguments given directly if they can be coerced to numbers"""
+    count = 0
+    for arg in args:
+        if isinstance(arg, _Range):
+            count += sum(1 for value in arg.values() if _is_number(value))
+        elif arg is not None and not isinstance(evaluator._number(arg), ExcelError):
+            count += 1
+    return count
+
+
+def _counta(evaluator, *args):
+    return sum(
+        sum(1 for value in arg.values() if value is not None) if isinstance(arg, _Range) else 1
+        for arg in args
+    )
+
+
+def _countif(evaluator, values, criteria):
+    if not isinstance(values, _Range):
+        return VALUE
+    matches = evaluator._matches(evaluator._scalar(criteria))
+    return sum(1 for value in values.values() if matches(value))
+
+
+def _sumif(evaluator, values, criteria, sum_values=None):
+    if not isinstance(values, _Range) or not isinstance(sum_values or values, _Range):
+        return VALUE
+    matches = evaluator._matches(evaluator._scalar(criteria))
+    sum_values = (sum_values or values).values()
+    total = 0
+    for i, value in enumerate(values.values()):
+        if i < len(sum_values) and matches(value):
+            number = sum_values[i]
+            if isinstance(number, (int, float)) and not isinstance(number, bool):
+                total += number
+    return _to_int(total)
+
+
+def _vlookup(evaluator, lookup_value, table, col_index, approximate=True):
+    lookup_value = evaluator._scalar(lookup_value)
+    col_index = evaluator._number(evaluator._scalar(col_index))
+    approximate = evaluator._boolean(evaluator._scalar(approximate))
+    for value in [lookup_value, col_index, approximate]:
+        if isinstance(value, ExcelError):
+            return value
+    if not isinstance(table, _Range):
+        return VALUE
+    col_index = int(col_index)
+    if col_index < 1:
+        return VALUE
+    if not table.rows or col_index > len(table.rows[0]):
+        return REF
+
+    if approximate:
+        # the first column is sorted ascending, so the match is the last row not greater than the lookup value
+        match = None
+        for row in table.rows:
+            if row[0] is None or _type_rank(row[0]) != _type_rank(lookup_value):
+                continue
+            if evaluator._compare(row[0], lookup_value) > 0:
+                break
+            match = row
+        return NA if match is None else match[col_index - 1]
+
+    for row in table.rows:
+        if row[0] is not None and _type_rank(row[0]) == _type_rank(lookup_value) \
+                and evaluator._compare(row[0], lookup_value) == 0:
+            return row[col_index - 1]
+    return NA
+
+
+def _match(evaluator, lookup_value, values, match_type=1):
+    lookup_value = evaluator._scalar(lookup_value)
+    match_type = evaluator._number(evaluator._scalar(match_type))
+    if not isinstance(values, _Range):
+        return NA
+    for position, value in enumerate(values.values(), start=1):
+        if match_type == 0 and value is not None and _type_rank(value) == _type_rank(lookup_value) \
+                and evaluator._compare(value, lookup_value) == 0:
+            return position
+    if match_type == 0:
+        return NA
+    raise FormulaError('Only exact MATCH is supported')
+
+
+def _index(evaluator, values, row, col=None):
+    if not isinstance(values, _Range):
+        return VALUE
+    row = evaluator._number(evaluator._scalar(row))
+    col = evaluator._number(evaluator._scalar(col)) if col is not None else 1
+    for number in [row, col]:
+        if isinstance(number, ExcelError):
+            return number
+    row, col = int(row), int(col)
+    if len(values.rows) == 1 and col == 1:
+        row, col = 1, row
+    try:
+        value = values.rows[row - 1][col - 1]
+    except IndexError:
+        return REF
+    return 0 if value is None else value
+
+
+def _concat(evaluator, *args):
+    parts = []
+    for arg in args:
+        for value in (arg.values() if isinstance(arg, _Range) else [arg]):
+            if isinstance(value, ExcelError):
+                return value
+            parts.append(evaluator._text(value))
+    return ''.join(parts)
+
+
+def _date(evaluator, *args):
+    numbers = [evaluator._number(evaluator._scalar(arg)) for arg in args]
+    for number in numbers:
+        if isinstance(number, ExcelError):
+            return number
+    year, month, day = (int(number) for number in numbers)
+    if year < 1900:
+        year += 1900
+    year += (month - 1) // 12
+    month = (month - 1) % 12 + 1
+    try:
+        return _to_int(to_excel(datetime(year, month, 1) + timedelta(days=day - 1), evaluator.epoch))
+    except (ValueError, OverflowError):
+        return NUM
+
+
+def _date_part(part: str):
+    def function(evaluator, serial):
+        serial = evaluator._number(evaluator._scalar(serial))
+        if isinstance(serial, ExcelError):
+            return serial
+        try:
+            return getattr(from_excel(serial, evaluator.epoch), part)
+        except (ValueError, OverflowError):
+            return NUM
+    return function
+
+
+def _if(evaluator, args):
+    if not 1 < len(args) < 4:
+        raise FormulaError('IF takes 2 or 3 arguments')
+    condition = evaluator._boolean(evaluator._scalar(evaluator._eval(args[0])))
+    if isinstance(condition, ExcelError):
+        return condition
+    if condition:
+        return evaluator._eval(args[1])
+    return evaluator._eval(args[2]) if len(args) == 3 else False
+
+
+def _iferror(evaluator, args):
+    value = evaluator._scalar(evaluator._eval(args[0]))
+    return evaluator._eval(args[1]) if isinstance(value, ExcelError) else value
+
+
+def _not(evaluator, value):
+    value = evaluator._boolean(evaluator._scalar(value))
+    return value if isinstance(value, ExcelError) else not value
+
+
+def _logical(function):
+    def wrapper(evaluator, *args):
+        values = []
+        for arg in args:
+            for value in (arg.values() if isinstance(arg, _Range) else [arg]):
+                if isinstance(arg, _Range) and not isinstance(value, (bool, int, float)):
+                    continue
+                value = evaluator._boolean(value)
+                if isinstance(value, ExcelError):
+                    return value
+                values.append(value)
+        return function(values) if values else VALUE
+    return wrapper
+
+
+FUNCTIONS = {
+    'SUM': _errors_first(lambda e, *args: _to_int(sum(e._numbers(args)))),
+    'AVERAGE': _errors_first(_average),
+    'MIN': _errors_first(_min_max(min)),
+    'MAX': _errors_first(_min_max(max)),
+    'COUNT': _count,
+    'COUNTA': _counta,
+    'COUNTIF': _errors_first(_countif),
+    'SUMIF': _errors_first(_sumif),
+    'ROUND': _numeric(lambda number, digits=0: _round(number, digits)),
+    'ROUNDUP': _numeric(lambda number, digits=0: _round(number, digits, 'up')),
+    'ROUNDDOWN': _numeric(lambda number, digits=0: _round(number, digits, 'down')),
+    'INT': _numeric(math.floor),
+    'ABS': _numeric(abs),
+    'MOD': _numeric(lambda number, divisor: number - divisor * math.floor(number / divisor)),
+    'POWER': _numeric(lambda number, power: float(number) ** power),
+    'SQRT': _numeric(math.sqrt),
+    'AND': _errors_first(_logical(all)),
+    'OR': _errors_first(_logical(any)),
+    'NOT': _errors_first(_not),
+    'ISBLANK': lambda e, value: e._scalar(value) is None,
+    'ISNUMBER': lambda e, value: _is_number(e._scalar(value)),
+    'ISTEXT': lambda e, value: isinstance(e._scalar(value), str),
+    'ISERROR': lambda e, value: isinstance(e._scalar(value), ExcelError),
+    'VLOOKUP': _errors_first(_vlookup),
+    'MATCH': _errors_first(_match),
+    'INDEX': _errors_first(_index),
+    'CONCATENATE': _concat,
+    'CONCAT': _concat,
+    'LEFT': _text_function(lambda text, count=1: text[:count]),
+    'RIGHT': _text_function(lambda text, count=1: text[-count:] if count else ''),
+    'MID': _text_function(lambda text, start, count: text[start - 1:start - 1 + count]),
+    'LEN': _text_function(len),
+    'UPPER': _text_function(str.upper),
+    'LOWER': _text_function(str.lower),
+    'PROPER': _text_function(str.title),
+    'TRIM': _text_function(lambda text: re.sub(' +', ' ', text.strip(' '))),
+    'VALUE': lambda e, value: e._number(e._scalar(value)),
+    'DATE': _errors_first(_date),
+    'YEAR': _errors_first(_date_part('year')),
+    'MONTH': _errors_first(_date_part('month')),
+    'DAY': _errors_first(_date_part('day')),
+    'TODAY': lambda e: to_excel(datetime.combine(date.today(), time()), e.epoch),
+    'NOW': lambda e: to_excel(datetime.now(), e.epoch),
+}
+LAZY_FUNCTIONS = {'IF': _if, 'IFERROR': _iferror}  # only the branch taken is evaluated
+
+INFIX_PRECEDENCE = {
+    '=': 1, '<>': 1, '<': 1, '>': 1, '<=': 1, '>=': 1, '&': 2, '+': 3, '-': 3, '*': 4, '/': 4, '^': 5
+}
+
+
+class _Parser:
+    """Parse a formula from the openpyxl tokens into a tree of tuples, by precedence climbing"""
+
+    def __init__(self, formula: str):
+        try:
+            tokens = Tokenizer(formula).items
+        except TokenizerError as e:
+            raise FormulaError(f'Unable to parse formula {formula!r}: {e}')
+        self.formula = formula
+        self.tokens = [token for token in tokens if token.type != Token.WSPACE]
+        self.position = 0
+
+    def parse(self):
+        node = self._expression(1)
+        if self.position != len(self.tokens):
+            raise FormulaError(f'Unable to parse formula {self.formula!r}')
+        return node
+
+    def _peek(self):
+        return self.tokens[self.position] if self.position < len(self.tokens) else None
+
+    def _next(self) -> Token:
+        token = self._peek()
+        if token is None:
+            raise FormulaError(f'Unexpected end of formula {self.formula!r}')
+        self.position += 1
+        return token
+
+    def _expression(self, min_precedence: int):
+        node = self._unary()
+        while True:
+            token = self._peek()
+            if token is None or token.type != Token.OP_IN or token.value not in INFIX_PRECEDENCE:
+                if token is not None and token.type == Token.OP_IN:
+                    raise FormulaError(f'Unsupported operator {token.value!r}')
+                return node
+            precedence = INFIX_PRECEDENCE[token.value]
+            if precedence < min_precedence:
+                return node
+            self._next()
+            node = ('op', token.value, node, self._expression(precedence + 1))
+
+    def _unary(self):
+        token = self._peek()
+        if token is not None and token.type == Token.OP_PRE:
+            self._next()
+            operand = self._unary()
+            return ('neg', operand) if token.value == '-' else operand
+        node = self._primary()
+        while self._peek() is not None and self._peek().type == Token.OP_POST:
+            self._next()
+            node = ('percent', node)
+        return node
+
+    def _primary(self):
+        token = self._next()
+        if token.type == Token.OPERAND:
+            if token.subtype == Token.NUMBER:
+                return 'value', _to_int(float(token.value))
+            if token.subtype == Token.TEXT:
+                return 'value', token.value[1:-1].replace('""', '"')
+            if token.subtype == Token.LOGICAL:
+                return 'value', token.value.upper() == 'TRUE'
+            if token.subtype == Token.ERROR:
+                return 'value', ERRORS.get(token.value, VALUE)
+            return 'ref', token.value
+        if token.type == Token.PAREN and token.subtype == Token.OPEN:
+            node = self._expression(1)
+            self._expect(Token.PAREN)
+            return node
+        if token.type == Token.FUNC and token.subtype == Token.OPEN:
+            name = token.value[:-1].upper()
+            if name.startswith('_XLFN.'):
+                name = name[len('_XLFN.'):]
+            args = []
+            if self._peek() is not None and self._peek().type == Token.FUNC and self._peek().subtype == Token.CLOSE:
+                self._next()
+                return 'func', name, args
+            while True:
+                args.append(self._expression(1))
+                token = self._next()
+                if token.type == Token.FUNC and token.subtype == Token.CLOSE:
+                    return 'func', name, args
+                if token.type != Token.SEP or token.subtype != Token.ARG:
+                    raise FormulaError(f'Unable to parse formula {self.formula!r}')
+        raise FormulaError(f'Unsupported token {token.value!r} in formula {self.formula!r}')
+
+    def _expect(self, token_type: str):
+        token = self._next()
+        if token.type != token_type or token.subtype != Token.CLOSE:
+            raise FormulaError(f'Unable to parse formula {self.formula!r}')
+
+
+def evaluate_formulas(ws: Worksheet) -> Dict[str, object]:
+    """Evaluate all the formulas of a worksheet, raising FormulaError if any can't be evaluated in Python"""
+    return FormulaEvaluator(ws).evaluate_all()
+
+
+def cached_value_xml(value, epoch: datetime) -> Tuple[str, str]:
+    """The type attribute and <v> text of a formula cell caching a result"""
+    if isinstance(value, bool):
+        return ' t="b"', '1' if value else '0'
+    if isinstance(value, ExcelError):
+        return ' t="e"', value.code
+    if isinstance(value, str):
+        return ' t="str"', escape(value)
+    if isinstance(value, (datetime, date, time, timedelta)):
+        return '', repr(to_excel(value, epoch))
+    return '', repr(value)
+
+
+_FORMULA_CELL = re.compile(r'<c r="([A-Z]+[0-9]+)"([^>]*)>(<f>[^<]*</f>)(?:<v\s*/>|<v></v>)?</c>')
+_TYPE_ATTR = re.compile(r'\s+t="[^"]*"')
+
+
+def write_cached_values(file_bytes: bytes, sheet_path: str, values: Dict[str, object], epoch: datetime) -> bytes:
+    """
+    Write the results of formulas into a workbook saved by openpyxl, which only saves the formulas, so reading it
+    with data_only gives the results as if it had been opened and saved by Excel.
+    """
+    def cached_value(match: re.Match) -> str:
+        coordinate, attrs, formula = match.groups()
+        if coordinate not in values:
+            return match.group(0)
+        type_attr, text = cached_value_xml(values[coordinate], epoch)
+        return f'<c r="{coordinate}"{_TYPE_ATTR.sub("", attrs)}{type_attr}>{formula}<v>{text}</v></c>'
+
+    source = zipfile.ZipFile(BytesIO(file_bytes))
+    output = BytesIO()
+    with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+        for info in source.infolist():
+            data = source.read(info.filename)
+            if info.filename == sheet_path:
+                data = _FORMULA_CELL.sub(cached_value, data.decode('utf-8')).encode('utf-8')
+            target.writestr(info, data)
+    return output.getvalue()
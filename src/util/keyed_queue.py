@@ -0,0 +1,49 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, Hashable, List
+
+logger = logging.getLogger(__name__)
+
+
+class KeyedQueue:
+    """
+    Hands items to a handler on a pool of threads. Items put under the same key are handled one batch at a time,
+    in the order they were put, while items under different keys are handled in parallel.
+    A batch is every item put under the key since the last batch started, so is a single item unless it's busy.
+    """
+
+    def __init__(self, handler: Callable[[Hashable, List], None], max_workers: int, name: str):
+        self.handler = handler
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+        self._pending: Dict[Hashable, list] = {}
+        self._active = set()  # keys with a batch running or waiting for a thread
+        self._lock = threading.Lock()
+
+    def put(self, key: Hashable, item):
+        self.put_all(key, [item])
+
+    def put_all(self, key: Hashable, items: List):
+        """Put items under a key at once, so they are handled in the same batch"""
+        with self._lock:
+            self._pending.setdefault(key, []).extend(items)
+            if key in self._active:
+                return  # picked up by the running batch's thread once it finishes
+            self._active.add(key)
+        self._executor.submit(self._drain, key)
+
+    def pending(self, key: Hashable) -> int:
+        with self._lock:
+            return len(self._pending.get(key, []))
+
+    def _drain(self, key: Hashable):
+        while True:
+            with self._lock:
+                items = self._pending.pop(key, None)
+                if not items:
+                    self._active.discard(key)
+                    return
+            try:
+                self.handler(key, items)
+            except Exception:
+                logger.exception(f'Unable to handle {len(items)} queued item(s) for {key!r}')
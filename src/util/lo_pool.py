@@ -0,0 +1,206 @@
+import json
+import logging
+import os
+import queue
+import shutil
+import socket
+import subprocess
+import tempfile
+import threading
+import time
+from typing import List, Optional
+
+from config import Config
+
+log = logging.getLogger(__name__)
+
+WORKER_SCRIPT = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'lo_worker.py')
+
+
+class RecalcError(Exception):
+    pass
+
+
+class RecalcWorker:
+    """A long lived worker process, which serves recalculation jobs on its own unix socket"""
+
+    def __init__(self, command: List[str], work_dir: str, index: int):
+        self.command = command
+        self.socket_path = os.path.join(work_dir, f'worker-{index}.sock')
+        self.profile_dir = os.path.join(work_dir, f'profile-{index}')
+        self.process: Optional[subprocess.Popen] = None
+
+    def start(self, timeout: float):
+        self.stop()
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        self.process = subprocess.Popen(
+            [*self.command, '--socket', self.socket_path, '--profile', self.profile_dir], stdin=subprocess.DEVNULL
+        )
+        deadline = time.monotonic() + timeout
+        while not os.path.exists(self.socket_path):
+            if self.process.poll() is not None:
+                raise RecalcError(f'Worker exited with code {self.process.returncode} while starting')
+            if time.monotonic() > deadline:
+                self.stop()
+                raise RecalcError(f'Worker did not start within {timeout}s')
+            time.sleep(0.05)
+
+    def stop(self):
+        if self.process is not None and self.process.poll() is None:
+            self.process.terminate()
+            try:
+                self.process.wait(5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process = None
+
+    @property
+    def alive(self) -> bool:
+        return self.process is not None and self.process.poll() is None
+
+    def request(self, message: dict, timeout: float) -> dict:
+        """Send a job and wait for the reply. Raises OSError, or socket.timeout, if the worker doesn't reply."""
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as connection:
+            connection.settimeout(timeout)
+            connection.connect(self.socket_path)
+            with connection.makefile('rwb') as stream:
+                stream.write(json.dumps(message).encode('utf-8') + b'\n')
+                stream.flush()
+                reply = stream.readline()
+        if not reply:
+            raise ConnectionError('Worker closed the connection without replying')
+        return json.loads(reply)
+
+
+class RecalcPool:
+    """
+    Pool of long lived LibreOffice instances, so recalculating a workbook doesn't pay for starting LibreOffice.
+    Jobs wait for a free worker, so at most size run at once. A worker that crashes, times out or fails a health
+    check is restarted, and the job that found it broken fails rather than being retried.
+    """
+
+    def __init__(
+        self, command: List[str], size: int, job_timeout: float, startup_timeout: float,
+        health_check_interval: float = None
+    ):
+        self.command = command
+        self.size = size
+        self.job_timeout = job_timeout
+        self.startup_timeout = startup_timeout
+        self.health_check_interval = health_check_interval
+        self.work_dir = None
+        self.workers: List[RecalcWorker] = []
+        self._idle = queue.Queue()
+        self._lock = threading.Lock()
+        self._closed = threading.Event()
+        self.jobs = 0
+        self.restarts = 0
+
+    def start(self):
+        """Start the workers, unless already started. Workers that fail to start are retried when next used."""
+        with self._lock:
+            if self.workers:
+                return
+            self.work_dir = tempfile.mkdtemp(prefix='grid-api-lo-')
+            self.workers = [RecalcWorker(self.command, self.work_dir, i) for i in range(self.size)]
+        for worker in self.workers:
+            try:
+                worker.start(self.startup_timeout)
+            except RecalcError:
+                log.exception('Unable to start recalculation worker')
+            self._idle.put(worker)
+        if self.health_check_interval:
+            threading.Thread(target=self._check_health_periodically, daemon=True, name='recalc-health').start()
+
+    def recalculate(self, path: str):
+        """Recalculate the formulas of a workbook and save it in place, raising RecalcError if that fails"""
+        self.start()
+        try:
+            worker = self._idle.get(timeout=self.job_timeout)
+        except queue.Empty:
+            raise RecalcError(f'No recalculation worker free within {self.job_timeout}s')
+        try:
+            if not worker.alive:
+                self._restart(worker)
+            try:
+                reply = worker.request({'path': path}, self.job_timeout)
+            except (OSError, ValueError) as e:  # includes socket.timeout
+                self._restart(worker)
+                raise RecalcError(f'Recalculation worker failed: {e!r}')
+            if not reply.get('ok'):
+                raise RecalcError(f'Unable to recalculate {path!r}: {reply.get("error")}')
+            with self._lock:
+                self.jobs += 1
+        finally:
+            self._idle.put(worker)
+
+    def health_check(self):
+        """Ping the idle workers, restarting any which have died or don't reply"""
+        for _ in range(self._idle.qsize()):
+            try:
+                worker = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if not worker.alive or not worker.request({'ping': True}, self.job_timeout).get('ok'):
+                    raise RecalcError('Worker is not healthy')
+            except (OSError, ValueError, RecalcError):
+                log.warning('Recalculation worker failed its health check, restarting it')
+                try:
+                    self._restart(worker)
+                except RecalcError:
+                    log.exception('Unable to restart recalculation worker')
+            finally:
+                self._idle.put(worker)
+
+    def close(self):
+        self._closed.set()
+        with self._lock:
+            for worker in self.workers:
+                worker.stop()
+            self.workers = []
+            self._idle = queue.Queue()
+            if self.work_dir:
+                shutil.rmtree(self.work_dir, ignore_errors=True)
+                self.work_dir = None
+
+    def summary(self) -> dict:
+        return {
+            'size': self.size,
+            'alive': sum(worker.alive for worker in self.workers),
+            'idle': self._idle.qsize(),
+            'jobs': self.jobs,
+            'restarts': self.restarts
+        }
+
+    def _restart(self, worker: RecalcWorker):
+        with self._lock:
+            self.restarts += 1
+        worker.start(self.startup_timeout)
+
+    def _check_health_periodically(self):
+        while not self._closed.wait(self.health_check_interval):
+            self.health_check()
+
+
+_pool = None
+_pool_pid = None
+_pool_lock = threading.Lock()
+
+
+def get_recalc_pool() -> RecalcPool:
+    """The pool of this process, which is created after gunicorn forks the worker so isn't shared between them"""
+    global _pool, _pool_pid
+    with _pool_lock:
+        if _pool is None or _pool_pid != os.getpid():
+            _pool = RecalcPool(
+                [Config.LO_WORKER_PYTHON, WORKER_SCRIPT],
+                size=Config.LO_POOL_SIZE,
+                job_timeout=Config.LO_JOB_TIMEOUT,
+                startup_timeout=Config.LO_STARTUP_TIMEOUT,
+                health_check_interval=Config.LO_HEALTH_CHECK_INTERVAL
+            )
+            _pool_pid = os.getpid()
+        return _pool
@@ -0,0 +1,157 @@
+"""
+LibreOffice recalculation worker, run by the RecalcPool in util/lo_pool.py. It must be run with a python that has the
+LibreOffice uno module, e.g. /usr/bin/python3 with the python3-uno package, so it doesn't import anything from the app.
+
+It starts one headless soffice, then serves jobs on a unix socket, one at a time. Each connection sends a JSON line
+and gets a JSON line back: {"path": ...} to recalculate a workbook and save it in place, or {"ping": true}.
+The worker exits if soffice does, and the pool starts another. It also exits if the app worker which started it
+does, as that may be killed without stopping its pool, and soffice is killed if it is.
+"""
+import argparse
+import ctypes
+import json
+import os
+import signal
+import socket
+import subprocess
+import sys
+import threading
+import time
+
+import uno
+from com.sun.star.beans import PropertyValue
+from com.sun.star.connection import NoConnectException
+
+XLSX_FILTER = 'Calc MS Excel 2007 XML'
+PR_SET_PDEATHSIG = 1
+PARENT_CHECK_INTERVAL = 1  # seconds
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--socket', required=True, help='path of the unix socket to serve jobs on')
+    parser.add_argument('--profile', required=True, help='LibreOffice user profile dir, one per instance')
+    parser.add_argument('--soffice', default='soffice')
+    parser.add_argument('--startup-timeout', type=float, default=60)
+    args = parser.parse_args()
+
+    pipe_name = f'grid-api-lo-{os.getpid()}'
+    soffice = subprocess.Popen([
+        args.soffice, '--headless', '--invisible', '--nologo', '--nodefault', '--norestore', '--nolockcheck',
+        f'-env:UserInstallation={uno.systemPathToFileUrl(os.path.abspath(args.profile))}',
+        f'--accept=pipe,name={pipe_name};urp;StarOffice.ComponentContext'
+    ], preexec_fn=_kill_with_parent)
+    signal.signal(signal.SIGTERM, lambda *_: _exit(soffice, 0))
+    threading.Thread(target=_watch_parent, args=(soffice, os.getppid()), daemon=True).start()
+
+    try:
+        desktop = _connect(pipe_name, soffice, args.startup_timeout)
+    except Exception as e:
+        print(f'Unable to start LibreOffice: {e!r}', file=sys.stderr)
+        _exit(soffice, 1)
+
+    if os.path.exists(args.socket):
+        os.remove(args.socket)
+    server = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    server.bind(args.socket)
+    server.listen()  # the pool waits for the socket, so only binds once soffice is ready
+
+    while True:
+        connection, _ = server.accept()
+        with connection, connection.makefile('rwb') as stream:
+            try:
+                request = json.loads(stream.readline())
+            except ValueError:
+                continue
+            if soffice.poll() is not None:
+                _exit(soffice, 1)
+            reply = _ping(desktop) if request.get('ping') else _recalculate(desktop, request['path'])
+            stream.write(json.dumps(reply).encode('utf-8') + b'\n')
+            stream.flush()
+            if not reply['ok'] and soffice.poll() is not None:
+                _exit(soffice, 1)
+
+
+def _connect(pipe_name: str, soffice: subprocess.Popen, timeout: float):
+    local_context = uno.getComponentContext()
+    resolver = local_context.ServiceManager.createInstanceWithContext(
+        'com.sun.star.bridge.UnoUrlResolver', local_context
+    )
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            context = resolver.resolve(f'uno:pipe,name={pipe_name};urp;StarOffice.ComponentContext')
+            return context.ServiceManager.createInstanceWithContext('com.sun.star.frame.Desktop', context)
+        except NoConnectException:
+            if soffice.poll() is not None or time.monotonic() > deadline:
+                raise
+            time.sleep(0.25)
+
+
+def _ping(desktop) -> dict:
+    try:
+        desktop.getComponents()
+        return {'ok': True}
+    except Exception as e:
+        return {'ok': False, 'error': repr(e)}
+
+
+def _recalculate(desktop, path: str) -> dict:
+    """Load the workbook, recalculate all formulas so their results are cached in the file, and save it in place"""
+    url = uno.systemPathToFileUrl(os.path.abspath(path))
+    try:
+        document = desktop.loadComponentFromURL(url, '_blank', 0, (_property('Hidden', True),))
+        if document is None:
+            return {'ok': False, 'error': f'Unable to load {path!r}'}
+        try:
+            document.calculateAll()
+            document.storeToURL(url, (_property('FilterName', XLSX_FILTER), _property('Overwrite', True)))
+        finally:
+            document.close(True)
+        return {'ok': True}
+    except Exception as e:
+        return {'ok': False, 'error': repr(e)}
+
+
+def _property(name: str, value) -> PropertyValue:
+    prop = PropertyValue()
+    prop.Name = name
+    prop.Value = value
+    return prop
+
+
+def _kill_with_parent():
+    """
+    Have soffice killed if this worker is. It's started by the main thread, which lives as long as the worker,
+    as the signal is sent when the thread which started it exits.
+    """
+    try:
+        ctypes.CDLL(None).prctl(PR_SET_PDEATHSIG, signal.SIGKILL)
+    except (OSError, AttributeError):
+        pass  # not linux, so soffice is only stopped when this worker exits by itself
+
+
+def _watch_parent(soffice: subprocess.Popen, parent_pid: int):
+    """Exit once the app worker which started this has, when this is reparented"""
+    while os.getppid() == parent_pid:
+        time.sleep(PARENT_CHECK_INTERVAL)
+    _stop(soffice)
+    os._exit(0)  # sys.exit only ends this thread
+
+
+def _stop(soffice: subprocess.Popen):
+    if soffice.poll() is None:
+        soffice.terminate()
+        try:
+            soffice.wait(10)
+        except subprocess.TimeoutExpired:
+            soffice.kill()
+
+
+def _exit(soffice: subprocess.Popen, code: int):
+    _stop(soffice)
+    sys.exit(code)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,216 @@
+import os
+import pickle
+import sqlite3
+import threading
+from typing import Callable, Optional
+
+from util.LRU import LRUCache
+
+
+class SharedStoreError(Exception):
+    pass
+
+
+class SharedStore:
+    """
+    Local SQLite store shared by the worker processes on one host. It holds a generation per key, which is bumped
+    on every replace or invalidation, and the pickled value of the current generation if a worker has built it.
+    Values are saved within a budget of bytes, over which those saved longest ago are deleted, to be built again.
+    """
+
+    def __init__(self, path: str, max_bytes: int = None):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._local = threading.local()
+        _check_private(path)
+        with self._connection() as connection:
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS generations (key TEXT PRIMARY KEY, generation INTEGER NOT NULL)'
+            )
+            connection.execute(
+                'CREATE TABLE IF NOT EXISTS entries (key TEXT PRIMARY KEY, generation INTEGER NOT NULL, data BLOB)'
+            )
+
+    def _connection(self) -> sqlite3.Connection:
+        """One connection per thread, and a new one after gunicorn forks a worker"""
+        connection = getattr(self._local, 'connection', None)
+        if connection is None or self._local.pid != os.getpid():
+            connection = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('PRAGMA synchronous=NORMAL')
+            self._local.connection = connection
+            self._local.pid = os.getpid()
+        return connection
+
+    def generation(self, key: str) -> int:
+        row = self._connection().execute('SELECT generation FROM generations WHERE key = ?', (key,)).fetchone()
+        return row[0] if row else 0
+
+    def load(self, key: str, generation: int) -> Optional[bytes]:
+        row = self._connection().execute(
+            'SELECT data FROM entries WHERE key = ? AND generation = ?', (key, generation)
+        ).fetchone()
+        return row[0] if row else None
+
+    def save(self, key: str, generation: int, data: bytes):
+        """Save a value built from the given generation, unless the key has moved on since"""
+        connection = self._connection()
+        with _transaction(connection):
+            if self.generation(key) == generation:
+                connection.execute(
+                    'INSERT OR REPLACE INTO entries (key, generation, data) VALUES (?, ?, ?)', (key, generation, data)
+                )
+                self._evict(connection)
+
+    def replace(self, key: str, data: Optional[bytes], expected_generation: int = None) -> Optional[int]:
+        """
+        Move the key to a new generation, holding data or nothing if None. Returns the new generation, or None if
+        an expected generation was given and the key has moved on from it.
+        """
+        connection = self._connection()
+        with _transaction(connection):
+            generation = self.generation(key)
+            if expected_generation is not None and generation != expected_generation:
+                return None
+            generation += 1
+            connection.execute(
+                'INSERT OR REPLACE INTO generations (key, generation) VALUES (?, ?)', (key, generation)
+            )
+            if data is None:
+                connection.execute('DELETE FROM entries WHERE key = ?', (key,))
+            else:
+                connection.execute(
+                    'INSERT OR REPLACE INTO entries (key, generation, data) VALUES (?, ?, ?)', (key, generation, data)
+                )
+                self._evict(connection)
+            return generation
+
+    def _evict(self, connection: sqlite3.Connection):
+        """Delete the values saved longest ago while over the budget. A replace reinserts a row, so they're first."""
+        if self.max_bytes is None:
+            return
+        total = connection.execute('SELECT COALESCE(SUM(LENGTH(data)), 0) FROM entries').fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        for rowid, size in connection.execute('SELECT rowid, LENGTH(data) FROM entries ORDER BY rowid').fetchall():
+            connection.execute('DELETE FROM entries WHERE rowid = ?', (rowid,))
+            total -= size
+            if total <= self.max_bytes:
+                break
+
+    def clear(self):
+        connection = self._connection()
+        with _transaction(connection):
+            connection.execute('UPDATE generations SET generation = generation + 1')
+            connection.execute('DELETE FROM entries')
+
+    def summary(self) -> dict:
+        row = self._connection().execute('SELECT COUNT(*), COALESCE(SUM(LENGTH(data)), 0) FROM entries').fetchone()
+        return {'sharedsize': row[0], 'sharedbytes': row[1]}
+
+
+class _transaction:
+    """BEGIN IMMEDIATE takes the write lock up front, so read-then-write is atomic across processes"""
+
+    def __init__(self, connection: sqlite3.Connection):
+        self.connection = connection
+
+    def __enter__(self):
+        self.connection.execute('BEGIN IMMEDIATE')
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.connection.execute('COMMIT' if exc_type is None else 'ROLLBACK')
+
+
+class SharedLRUCache(LRUCache):
+    """
+    LRU cache of values in this process, kept coherent with the other gunicorn workers through a SharedStore.
+    A local value is used only while its generation is the current shared one, so a replace or remove in any
+    worker is seen by all of them. A miss loads the value another worker already built before computing it.
+    The store is only read and written outside the lock, as a write can wait on another worker's, and the
+    generations read are reconciled with the local values under the lock afterwards.
+    """
+
+    def __init__(self, store: SharedStore, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.store = store
+        self.loaded = {}  # key -> shared generation of the local value
+        self.shared_hits = 0
+
+    def remove(self, *args, generation: int = None, **kwargs) -> bool:
+        key = self._generate_key(*args, **kwargs)
+        if self.store.replace(key, None, expected_generation=generation) is None:
+            return False
+        return super().remove(*args, **kwargs)
+
+    def replace(self, value, *args, generation: int = None, **kwargs) -> bool:
+        key = self._generate_key(*args, **kwargs)
+        new_generation = self.store.replace(key, _dumps(value), expected_generation=generation)
+        if new_generation is None:
+            return False
+        with self._lock:
+            if key in self.cache and self.loaded.get(key, 0) > new_generation:
+                return True  # replaced again by another thread in the meantime
+            super().replace(value, *args, **kwargs)
+            self.loaded[key] = new_generation
+        return True
+
+    def generation(self, *args, **kwargs) -> int:
+        return self.store.generation(self._generate_key(*args, **kwargs))
+
+    def clear(self) -> bool:
+        self.store.clear()
+        with self._lock:
+            self.loaded.clear()
+            self.shared_hits = 0
+            return super().clear()
+
+    def summary(self) -> dict:
+        return {**super().summary(), **self.store.summary(), 'sharedhits': self.shared_hits}
+
+    def _sync(self, key):
+        generation = self.store.generation(key)
+        with self._lock:
+            # a value loaded or replaced since the generation was read is newer, so is kept
+            if key in self.cache and self.loaded.get(key, 0) < generation:
+                self._pop(key)
+
+    def _compute(self, key, func: Callable, *args, **kwargs):
+        generation = self.store.generation(key)
+        data = self.store.load(key, generation)
+        if data is not None:
+            value = pickle.loads(data)
+            with self._lock:
+                self.shared_hits += 1
+        else:
+            value = func(*args, **kwargs)
+            self.store.save(key, generation, _dumps(value))
+        with self._lock:
+            self.loaded[key] = generation
+        return value
+
+    def _pop(self, key):
+        super()._pop(key)
+        self.loaded.pop(key, None)
+
+
+def _check_private(path: str):
+    """
+    Values in the store are unpickled, so it must only be writable by this user. The store is created readable and
+    writable only by it, and an existing one, or the sqlite journal files beside it, must be owned by it.
+    """
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_NOFOLLOW, 0o600)
+    os.close(fd)
+    for file_path in [path, f'{path}-wal', f'{path}-shm']:
+        try:
+            stat = os.lstat(file_path)
+        except FileNotFoundError:
+            continue
+        if stat.st_uid != os.getuid():
+            raise SharedStoreError(f'Shared cache file {file_path!r} is not owned by the user running the app')
+        if stat.st_mode & 0o077:
+            os.chmod(file_path, 0o600)
+
+
+def _dumps(value) -> bytes:
+    return pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
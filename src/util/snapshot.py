@@ -0,0 +1,476 @@
+import json
+import struct
+import sys
+import threading
+import zlib
+from array import array
+from collections import Counter, OrderedDict
+from datetime import date, datetime, time, timedelta
+from typing import List, Sequence, Callable, Hashable
+
+from constants import DATE_FORMAT
+
+BLANK = ''
+MAX_SAFE_INT = 2 ** 53
+# header of serialized snapshots, bump the format when the layout changes so old ones are reparsed
+SNAPSHOT_MAGIC = b'GRIDSNAP'
+SNAPSHOT_FORMAT = 2
+
+
+class SnapshotError(ValueError):
+    pass
+
+
+class NumberColumn:
+    """Column of numeric cell values, stored as a typed array with a parallel array of value kinds"""
+    EMPTY, INT, FLOAT = 0, 1, 2
+
+    def __init__(self):
+        self.values = array('d')
+        self.kinds = bytearray()
+
+    def __len__(self):
+        return len(self.kinds)
+
+    def __getitem__(self, index: int):
+        kind = self.kinds[index]
+        if kind == self.INT:
+            return int(self.values[index])
+        if kind == self.FLOAT:
+            return self.values[index]
+        return BLANK
+
+    def append(self, value) -> bool:
+        """Append a value, returning False if it cannot be stored in a numeric column"""
+        value_type = type(value)
+        if value is None or value == BLANK:
+            self.values.append(0.0)
+            self.kinds.append(self.EMPTY)
+        elif value_type is int and -MAX_SAFE_INT <= value <= MAX_SAFE_INT:
+            self.values.append(value)
+            self.kinds.append(self.INT)
+        elif value_type is float:
+            self.values.append(value)
+            self.kinds.append(self.FLOAT)
+        else:
+            return False
+        return True
+
+    def slice(self, start: int, end: int) -> list:
+        values, kinds = self.values, self.kinds
+        int_, float_ = self.INT, self.FLOAT
+        return [
+            int(values[i]) if kinds[i] == int_ else values[i] if kinds[i] == float_ else BLANK
+            for i in range(start, end)
+        ]
+
+    def take(self, indexes: Sequence[int]) -> list:
+        return [self[i] for i in indexes]
+
+    def truncate(self, length: int):
+        del self.values[length:]
+        del self.kinds[length:]
+
+    def stats(self) -> dict:
+        populated = [self[i] for i, kind in enumerate(self.kinds) if kind != self.EMPTY]
+        return {
+            'count': len(populated),
+            'blanks': len(self) - len(populated),
+            'distinct': len(set(populated)),
+            'min': min(populated, default=None),
+            'max': max(populated, default=None)
+        }
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.values) + sys.getsizeof(self.kinds)
+
+
+class PackedStrings:
+    """Immutable sequence of strings held as one utf-8 buffer plus offsets, rather than one object per string"""
+
+    def __init__(self, strings: List[str]):
+        encoded = [s.encode('utf-8') for s in strings]
+        self.offsets = array('Q', [0])
+        total = 0
+        for e in encoded:
+            total += len(e)
+            self.offsets.append(total)
+        self.buffer = b''.join(encoded)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, index: int) -> str:
+        return self.buffer[self.offsets[index]:self.offsets[index + 1]].decode('utf-8')
+
+    @property
+    def nbytes(self) -> int:
+        return sys.getsizeof(self.offsets) + sys.getsizeof(self.buffer)
+
+
+class DictionaryColumn:
+    """Column of cell values of any type, stored as an array of codes into a list of distinct values"""
+
+    def __init__(self):
+        self.codes = array('I')
+        self.values = [BLANK]
+        self._index = {(str, BLANK): 0}
+
+    @classmethod
+    def from_column(cls, column: NumberColumn) -> 'DictionaryColumn':
+        dictionary_column = cls()
+        for i in range(len(column)):
+            dictionary_column.append(column[i])
+        return dictionary_column
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, index: int):
+        return self.values[self.codes[index]]
+
+    def append(self, value) -> bool:
+        if value is None:
+            value = BLANK
+        # key on type as well as value, otherwise 1, 1.0 and True would share a code
+        key = (type(value), value)
+        code = self._index.get(key)
+        if code is None:
+            code = self._index[key] = len(self.values)
+            self.values.append(value)
+        self.codes.append(code)
+        return True
+
+    def slice(self, start: int, end: int) -> list:
+        values = self.values
+        return [values[code] for code in self.codes[start:end]]
+
+    def take(self, indexes: Sequence[int]) -> list:
+        values, codes = self.values, self.codes
+        return [values[codes[i]] for i in indexes]
+
+    def truncate(self, length: int):
+        del self.codes[length:]
+
+    def stats(self) -> dict:
+        code_counts = Counter(self.codes)
+        blanks = code_counts.pop(0, 0)
+        return {
+            'count': len(self) - blanks,
+            'blanks': blanks,
+            'distinct': len(code_counts),
+            'min': None,
+            'max': None
+        }
+
+    def finish(self):
+        """Drop the build index, and pack the values if they are all strings, e.g. free text columns"""
+        self._index = None
+        if all(type(v) is str for v in self.values):
+            self.values = PackedStrings(self.values)
+
+    def format_dates(self):
+        """Format the distinct date values as strings, which is much cheaper than formatting every cell"""
+        for code, value in enumerate(self.values):
+            try:
+                self.values[code] = value.strftime(DATE_FORMAT)
+            except AttributeError:
+                pass
+
+    @property
+    def nbytes(self) -> int:
+        if isinstance(self.values, PackedStrings):
+            return sys.getsizeof(self.codes) + self.values.nbytes
+        return sys.getsizeof(self.codes) + sys.getsizeof(self.values) + sum(sys.getsizeof(v) for v in self.values)
+
+
+class FileSnapshot:
+    """
+    Compact, columnar representation of a worksheet's data rows, which is what the file cache holds.
+    Row dicts are only rendered from the columns when a response is being built.
+    """
+
+    def __init__(self, headers: List[str], column_letters: List[str], data_types: dict, columns: list):
+        self.headers = headers
+        self.column_letters = column_letters
+        self.data_types = data_types
+        self.columns = columns
+        self.row_count = len(columns[0]) if columns else 0
+        self.derived = {}
+        self.derived_nbytes = 0
+        self._derived_lock = threading.Lock()
+        self._columns_nbytes = None
+        self.version = None  # version of the file the snapshot was built from
+
+    def rows(self, start: int = 0, end: int = None, compact: bool = False) -> List[dict or list]:
+        """
+        Render rows in the same shape as the ag-grid rowData, with the 1-based '_rowNumber' of each row.
+        If compact, each row is a list of values in the order of fields, rather than a dict.
+        """
+        end = self.row_count if end is None else min(end, self.row_count)
+        start = min(start, end)
+        row_numbers = range(start + 1, end + 1)
+        column_values = [column.slice(start, end) for column in self.columns]
+        return self._render(row_numbers, column_values, compact)
+
+    def rows_at(self, indexes: Sequence[int], compact: bool = False) -> List[dict or list]:
+        """Render the rows at the given indexes, e.g. the rows matching a filter, keeping their '_rowNumber'"""
+        row_numbers = [i + 1 for i in indexes]
+        column_values = [column.take(indexes) for column in self.columns]
+        return self._render(row_numbers, column_values, compact)
+
+    @property
+    def column_stats(self) -> dict:
+        """Counts of the values of each column, computed on first use as they need a pass over every cell"""
+        return self.memoize(
+            'column_stats', None,
+            lambda: {header: column.stats() for header, column in zip(self.headers, self.columns)}, maxsize=1
+        )
+
+    @property
+    def fields(self) -> List[str]:
+        return ['_rowNumber', *self.headers]
+
+    def _render(self, row_numbers: Sequence[int], column_values: List[list], compact: bool) -> List[dict or list]:
+        if compact:
+            return [list(values) for values in zip(row_numbers, *column_values)]
+        keys = self.fields
+        return [dict(zip(keys, values)) for values in zip(row_numbers, *column_values)]
+
+    def memoize(self, kind: str, key: Hashable, compute: Callable, maxsize: int):
+        """
+        Get something derived from the snapshot, such as a rendered block of rows, computing it on first use.
+        Each kind of derived value is kept in its own LRU of maxsize. Derived values live and die with the
+        snapshot, so they never need invalidating separately. The snapshot is shared by the requests of a file, so
+        the LRUs are locked, but not while computing, and the first value computed for a key is the one kept.
+        """
+        with self._derived_lock:
+            derived = self.derived.setdefault(kind, OrderedDict())
+            if key in derived:
+                derived.move_to_end(key)
+                return derived[key][0]
+
+        value = compute()
+        size = _estimate_nbytes(value)
+        with self._derived_lock:
+            if key in derived:
+                return derived[key][0]
+            derived[key] = (value, size)
+            self.derived_nbytes += size
+            while len(derived) > maxsize:
+                _, (_, evicted_size) = derived.popitem(last=False)
+                self.derived_nbytes -= evicted_size
+        return value
+
+    @property
+    def nbytes(self) -> int:
+        """Approximate memory held by the snapshot, including what has been derived from it"""
+        if self._columns_nbytes is None:
+            self._columns_nbytes = (
+                sum(column.nbytes for column in self.columns) + sum(sys.getsizeof(h) for h in self.headers)
+            )
+        return self._columns_nbytes + self.derived_nbytes
+
+    def __getstate__(self) -> dict:
+        """Derived values are left out when pickling, e.g. for the shared cache, and are rebuilt on demand"""
+        state = self.__dict__.copy()
+        state['derived'] = {}
+        state['derived_nbytes'] = 0
+        del state['_derived_lock']
+        return state
+
+    def __setstate__(self, state: dict):
+        self.__dict__.update(state)
+        self._derived_lock = threading.Lock()
+
+
+def _estimate_nbytes(value) -> int:
+    """Size of a derived value, counting the row dicts and their cell values for rendered rows"""
+    if isinstance(value, list):
+        return sys.getsizeof(value) + sum(
+            sys.getsizeof(row) + sum(sys.getsizeof(v) for v in row.values()) if isinstance(row, dict)
+            else sys.getsizeof(row)
+            for row in value
+        )
+    return sys.getsizeof(value)
+
+
+def dump_snapshot(snapshot: FileSnapshot) -> bytes:
+    """
+    Serialize a snapshot for persisting, without anything derived from it. After the magic and format, the
+    compressed body is the length of a JSON description of the snapshot and its columns, the description, then
+    the bytes of the column arrays in little-endian order, so loading it never runs code from the data.
+    """
+    buffers = []
+    description = json.dumps({
+        'headers': [_encode_value(header) for header in snapshot.headers],
+        'column_letters': snapshot.column_letters,
+        'data_types': [[_encode_value(header), data_type] for header, data_type in snapshot.data_types.items()],
+        'version': snapshot.version,
+        'columns': [_dump_column(column, buffers) for column in snapshot.columns]
+    }).encode('utf-8')
+    body = b''.join([struct.pack('<I', len(description)), description, *buffers])
+    return SNAPSHOT_MAGIC + SNAPSHOT_FORMAT.to_bytes(2, 'little') + zlib.compress(body, 1)
+
+
+def load_snapshot(data: bytes) -> FileSnapshot:
+    """Deserialize a snapshot, raising SnapshotError if it is corrupt or from another format"""
+    header_size = len(SNAPSHOT_MAGIC) + 2
+    if data[:len(SNAPSHOT_MAGIC)] != SNAPSHOT_MAGIC:
+        raise SnapshotError('Not a serialized snapshot')
+    snapshot_format = int.from_bytes(data[len(SNAPSHOT_MAGIC):header_size], 'little')
+    if snapshot_format != SNAPSHOT_FORMAT:
+        raise SnapshotError(f'Snapshot format {snapshot_format} is not the current format {SNAPSHOT_FORMAT}')
+    try:
+        body = memoryview(zlib.decompress(data[header_size:]))
+        (description_size,) = struct.unpack_from('<I', body)
+        offset = 4 + description_size
+        description = json.loads(bytes(body[4:offset]).decode('utf-8'))
+        columns = []
+        for column_description in description['columns']:
+            column, offset = _load_column(column_description, body, offset)
+            columns.append(column)
+        headers = [_decode_value(header) for header in description['headers']]
+        data_types = {_decode_value(header): data_type for header, data_type in description['data_types']}
+        snapshot = FileSnapshot(headers, description['column_letters'], data_types, columns)
+        snapshot.version = description['version']
+    except SnapshotError:
+        raise
+    except Exception as e:
+        raise SnapshotError(f'Corrupt snapshot: {e!r}')
+    if offset != len(body) or len(headers) != len(columns) or any(len(c) != snapshot.row_count for c in columns):
+        raise SnapshotError('Corrupt snapshot: the columns do not match its description')
+    return snapshot
+
+
+def _dump_column(column: NumberColumn or DictionaryColumn, buffers: List[bytes]) -> dict:
+    """Describe a column, appending its arrays to buffers"""
+    if isinstance(column, NumberColumn):
+        return {
+            'type': 'number',
+            'values': _dump_array(column.values, buffers),
+            'kinds': _dump_array(column.kinds, buffers)
+        }
+    description = {'type': 'dictionary', 'codes': _dump_array(column.codes, buffers)}
+    if isinstance(column.values, PackedStrings):
+        description['offsets'] = _dump_array(column.values.offsets, buffers)
+        description['buffer'] = _dump_array(column.values.buffer, buffers)
+    else:
+        description['values'] = [_encode_value(value) for value in column.values]
+    return description
+
+
+def _load_column(description: dict, body: memoryview, offset: int) -> tuple:
+    """Rebuild a column from its description and the arrays in body from offset, returning it and the next offset"""
+    if description['type'] == 'number':
+        column = NumberColumn()
+        offset = _load_array(column.values, description['values'], body, offset)
+        kinds = array('B')
+        offset = _load_array(kinds, description['kinds'], body, offset)
+        column.kinds = bytearray(kinds)
+        if len(column.values) != len(column.kinds) or any(kind > NumberColumn.FLOAT for kind in column.kinds):
+            raise SnapshotError('Corrupt snapshot: invalid number column')
+        return column, offset
+
+    if description['type'] != 'dictionary':
+        raise SnapshotError(f'Corrupt snapshot: unknown column type {description["type"]!r}')
+    column = DictionaryColumn()
+    column._index = None
+    offset = _load_array(column.codes, description['codes'], body, offset)
+    if 'values' in description:
+        column.values = [_decode_value(value) for value in description['values']]
+    else:
+        packed = column.values = PackedStrings([])
+        packed.offsets = array('Q')
+        offset = _load_array(packed.offsets, description['offsets'], body, offset)
+        buffer = array('B')
+        offset = _load_array(buffer, description['buffer'], body, offset)
+        packed.buffer = buffer.tobytes()
+        if not packed.offsets or packed.offsets[-1] != len(packed.buffer):
+            raise SnapshotError('Corrupt snapshot: invalid strings')
+    if column.codes and max(column.codes) >= len(column.values):
+        raise SnapshotError('Corrupt snapshot: invalid dictionary column')
+    return column, offset
+
+
+def _dump_array(values: array or bytearray or bytes, buffers: List[bytes]) -> int:
+    if sys.byteorder == 'big' and isinstance(values, array):
+        values = array(values.typecode, values)
+        values.byteswap()
+    data = bytes(values)
+    buffers.append(data)
+    return len(data)
+
+
+def _load_array(values: array, size: int, body: memoryview, offset: int) -> int:
+    if offset + size > len(body):
+        raise SnapshotError('Corrupt snapshot: truncated')
+    values.frombytes(body[offset:offset + size])
+    if sys.byteorder == 'big':
+        values.byteswap()
+    return offset + size
+
+
+_VALUE_TYPES = {datetime: datetime.fromisoformat, date: date.fromisoformat, time: time.fromisoformat}
+
+
+def _encode_value(value):
+    """JSON form of a cell value, with dates, times and durations as [type name, arguments...]"""
+    value_type = type(value)
+    if value is None or value_type in (str, int, float, bool):
+        return value
+    if value_type in _VALUE_TYPES:
+        return [value_type.__name__, value.isoformat()]
+    if value_type is timedelta:
+        return ['timedelta', value.days, value.seconds, value.microseconds]
+    raise SnapshotError(f'Cannot serialize a {value_type.__name__} value')
+
+
+def _decode_value(value):
+    if not isinstance(value, list):
+        return value
+    type_name, *arguments = value
+    if type_name == 'timedelta':
+        return timedelta(*arguments)
+    parse = next((parse for value_type, parse in _VALUE_TYPES.items() if value_type.__name__ == type_name), None)
+    if parse is None:
+        raise SnapshotError(f'Corrupt snapshot: unknown value type {type_name!r}')
+    return parse(*arguments)
+
+
+class SnapshotBuilder:
+    """Build a FileSnapshot one row at a time, so the worksheet rows never need to be held in memory"""
+
+    def __init__(self, headers: Sequence, column_letters: Sequence[str]):
+        self.headers = list(headers)
+        self.column_letters = list(column_letters)
+        self.columns = [NumberColumn() for _ in self.headers]
+        self.row_count = 0
+        self.last_populated_row = 0
+
+    def append(self, values: Sequence):
+        """Append a row of cell values. Rows shorter than the header row are padded with blanks."""
+        populated = False
+        for i, column in enumerate(self.columns):
+            value = values[i] if i < len(values) else None
+            if not column.append(value):
+                column = self.columns[i] = DictionaryColumn.from_column(column)
+                column.append(value)
+            if value is not None and value != BLANK:
+                populated = True
+
+        self.row_count += 1
+        if populated:
+            self.last_populated_row = self.row_count
+
+    def build(self, data_types: dict) -> FileSnapshot:
+        """Trailing empty rows cause problems when the cells have styles so they are dropped"""
+        for header, column in zip(self.headers, self.columns):
+            column.truncate(self.last_populated_row)
+            if isinstance(column, DictionaryColumn):
+                if data_types.get(header) == 'd':
+                    column.format_dates()
+                column.finish()
+
+        return FileSnapshot(self.headers, self.column_letters, data_types, self.columns)
@@ -0,0 +1,71 @@
+from array import array
+from datetime import date, datetime, timezone
+from typing import List, Tuple
+
+from util.filters import parse_date
+from util.snapshot import FileSnapshot, DictionaryColumn, BLANK
+
+
+def sort_key(value, data_type: str) -> tuple:
+    """Order blanks first, as ag-grid does, then numbers, dates and text. Date cells are held as formatted text."""
+    if value is None or value == BLANK:
+        return 0, 0
+    if data_type == 'd' and isinstance(value, str):
+        parsed = parse_date(value)
+        if parsed is not None:
+            return 2, _as_datetime(parsed)
+    if isinstance(value, (int, float)):
+        return 1, value
+    if isinstance(value, date):
+        return 2, _as_datetime(value)
+    return 3, str(value)
+
+
+def _as_datetime(value: date) -> datetime:
+    """Dates as at midnight, and datetimes with a timezone as naive UTC, so a column mixing them can be ordered"""
+    if not isinstance(value, datetime):
+        return datetime(value.year, value.month, value.day)
+    if value.tzinfo is not None:
+        return value.astimezone(timezone.utc).replace(tzinfo=None)
+    return value
+
+
+def column_ranks(snapshot: FileSnapshot, col_index: int) -> array:
+    """
+    Dense rank of each row's value within a column, so equal values share a rank. Sorting by ranks is a cheap
+    int comparison, and ranks of several columns combine for multi-column sorts.
+    """
+    column = snapshot.columns[col_index]
+    data_type = snapshot.data_types.get(snapshot.headers[col_index])
+
+    if isinstance(column, DictionaryColumn):
+        # rank the distinct values only, then map each row's code to its value's rank
+        values = column.values
+        keys = [sort_key(values[code], data_type) for code in range(len(values))]
+        code_ranks = _dense_ranks(keys)
+        return array('I', [code_ranks[code] for code in column.codes])
+
+    keys = [sort_key(value, data_type) for value in column.slice(0, len(column))]
+    return _dense_ranks(keys)
+
+
+def sort_rows(ranks: List[Tuple[array, bool]], row_count: int) -> array:
+    """Stable permutation of row indexes, sorted by each (column ranks, descending) in turn"""
+    if len(ranks) == 1:
+        column_rank, descending = ranks[0]
+        key = (lambda i: -column_rank[i]) if descending else column_rank.__getitem__
+    else:
+        key = lambda i: tuple(-r[i] if descending else r[i] for r, descending in ranks)
+    return array('I', sorted(range(row_count), key=key))
+
+
+def _dense_ranks(keys: list) -> array:
+    order = sorted(range(len(keys)), key=keys.__getitem__)
+    ranks = array('I', [0]) * len(keys)
+    rank, previous = -1, None
+    for i in order:
+        if rank < 0 or keys[i] != previous:
+            rank += 1
+            previous = keys[i]
+        ranks[i] = rank
+    return ranks
@@ -4,6 +4,7 @@ import subprocess
 from sys import platform
 
 from config import Config
+from util.lo_pool import get_recalc_pool, RecalcError
 
 log = logging.getLogger(__name__)
 
@@ -23,6 +24,9 @@ def _open_close_libre(input_file: str) -> bool:
         log.warning(f'Unable to open-close file {input_file!r} as LibreOffice is not available')
         return False
 
+    if Config.LO_POOL_SIZE:
+        return _recalculate_libre(input_file)
+
     try:
         log.info(f'Open-close file {input_file!r} - begin')
         input_dir, input_filename = os.path.split(input_file)
@@ -48,6 +52,18 @@ def _open_close_libre(input_file: str) -> bool:
         return False
 
 
+def _recalculate_libre(input_file: str) -> bool:
+    """Recalculate and save the file in place with one of the long lived LibreOffice instances of the pool"""
+    try:
+        log.info(f'Recalculate file {input_file!r} - begin')
+        get_recalc_pool().recalculate(input_file)
+        log.info(f'Recalculate file {input_file!r} - complete')
+        return True
+    except RecalcError:
+        log.exception(f'Recalculate file {input_file!r} - error')
+        return False
+
+
 def _open_close_excel(input_file, platform_: str) -> bool:
     """Open and close excel to re-evaluate formula and cache results. Requires Excel installation on machine."""
     if not Config.EXCEL_AVAILABLE:
@@ -0,0 +1,344 @@
+import html
+import re
+import shutil
+import zipfile
+from datetime import datetime, date, time, timedelta
+from io import BytesIO
+from types import SimpleNamespace
+from typing import Dict, Iterator, Optional, Set
+from xml.etree.ElementTree import fromstring, tostring, ParseError
+from xml.sax.saxutils import escape
+
+from openpyxl.cell.cell import ILLEGAL_CHARACTERS_RE
+from openpyxl.styles.numbers import BUILTIN_FORMATS
+from openpyxl.utils.cell import column_index_from_string, coordinate_from_string, get_column_letter
+from openpyxl.utils.datetime import to_excel
+
+from util.formulas import FormulaError, cached_value_xml, evaluate_formulas
+from util.xlsx_reader import XlsxReader, XlsxReaderError, SHEET_MAIN_NS
+
+# parts of a worksheet which refer to cell ranges, so would need moving along with the rows
+UNSUPPORTED_SHEET_TAGS = [
+    'mergeCells', 'tableParts', 'conditionalFormatting', 'dataValidations', 'hyperlinks', 'autoFilter', 'sortState',
+    'drawing', 'legacyDrawing', 'rowBreaks', 'extLst'
+]
+_UNSUPPORTED_SHEET_TAG = re.compile(rf'<(?:\w+:)?({"|".join(UNSUPPORTED_SHEET_TAGS)})\b')
+_DIMENSION = re.compile(r'<dimension\b[^>]*/>')
+_ROW = re.compile(r'<row\b([^>]*?)(?:/>|>(.*?)</row>)', re.DOTALL)
+_CELL = re.compile(r'<c\b([^>]*?)(?:/>|>(.*?)</c>)', re.DOTALL)
+_FORMULA = re.compile(r'<f\b([^>]*?)(?:/>|>(.*?)</f>)', re.DOTALL)
+_ATTR = re.compile(r'\s+([\w:]+)="([^"]*)"')
+
+WRITE_BATCH_ROWS = 1000
+
+
+class XlsxPatchError(Exception):
+    pass
+
+
+class SheetPatch:
+    """
+    The active sheet of a workbook as a minimal openpyxl Worksheet, so changes can be made to it with the same code,
+    but saved by rewriting only the sheet xml. Rows which aren't changed or moved are copied as they are, cached
+    formula results are recalculated in Python, and every other part of the package is copied unchanged.
+    Workbooks it can't patch safely, e.g. with merged cells or tables whose ranges would need moving, shared
+    formulas or a calculation chain, raise an XlsxPatchError so the caller can rewrite them with openpyxl instead.
+    Only what the changes of a transaction use is supported: reading and setting cell values and number formats,
+    adding a row after the last and deleting rows.
+    """
+
+    def __init__(self, file_bytes: bytes):
+        try:
+            reader = XlsxReader(file_bytes)
+            rows = list(reader.iter_rows(with_types=True))
+        except XlsxReaderError as e:
+            raise XlsxPatchError(f'Unable to read workbook: {e}') from e
+        if reader.max_row is None:
+            raise XlsxPatchError('Worksheet has no dimension')
+        if any(name.endswith('calcChain.xml') for name in reader.archive.NameToInfo):
+            raise XlsxPatchError('Workbook has a calculation chain, which would need updating')
+
+        self.archive = reader.archive
+        self.sheet_path = reader.sheet_path
+        self.parent = SimpleNamespace(epoch=reader.epoch)  # for the formula evaluator, as with a Worksheet
+        self.styles = _CellFormats(self.archive, reader.styles_path)
+        self._max_column = reader.max_col or 0
+        self.rows = [_Row(number, values, types) for number, (values, types) in enumerate(rows, start=1)]
+        self.head, self.tail = self._read_sheet()
+
+    @property
+    def max_row(self) -> int:
+        return len(self.rows)
+
+    @property
+    def max_column(self) -> int:
+        return self._max_column
+
+    def __getitem__(self, key: int or str):
+        """A row by number, a column by letter or a cell by coordinate, as ws[1], ws['A'] and ws['A1']"""
+        if isinstance(key, int):
+            row = self._row(key)
+            return tuple(self._cell(row, col) for col in range(1, self.max_column + 1))
+        if key.isalpha():
+            col = column_index_from_string(key)
+            return tuple(self._cell(row, col) for row in self.rows)
+        letters, number = coordinate_from_string(key)
+        return self._cell(self._row(number), column_index_from_string(letters))
+
+    @property
+    def values(self) -> Iterator[tuple]:
+        for row in self.rows:
+            yield tuple(row.values)
+
+    def delete_rows(self, idx: int, amount: int = 1):
+        del self.rows[idx - 1:idx - 1 + amount]
+        for row in self.rows[idx - 1:]:
+            row.number -= amount
+
+    def save(self) -> bytes:
+        """The workbook with the sheet rewritten, and the results of all its formulas cached"""
+        try:
+            results = evaluate_formulas(self)
+        except FormulaError as e:
+            raise XlsxPatchError(f'Unable to evaluate formulas: {e}') from e
+
+        output = BytesIO()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as target:
+            for info in self.archive.infolist():
+                target_info = zipfile.ZipInfo(info.filename, info.date_time)
+                target_info.compress_type = zipfile.ZIP_DEFLATED
+                target_info.external_attr = info.external_attr
+                with target.open(target_info, 'w') as destination:
+                    if info.filename == self.sheet_path:
+                        self._write_sheet(destination, results)
+                    else:
+                        with self.archive.open(info) as source:
+                            shutil.copyfileobj(source, destination)
+        return output.getvalue()
+
+    def _read_sheet(self) -> (str, str):
+        """Split the sheet xml around its rows, which are kept as they are until changed"""
+        xml = self.archive.read(self.sheet_path).decode('utf-8')
+        start, end = xml.find('<sheetData>'), xml.rfind('</sheetData>')
+        if start < 0 or end < 0:
+            raise XlsxPatchError('Worksheet has no sheetData, or it has a namespace prefix')
+        head, tail = xml[:start + len('<sheetData>')], xml[end:]
+        unsupported = _UNSUPPORTED_SHEET_TAG.search(head) or _UNSUPPORTED_SHEET_TAG.search(tail)
+        if unsupported:
+            raise XlsxPatchError(f'Worksheet has {unsupported.group(1)}, which refer to cell ranges')
+        if not _DIMENSION.search(head):
+            raise XlsxPatchError('Worksheet has no dimension')
+
+        previous = 0
+        for match in _ROW.finditer(xml, start, end):
+            attrs = dict(_ATTR.findall(match.group(1)))
+            number = int(attrs.pop('r', 0))
+            if number <= previous or number > len(self.rows):
+                raise XlsxPatchError(f'Unexpected row {number} after row {previous}')
+            previous = number
+            row = self.rows[number - 1]
+            row.raw, row.inner, row.original_number = match.group(0), match.group(2) or '', number
+            attrs.pop('spans', None)  # only a hint, which could be wrong once cells are added
+            row.attrs = ''.join(f' {name}="{value}"' for name, value in attrs.items())
+            if '<f' in row.inner:
+                self._read_formulas(row)
+        return head, tail
+
+    @staticmethod
+    def _read_formulas(row: '_Row'):
+        """Formula cells are read as their cached results, which are replaced by the formulas as in openpyxl"""
+        for match in _CELL.finditer(row.inner):
+            formula = _FORMULA.search(match.group(2) or '')
+            if not formula:
+                continue
+            attrs = dict(_ATTR.findall(match.group(1)))
+            formula_attrs = dict(_ATTR.findall(formula.group(1)))
+            if formula_attrs.get('t', 'normal') != 'normal' or 'cm' in attrs or 'vm' in attrs:
+                raise XlsxPatchError(f'Unsupported formula in cell {attrs.get("r")}')
+            col = column_index_from_string(attrs['r'].rstrip('0123456789'))
+            row.values[col - 1] = f'={html.unescape(formula.group(2) or "")}'
+
+    def _row(self, number: int) -> '_Row':
+        if number == len(self.rows) + 1:
+            self.rows.append(_Row(number, [None] * self.max_column, [None] * self.max_column))
+        elif not 1 <= number <= len(self.rows):
+            raise XlsxPatchError(f'Row {number} is not in the sheet, or the one after it')
+        return self.rows[number - 1]
+
+    def _cell(self, row: '_Row', col: int) -> '_Cell':
+        cell = row.cells.get(col)
+        if cell is None:
+            if col > len(row.values):
+                padding = [None] * (col - len(row.values))
+                row.values.extend(padding)
+                row.types.extend(padding)
+            self._max_column = max(self._max_column, col)
+            cell = row.cells[col] = _Cell(row, col)
+        return cell
+
+    def _write_sheet(self, destination, results: Dict[str, object]):
+        dimension = f'<dimension ref="A1:{get_column_letter(max(self.max_column, 1))}{max(self.max_row, 1)}" />'
+        destination.write(_DIMENSION.sub(dimension, self.head, count=1).encode('utf-8'))
+        batch = []
+        for row in self.rows:
+            batch.append(self._row_xml(row, results))
+            if len(batch) >= WRITE_BATCH_ROWS:
+                destination.write(''.join(batch).encode('utf-8'))
+                batch = []
+        batch.append(self.tail)
+        destination.write(''.join(batch).encode('utf-8'))
+
+    def _row_xml(self, row: '_Row', results: Dict[str, object]) -> str:
+        has_formulas = 'f' in row.types
+        if row.raw is not None and row.number == row.original_number and not row.dirty and not has_formulas:
+            return row.raw
+
+        cells = {}
+        for match in _CELL.finditer(row.inner or ''):
+            attrs = dict(_ATTR.findall(match.group(1)))
+            col = column_index_from_string(attrs.pop('r').rstrip('0123456789'))
+            if col in row.dirty or row.types[col - 1] == 'f':
+                cells[col] = self._cell_xml(row, col, attrs.get('s'), results)
+            else:
+                attrs = ''.join(f' {name}="{value}"' for name, value in attrs.items())
+                inner = match.group(2)
+                cells[col] = f'<c r="{get_column_letter(col)}{row.number}"{attrs}' + (
+                    '/>' if inner is None else f'>{inner}</c>'
+                )
+        for col in row.dirty - cells.keys():
+            cells[col] = self._cell_xml(row, col, None, results)
+
+        if row.raw is None and not any(cells.values()):
+            return ''  # rows without any cells aren't written, as with openpyxl
+        return f'<row r="{row.number}"{row.attrs}>{"".join(cells[col] for col in sorted(cells))}</row>'
+
+    def _cell_xml(self, row: '_Row', col: int, style: Optional[str], results: Dict[str, object]) -> str:
+        """A changed or formula cell, written as openpyxl would with strings inline"""
+        coordinate = f'{get_column_letter(col)}{row.number}'
+        value = row.values[col - 1]
+        cell = row.cells.get(col)
+        if cell is not None and cell.number_format_set:
+            style = str(self.styles.find(int(style or 0), cell.number_format))
+        style_attr = f' s="{style}"' if style and style != '0' else ''
+
+        if value is None:
+            return f'<c r="{coordinate}"{style_attr}/>' if style_attr else ''
+        if row.types[col - 1] == 'f':
+            type_attr, text = cached_value_xml(results[coordinate], self.parent.epoch)
+            return f'<c r="{coordinate}"{style_attr}{type_attr}><f>{escape(value[1:])}</f><v>{text}</v></c>'
+        if isinstance(value, bool):
+            return f'<c r="{coordinate}"{style_attr} t="b"><v>{int(value)}</v></c>'
+        if isinstance(value, (int, float)):
+            return f'<c r="{coordinate}"{style_attr} t="n"><v>{value!r}</v></c>'
+        if isinstance(value, (datetime, date, time, timedelta)):
+            if not style_attr:
+                raise XlsxPatchError(f'Date in cell {coordinate} has no number format')
+            return f'<c r="{coordinate}"{style_attr} t="n"><v>{to_excel(value, self.parent.epoch)!r}</v></c>'
+        if isinstance(value, str):
+            if ILLEGAL_CHARACTERS_RE.search(value):
+                raise XlsxPatchError(f'Illegal characters in cell {coordinate}')
+            space = ' xml:space="preserve"' if value != value.strip() else ''
+            return f'<c r="{coordinate}"{style_attr} t="inlineStr"><is><t{space}>{escape(value)}</t></is></c>'
+        raise XlsxPatchError(f'Unsupported value {value!r} in cell {coordinate}')
+
+
+class _Row:
+    def __init__(self, number: int, values: list, types: list):
+        self.number = number
+        self.original_number = None  # the number of the row in the sheet xml, if it was there
+        self.raw = self.inner = None
+        self.attrs = ''
+        self.values = values
+        self.types = types
+        self.cells: Dict[int, _Cell] = {}
+        self.dirty: Set[int] = set()  # columns of the cells which have been set
+
+
+class _Cell:
+    """A cell of a SheetPatch, with the attributes of an openpyxl Cell which changes use"""
+    __slots__ = ('row', 'column', '_number_format')
+
+    def __init__(self, row: _Row, column: int):
+        self.row = row
+        self.column = column
+        self._number_format = None
+
+    @property
+    def number_format(self) -> str:
+        return self._number_format or 'General'
+
+    @number_format.setter
+    def number_format(self, number_format: str):
+        self._number_format = number_format
+        self.row.dirty.add(self.column)
+
+    @property
+    def number_format_set(self) -> bool:
+        return self._number_format is not None
+
+    @property
+    def value(self):
+        return self.row.values[self.column - 1]
+
+    @value.setter
+    def value(self, value):
+        self.row.values[self.column - 1] = value
+        self.row.types[self.column - 1] = _data_type(value)
+        self.row.dirty.add(self.column)
+
+    @property
+    def data_type(self) -> str:
+        return self.row.types[self.column - 1] or 'n'
+
+    @property
+    def column_letter(self) -> str:
+        return get_column_letter(self.column)
+
+    @property
+    def coordinate(self) -> str:
+        return f'{self.column_letter}{self.row.number}'
+
+
+def _data_type(value) -> str:
+    """The openpyxl data type of a value assigned to a cell"""
+    if isinstance(value, bool):
+        return 'b'
+    if isinstance(value, str):
+        return 'f' if value.startswith('=') and len(value) > 1 else 's'
+    if isinstance(value, (datetime, date, time, timedelta)):
+        return 'd'
+    return 'n'
+
+
+class _CellFormats:
+    """The cell formats of a workbook, to find the one a cell has once its number format is set"""
+
+    def __init__(self, archive: zipfile.ZipFile, path: Optional[str]):
+        self.formats = []
+        if path is None:
+            return
+        try:
+            root = fromstring(archive.read(path))
+        except (KeyError, ParseError) as e:
+            raise XlsxPatchError(f'Unable to read styles: {e!r}') from e
+        codes = dict(BUILTIN_FORMATS)
+        for num_fmt in root.iterfind(f'{{{SHEET_MAIN_NS}}}numFmts/{{{SHEET_MAIN_NS}}}numFmt'):
+            codes[int(num_fmt.get('numFmtId'))] = num_fmt.get('formatCode')
+        for xf in root.iterfind(f'{{{SHEET_MAIN_NS}}}cellXfs/{{{SHEET_MAIN_NS}}}xf'):
+            # formats are the same apart from the number format if they have the same font, fill, border etc.
+            others = (
+                tuple(xf.get(name, '0') for name in ['fontId', 'fillId', 'borderId', 'xfId', 'quotePrefix']),
+                tuple(tostring(child) for child in xf)
+            )
+            self.formats.append((codes.get(int(xf.get('numFmtId', 0))), others))
+
+    def find(self, index: int, number_format: str) -> int:
+        if index >= len(self.formats):
+            raise XlsxPatchError(f'Cell format {index} not found')
+        code, others = self.formats[index]
+        if code == number_format:
+            return index
+        for i, (other_code, other_others) in enumerate(self.formats):
+            if other_code == number_format and other_others == others:
+                return i
+        raise XlsxPatchError(f'No cell format with number format {number_format!r}, which would need adding')
@@ -0,0 +1,338 @@
+import posixpath
+import mmap
+import zipfile
+from typing import Iterator, List, Optional
+from xml.etree.ElementTree import iterparse, ParseError, fromstring
+from xml.parsers import expat
+
+from openpyxl.styles.numbers import is_date_format, builtin_format_code
+from openpyxl.utils.datetime import from_excel, from_ISO8601, WINDOWS_EPOCH, MAC_EPOCH
+from openpyxl.utils.cell import range_boundaries, column_index_from_string
+
+from util.buffers import as_file
+
+SHEET_MAIN_NS = 'http://schemas.openxmlformats.org/spreadsheetml/2006/main'
+REL_NS = 'http://schemas.openxmlformats.org/package/2006/relationships'
+DOC_REL_NS = 'http://schemas.openxmlformats.org/officeDocument/2006/relationships'
+
+ROW_TAG = f'{{{SHEET_MAIN_NS}}}row'
+TEXT_TAG = f'{{{SHEET_MAIN_NS}}}t'
+RICH_TEXT_RUN_TAG = f'{{{SHEET_MAIN_NS}}}r'
+STRING_ITEM_TAG = f'{{{SHEET_MAIN_NS}}}si'
+DIMENSION_TAG = f'{{{SHEET_MAIN_NS}}}dimension'
+SHEET_DATA_TAG = f'{{{SHEET_MAIN_NS}}}sheetData'
+
+WORKSHEET_REL_TYPE = f'{DOC_REL_NS}/worksheet'
+SHARED_STRINGS_REL_TYPE = f'{DOC_REL_NS}/sharedStrings'
+STYLES_REL_TYPE = f'{DOC_REL_NS}/styles'
+OFFICE_DOCUMENT_REL_TYPE = f'{DOC_REL_NS}/officeDocument'
+
+CHUNK_SIZE = 64 * 1024
+
+
+class XlsxReaderError(Exception):
+    pass
+
+
+class XlsxReader:
+    """
+    Read the cell values of a workbook's active sheet straight from the xlsx zip, without building any openpyxl
+    cell objects. Values match what openpyxl returns in read-only mode. Anything unexpected raises an
+    XlsxReaderError, so the caller can fall back to openpyxl for unusual files.
+    """
+
+    def __init__(self, file_bytes: bytes or mmap.mmap):
+        try:
+            self.archive = zipfile.ZipFile(as_file(file_bytes))
+            workbook_path = self._get_workbook_path()
+            workbook_rels = self._read_rels(workbook_path)
+            self.epoch, self.sheet_path = self._read_workbook(workbook_path, workbook_rels)
+            self.shared_strings = self._read_shared_strings(workbook_rels)
+            self.styles_path = self._find_rel_target(workbook_rels, STYLES_REL_TYPE)
+            self.date_styles = self._read_date_styles(self.styles_path)
+            self.max_row, self.max_col = self._read_dimensions()
+        except (KeyError, ValueError, IndexError, ParseError, zipfile.BadZipFile) as e:
+            raise XlsxReaderError(f'Unable to read workbook: {e!r}') from e
+
+    def iter_rows(self, with_types: bool = False) -> Iterator:
+        """
+        Yield a list of cell values for each row, from the first row, with missing rows and cells as None.
+        Formula cells give their cached value. If with_types, yield (values, types) where types are the
+        openpyxl data types of the cells when loaded with data_only=False, i.e. 'f' for formula cells.
+        """
+        try:
+            yield from self._iter_rows(with_types)
+        except (KeyError, ValueError, IndexError, expat.ExpatError, zipfile.BadZipFile) as e:
+            raise XlsxReaderError(f'Unable to read worksheet {self.sheet_path!r}: {e!r}') from e
+
+    def _iter_rows(self, with_types: bool) -> Iterator:
+        handler = _SheetHandler(self, with_types)
+        parser = expat.ParserCreate(namespace_separator=' ')
+        parser.buffer_text = True
+        parser.StartElementHandler = handler.start
+        parser.EndElementHandler = handler.end
+        parser.CharacterDataHandler = handler.data
+
+        # the parser is fed in chunks, so only the rows completed by each chunk are held in memory
+        with self.archive.open(self.sheet_path) as source:
+            while not handler.done:
+                chunk = source.read(CHUNK_SIZE)
+                parser.Parse(chunk, not chunk)
+                rows, handler.rows = handler.rows, []
+                yield from rows
+                if not chunk:
+                    break
+
+        yield from handler.pad_rows(self.max_row)
+
+    def _get_workbook_path(self) -> str:
+        for rel in self._read_rels('').values():
+            if rel[0] == OFFICE_DOCUMENT_REL_TYPE:
+                return rel[1]
+        return 'xl/workbook.xml'
+
+    def _read_rels(self, part_path: str) -> dict:
+        """Map relationship ids to (type, target path) for a part of the package"""
+        part_dir, part_name = posixpath.split(part_path)
+        rels_path = posixpath.join(part_dir, '_rels', f'{part_name}.rels')
+        if rels_path not in self.archive.NameToInfo:
+            return {}
+
+        root = fromstring(self.archive.read(rels_path))
+        rels = {}
+        for rel in root.iter(f'{{{REL_NS}}}Relationship'):
+            if rel.get('TargetMode') == 'External':
+                continue
+            target = rel.get('Target')
+            if target.startswith('/'):
+                target = target[1:]
+            else:
+                target = posixpath.normpath(posixpath.join(part_dir, target))
+            rels[rel.get('Id')] = (rel.get('Type'), target)
+        return rels
+
+    def _read_workbook(self, workbook_path: str, workbook_rels: dict) -> tuple:
+        root = fromstring(self.archive.read(workbook_path))
+        if root.tag != f'{{{SHEET_MAIN_NS}}}workbook':
+            raise XlsxReaderError(f'Unsupported workbook namespace in {root.tag!r}')
+
+        workbook_pr = root.find(f'{{{SHEET_MAIN_NS}}}workbookPr')
+        date1904 = workbook_pr is not None and workbook_pr.get('date1904') in ['1', 'true']
+        epoch = MAC_EPOCH if date1904 else WINDOWS_EPOCH
+
+        workbook_view = root.find(f'{{{SHEET_MAIN_NS}}}bookViews/{{{SHEET_MAIN_NS}}}workbookView')
+        active_tab = int(workbook_view.get('activeTab', 0)) if workbook_view is not None else 0
+        sheets = root.findall(f'{{{SHEET_MAIN_NS}}}sheets/{{{SHEET_MAIN_NS}}}sheet')
+        rel_type, sheet_path = workbook_rels[sheets[active_tab].get(f'{{{DOC_REL_NS}}}id')]
+        if rel_type != WORKSHEET_REL_TYPE:
+            raise XlsxReaderError(f'Active sheet is not a worksheet: {rel_type!r}')
+        return epoch, sheet_path
+
+    def _read_shared_strings(self, workbook_rels: dict) -> List[str]:
+        path = self._find_rel_target(workbook_rels, SHARED_STRINGS_REL_TYPE)
+        if path is None:
+            return []
+
+        shared_strings = []
+        with self.archive.open(path) as source:
+            for _, element in iterparse(source):
+                if element.tag == STRING_ITEM_TAG:
+                    shared_strings.append(_string_item_text(element).replace('x005F_', ''))
+                    element.clear()
+        return shared_strings
+
+    def _read_date_styles(self, path: Optional[str]) -> set:
+        """Get the indexes of the cell styles which have a date number format"""
+        if path is None:
+            return set()
+
+        root = fromstring(self.archive.read(path))
+        custom_formats = {
+            int(num_fmt.get('numFmtId')): num_fmt.get('formatCode')
+            for num_fmt in root.iterfind(f'{{{SHEET_MAIN_NS}}}numFmts/{{{SHEET_MAIN_NS}}}numFmt')
+        }
+        date_styles = set()
+        for idx, xf in enumerate(root.iterfind(f'{{{SHEET_MAIN_NS}}}cellXfs/{{{SHEET_MAIN_NS}}}xf')):
+            num_fmt_id = int(xf.get('numFmtId', 0))
+            fmt = custom_formats.get(num_fmt_id) or builtin_format_code(num_fmt_id)
+            if is_date_format(fmt):
+                date_styles.add(idx)
+        return date_styles
+
+    def _read_dimensions(self) -> (Optional[int], Optional[int]):
+        """Get the max row and column from the sheet dimension, which openpyxl also uses to size the rows"""
+        with self.archive.open(self.sheet_path) as source:
+            for _, element in iterparse(source):
+                if element.tag == DIMENSION_TAG:
+                    _, _, max_col, max_row = range_boundaries(element.get('ref'))
+                    return max_row, max_col
+                if element.tag in [ROW_TAG, SHEET_DATA_TAG]:
+                    break
+        return None, None
+
+    @staticmethod
+    def _find_rel_target(rels: dict, rel_type: str) -> Optional[str]:
+        for type_, target in rels.values():
+            if type_ == rel_type:
+                return target
+        return None
+
+
+class _SheetHandler:
+    """Expat callbacks which collect the cell values of each row of a worksheet as it is parsed"""
+    ROW = f'{SHEET_MAIN_NS} row'
+    CELL = f'{SHEET_MAIN_NS} c'
+    VALUE = f'{SHEET_MAIN_NS} v'
+    FORMULA = f'{SHEET_MAIN_NS} f'
+    INLINE_STRING = f'{SHEET_MAIN_NS} is'
+    TEXT = f'{SHEET_MAIN_NS} t'
+    PHONETIC_RUN = f'{SHEET_MAIN_NS} rPh'
+
+    def __init__(self, reader: XlsxReader, with_types: bool):
+        self.shared_strings = reader.shared_strings
+        self.date_styles = {str(style_id) for style_id in reader.date_styles}
+        self.epoch = reader.epoch
+        self.max_row = reader.max_row
+        self.max_col = reader.max_col
+        self.with_types = with_types
+        self.empty_row = [None] * self.max_col if self.max_col else []
+        self.column_indexes = {}
+        self.dates = {}
+
+        self.rows = []
+        self.done = False
+        self.row_counter = 0
+        self.values = self.types = None
+        self.col_counter = 0
+
+        self.cell_type = self.cell_style = None
+        self.has_formula = False
+        self.text = None
+        self.value_text = None
+        self.inline_text = None
+        self.in_phonetic_run = False
+
+    def start(self, name: str, attrs: dict):
+        if name == self.CELL:
+            coordinate = attrs.get('r')
+            if coordinate:
+                letters = coordinate.rstrip('0123456789')
+                col_index = self.column_indexes.get(letters)
+                if col_index is None:
+                    col_index = self.column_indexes[letters] = column_index_from_string(letters)
+                self.col_counter = col_index
+            else:
+                self.col_counter += 1
+            self.cell_type = attrs.get('t', 'n')
+            self.cell_style = attrs.get('s')
+            self.has_formula = False
+            self.value_text = self.inline_text = None
+        elif name == self.VALUE:
+            self.text = []
+        elif name == self.FORMULA:
+            self.has_formula = True
+        elif name == self.ROW:
+            if self.done:
+                return
+            row_index = attrs.get('r')
+            row_index = int(row_index) if row_index else self.row_counter + 1
+            if self.max_row is not None and row_index > self.max_row:
+                self.done = True
+                return
+            # rows without any cells may be missing from the xml
+            self.rows.extend(self.pad_rows(row_index - 1))
+            self.row_counter = row_index
+            self.values = list(self.empty_row)
+            self.types = list(self.empty_row)
+            self.col_counter = 0
+        elif name == self.INLINE_STRING:
+            self.inline_text = []
+        elif name == self.TEXT and self.inline_text is not None and not self.in_phonetic_run:
+            self.text = []
+        elif name == self.PHONETIC_RUN:
+            self.in_phonetic_run = True
+
+    def data(self, text: str):
+        if self.text is not None:
+            self.text.append(text)
+
+    def end(self, name: str):
+        if name == self.CELL:
+            if self.values is not None and not (self.max_col and self.col_counter > self.max_col):
+                self._set_cell()
+        elif name == self.VALUE:
+            self.value_text = ''.join(self.text)
+            self.text = None
+        elif name == self.ROW:
+            if self.values is not None:
+                self.rows.append((self.values, self.types) if self.with_types else self.values)
+                self.values = self.types = None
+        elif name == self.TEXT and self.text is not None:
+            self.inline_text.append(''.join(self.text))
+            self.text = None
+        elif name == self.PHONETIC_RUN:
+            self.in_phonetic_run = False
+
+    def pad_rows(self, up_to_row: int) -> list:
+        rows = []
+        while up_to_row is not None and self.row_counter < up_to_row:
+            self.row_counter += 1
+            rows.append((list(self.empty_row), list(self.empty_row)) if self.with_types else list(self.empty_row))
+        return rows
+
+    def _set_cell(self):
+        """Convert the cached value of the cell as openpyxl would, and its data type as with data_only=False"""
+        data_type = self.cell_type
+        value = None if data_type == 'inlineStr' else self.value_text or None
+
+        if value is not None:
+            if data_type == 'n':
+                value = float(value) if '.' in value or 'E' in value or 'e' in value else int(value)
+                if self.cell_style in self.date_styles:
+                    data_type = 'd'
+                    value = self._to_date(value)
+                    if value is None:
+                        data_type = 'e'
+                        value = '#VALUE!'
+            elif data_type == 's':
+                value = self.shared_strings[int(value)]
+            elif data_type == 'b':
+                value = bool(int(value))
+            elif data_type == 'str':
+                data_type = 's'
+            elif data_type == 'd':
+                value = from_ISO8601(value)
+        elif data_type == 'inlineStr' and self.inline_text is not None:
+            data_type = 's'
+            value = ''.join(self.inline_text)
+
+        if self.has_formula:
+            data_type = 'f'
+
+        col_index = self.col_counter - 1
+        values, types = self.values, self.types
+        if len(values) <= col_index:
+            padding = [None] * (col_index + 1 - len(values))
+            values.extend(padding)
+            types.extend(padding)
+        values[col_index] = value
+        types[col_index] = data_type
+
+    def _to_date(self, serial):
+        """Dates repeat a lot in a column, so the conversions are memoized"""
+        try:
+            return self.dates[serial]
+        except KeyError:
+            try:
+                date = from_excel(serial, self.epoch)
+            except (OverflowError, ValueError):
+                date = None
+            self.dates[serial] = date
+            return date
+
+
+def _string_item_text(element) -> str:
+    """Text of a shared string or inline string, joining any rich text runs and ignoring phonetic runs"""
+    snippets = [element.findtext(TEXT_TAG) or '']
+    snippets.extend(run.findtext(TEXT_TAG) or '' for run in element.iterfind(RICH_TEXT_RUN_TAG))
+    return ''.join(snippets)